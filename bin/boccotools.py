@@ -6,6 +6,6 @@ import sys
 ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
 sys.path.append(ROOT)
 
-import bocco
+import bocco.daemon
 
-bocco.cli.cli(obj={})
+bocco.daemon.main()
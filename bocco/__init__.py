@@ -10,6 +10,20 @@ Web API の詳細は http://api-docs.bocco.me を参照してください。
 
 """
 from __future__ import absolute_import
-from . import api, models, cli
+import sys
+
+_SUBMODULES = ('api', 'models', 'pool', 'cli')
+
+if (3, 7) <= sys.version_info:
+    # bocco.daemon からコマンドを転送するときに Flask などを読み込まないよう、
+    # サブモジュールは最初に参照されたときに読み込む
+    import importlib
+
+    def __getattr__(name):
+        if name in _SUBMODULES:
+            return importlib.import_module('.' + name, __name__)
+        raise AttributeError('module {0!r} has no attribute {1!r}'.format(__name__, name))
+else:
+    from . import api, models, pool, cli
 
 VERSION = '0.1.4'
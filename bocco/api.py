@@ -1,14 +1,23 @@
 # encoding: utf-8
 from __future__ import absolute_import
+import copy
+import errno
+import json
+import mimetypes
+import os
 import sys
+import threading
+import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 
 try:
-    from typing import Any, Dict, List, Optional, Type, Tuple
+    from typing import Any, BinaryIO, Callable, Dict, Iterator, List, Optional, Type, Tuple, Union
 except:
     pass
 
 import requests
+from requests.adapters import HTTPAdapter
 from schema import SchemaError
 
 from .models import ApiErrorBody, Session, Room, Message, MessageMedia
@@ -20,13 +29,25 @@ if (3, 0) <= sys.version_info:
 
 BASE_URL = 'https://api.bocco.me/alpha'
 
+#: アップロード時にファイルから一度に読み込むバイト数
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+#: :class:`Client` が対応している HTTP のトランスポート
+TRANSPORTS = ('http1', 'http2')
+
+#: ダウンロード時に一度に書き込むバイト数
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+#: :class:`SessionManager` がセッションを保存するファイル
+SESSION_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.bocco', 'session.json')
+
 
 class Client(object):
     """BOCCO API クライアント"""
 
     @classmethod
-    def signin(cls, api_key, email, password):
-        # type: (str, str, str) -> Client
+    def signin(cls, api_key, email, password, base_url=None, transport='http1', timeout=None):
+        # type: (str, str, str, Optional[str], str, Any) -> Client
         """新しいセッションでクライアントを作成する
 
         .. code-block:: python
@@ -38,12 +59,17 @@ class Client(object):
 
         Web API: http://api-docs.bocco.me/reference.html#post-sessions
         """
+        session = cls._create_session(api_key, email, password, base_url, timeout)
+        return Client(session['access_token'], base_url=base_url, transport=transport, timeout=timeout)
+
+    @classmethod
+    def _create_session(cls, api_key, email, password, base_url=None, timeout=None):
+        # type: (str, str, str, Optional[str], Any) -> Session
         data = {'apikey': api_key,
                 'email': email,
                 'password': password}
-        r = requests.post(BASE_URL + '/sessions', data=data)  # type: ignore
-        session = Client._parse(r.json(), Session)
-        return Client(session['access_token'])
+        r = requests.post((base_url or BASE_URL) + '/sessions', data=data, timeout=timeout)  # type: ignore
+        return Client._parse(r.json(), Session)
 
     @classmethod
     def _parse(cls, data, klass):
@@ -55,30 +81,140 @@ class Client(object):
         body = ApiErrorBody(data)
         raise ApiError(body)
 
-    def __init__(self, access_token):
-        # type: (str) -> None
+    @classmethod
+    def from_session_manager(cls, session_manager, **kwargs):
+        # type: (SessionManager, **Any) -> Client
+        """:class:`SessionManager` のセッションを使うクライアントを作成する
+
+        アクセストークンが失効していた場合 (401) は、一度だけ再サインインしてリクエストをやり直します。
+        ``kwargs`` は :class:`Client` のコンストラクタに渡されます。
+
+        .. code-block:: python
+
+           manager = bocco.api.SessionManager('API KEY', 'test@example.com', 'pass')
+           api = bocco.api.Client.from_session_manager(manager)
+        """
+        kwargs.setdefault('base_url', session_manager.base_url)
+        client = cls(session_manager.session['access_token'], **kwargs)
+        client.session_manager = session_manager
+        return client
+
+    def __init__(self, access_token, http_session=None, base_url=None, transport='http1', timeout=None):
+        # type: (str, Optional[requests.Session], Optional[str], str, Any) -> None
+        """
+        :param access_token: アクセストークン
+        :param http_session: HTTP 接続に使う :class:`requests.Session`
+                             (``transport='http2'`` の場合は :class:`~bocco.http2.Http2Session`)。
+                             複数のクライアントで共有するとコネクションプールも共有されます。
+        :param base_url: API の URL。省略時は :data:`BASE_URL`。
+                         :mod:`bocco.fake` のサーバに向ける場合などに指定します。
+        :param transport: ``http1`` (requests) または ``http2`` (httpx)。
+                          ``http2`` では同時に送ったリクエストが少数の接続に多重化されます。
+        :param timeout: リクエストのタイムアウト (秒、または ``(接続, 読み込み)`` のタプル)。
+                        ``None`` ならタイムアウトしない。
+                        :meth:`subscribe` のロングポーリングには接続のタイムアウトだけを使います。
+        """
+        if transport not in TRANSPORTS:
+            raise ValueError(u'Unknown transport: {0}'.format(transport))
         self.access_token = access_token  # type: str
+        self.base_url = base_url or BASE_URL  # type: str
         self.headers = {'Accept-Language': 'ja-JP,ja'}  # type: dict
+        self.session_manager = None  # type: Optional[SessionManager]
+        self.transport = transport  # type: str
+        self.timeout = timeout  # type: Any
+        if http_session is None:
+            if transport == 'http2':
+                from .http2 import Http2Session
+                http_session = Http2Session()
+            else:
+                http_session = requests.Session()
+        self.http = http_session  # type: requests.Session
+
+    def _with_pool_size(self, size):
+        # type: (int) -> Client
+        """``size`` 本の接続を持つ専用のセッションを使う、このクライアントの複製を返す
+
+        共有しているセッションのアダプタを差し替えずに、同時に使う接続を増やすためのもの。
+        HTTP/2 では同時リクエストが多重化されるので、このクライアントをそのまま返す。
+        """
+        if not isinstance(self.http, requests.Session):
+            return self
+        http = requests.Session()
+        for name in ('headers', 'auth', 'proxies', 'verify', 'cert', 'trust_env', 'cookies'):
+            setattr(http, name, getattr(self.http, name))
+        adapter = HTTPAdapter(pool_connections=size, pool_maxsize=size)
+        http.mount('https://', adapter)
+        http.mount('http://', adapter)
+        client = copy.copy(self)
+        client.http = http
+        return client
+
+    def _long_poll_timeout(self):
+        # type: () -> Any
+        """ロングポーリングのタイムアウト (接続のタイムアウトだけ)"""
+        if self.timeout is None:
+            return None
+        if isinstance(self.timeout, tuple):
+            return (self.timeout[0], None)
+        return (self.timeout, None)
+
+    def _request(self, send):
+        # type: (Callable[[str], requests.Response]) -> requests.Response
+        """``send(access_token)`` を呼び、401 なら再サインインして一度だけやり直す"""
+        access_token = self.access_token
+        r = send(access_token)
+        if r.status_code == 401 and self.session_manager is not None:
+            self.access_token = self.session_manager.refresh(access_token)
+            r = send(self.access_token)
+        return r
 
     def _post(self, path, data):
         # type: (str, Optional[Dict[str, Any]]) -> requests.Response
         if data is None:
             data = {}
-        if 'access_token' not in data:
-            data['access_token'] = self.access_token
-        return requests.post(BASE_URL + path,  # type: ignore
-                             data=data,
-                             headers=self.headers)
 
-    def _get(self, path, params = None):
-        # type: (str, Optional[Dict[str, Any]]) -> requests.Response
+        def send(access_token):
+            # type: (str) -> requests.Response
+            body = dict(data)  # type: Dict[str, Any]
+            body.setdefault('access_token', access_token)
+            return self.http.post(self.base_url + path,  # type: ignore
+                                  data=body,
+                                  headers=self.headers,
+                                  timeout=self.timeout)
+        return self._request(send)
+
+    def _post_multipart(self, path, fields, name, fileobj, progress=None, timeout=None):
+        # type: (str, Dict[str, str], str, BinaryIO, Optional[Callable[[int, int], None]], Optional[float]) -> requests.Response
+        start = fileobj.tell()
+
+        def send(access_token):
+            # type: (str) -> requests.Response
+            fileobj.seek(start)
+            body = _MultipartBody(dict(fields, access_token=access_token), name, fileobj, progress)
+            headers = dict(self.headers)
+            headers['Content-Type'] = body.content_type
+            return self.http.post(self.base_url + path,  # type: ignore
+                                  data=body,
+                                  headers=headers,
+                                  timeout=timeout if timeout is not None else self.timeout)
+        return self._request(send)
+
+    def _get(self, path, params = None, timeout = None):
+        # type: (str, Optional[Dict[str, Any]], Any) -> requests.Response
         if params is None:
             params = {}
-        if 'access_token' not in params:
-            params['access_token'] = self.access_token
-        return requests.get(BASE_URL + path,
-                            params=params,
-                            headers=self.headers)
+        if timeout is None:
+            timeout = self.timeout
+
+        def send(access_token):
+            # type: (str) -> requests.Response
+            query = dict(params)  # type: Dict[str, Any]
+            query.setdefault('access_token', access_token)
+            return self.http.get(self.base_url + path,
+                                 params=query,
+                                 headers=self.headers,
+                                 timeout=timeout)
+        return self._request(send)
 
     def get_rooms(self):
         # type: () -> List[Room]
@@ -112,18 +248,95 @@ class Client(object):
 
         Web API: http://api-docs.bocco.me/reference.html#get-roomsroomidmessages
         """
+        messages = []
+        for message_data in self._get_messages_data(room_uuid, newer_than, older_than, read):
+            messages.append(Message(message_data))
+        return messages
+
+    def get_recent_messages(self, room_uuid, limit, older_than=None, read=True):
+        # type: (uuid.UUID, int, Optional[int], bool) -> List[Message]
+        """最新 (``older_than`` を指定した場合はそれより前) の ``limit`` 件のメッセージを古い順に取得
+
+        必要なページだけを取得し、返すメッセージだけを検証します。
+        """
+        pages = []  # type: List[Dict[str, Any]]
+        if 0 < limit:
+            for page in self._iter_messages_data(room_uuid, older_than=older_than, read=read):
+                pages.extend(page)
+                if limit <= len(pages):
+                    break
+        return [Message(m) for m in reversed(pages[:limit])]
+
+    def follow_messages(self, room_uuid, newer_than=None, read=True, max_retry_interval=60.0):
+        # type: (uuid.UUID, Optional[int], bool, float) -> Iterator[Message]
+        """``newer_than`` より新しいメッセージを届いた順に返し続けるイテレータ
+
+        :meth:`subscribe` を繰り返し、返したメッセージの ID までカーソルを進めます。
+        接続が切れたり一時的なエラー (408、429、5xx) が返ったりした場合は、
+        1 秒から ``max_retry_interval`` 秒まで倍々に間隔を空けて再接続します。
+        それ以外のエラー (存在しない部屋や権限がない場合など) では :class:`requests.HTTPError` を投げます。
+        ``newer_than`` を省略すると、呼び出した時点の最新のメッセージより後から返します。
+        """
+        if newer_than is None:
+            newer_than = max([m['id'] for m in self._get_messages_data(room_uuid, read=False, check=True)] or [0])
+        retry_interval = 1.0
+        while True:
+            try:
+                events = self._subscribe_data(room_uuid, newer_than, read, check=True)
+            except (requests.RequestException, ValueError) as e:
+                if isinstance(e, requests.RequestException) and not _is_transient(e):
+                    raise
+                time.sleep(retry_interval)
+                retry_interval = min(retry_interval * 2, max_retry_interval)
+                continue
+            retry_interval = 1.0
+            data = [e['body'] for e in events if e.get('event') == u'message']
+            data.sort(key=lambda m: m['id'])
+            for message_data in data:
+                if newer_than < message_data['id']:
+                    newer_than = message_data['id']
+                    yield Message(message_data)
+
+    def _get_messages_data(self, room_uuid, newer_than=None, older_than=None, read=True, check=False):
+        # type: (uuid.UUID, Optional[int], Optional[int], bool, bool) -> List[Dict[str, Any]]
+        """:meth:`get_messages` と同じだが、検証前の JSON をそのまま返す
+
+        ``check`` が真なら、エラーのレスポンスで :class:`requests.HTTPError` を投げる。
+        """
+        r = self._get_messages_response(room_uuid, newer_than=newer_than, older_than=older_than, read=read, check=check)
+        data = r.json()
+        if type(data) != list:
+            return []
+        return data
+
+    def _get_messages_response(self, room_uuid, newer_than=None, older_than=None, read=True, check=False):
+        # type: (uuid.UUID, Optional[int], Optional[int], bool, bool) -> requests.Response
+        """:meth:`_get_messages_data` と同じだが、JSON をデコードせずにレスポンスを返す"""
         assert type(room_uuid) == uuid.UUID
         r = self._get('/rooms/{0}/messages'.format(room_uuid),
                       params={'newer_than': newer_than,
                               'older_than': older_than,
                               'read': 1 if read else 0})
-        data = r.json()
-        if type(data) != list:
-            return []
-        messages = []
-        for message_data in data:
-            messages.append(Message(message_data))
-        return messages
+        if check:
+            r.raise_for_status()
+        return r
+
+    def _iter_messages_data(self, room_uuid, older_than=None, read=True):
+        # type: (uuid.UUID, Optional[int], bool) -> Iterator[List[Dict[str, Any]]]
+        """``older_than`` より古いメッセージを新しい順に 1 ページずつ返す (検証前の JSON)
+
+        各ページは新しいメッセージが先頭になるよう並べ替えられます。
+        エラーのレスポンスを履歴の終わりと取り違えないよう、:class:`requests.HTTPError` を投げます。
+        """
+        while True:
+            page = self._get_messages_data(room_uuid, older_than=older_than, read=read, check=True)
+            if older_than is not None:
+                page = [m for m in page if m['id'] < older_than]
+            if not page:
+                return
+            page.sort(key=lambda m: m['id'], reverse=True)
+            yield page
+            older_than = page[-1]['id']
 
     def subscribe(self,
                   room_uuid,
@@ -143,19 +356,30 @@ class Client(object):
         Web API: http://api-docs.bocco.me/reference.html#get-roomsroomidsubscribe
         """
         assert type(room_uuid) == uuid.UUID
-        r = self._get('/rooms/{0}/subscribe'.format(room_uuid),
-                      params={'newer_than': newer_than,
-                              'read': 1 if read else 0})
-        data = r.json()
-        if type(data) != list:
-            return []
         messages = []
-        for event in data:
+        for event in self._subscribe_data(room_uuid, newer_than, read):
             if event['event'] == u'message':
                 messages.append(Message(event['body']))
             # TODO handle event['event'] == 'member'
         return messages
 
+    def _subscribe_data(self, room_uuid, newer_than=None, read=True, check=False):
+        # type: (uuid.UUID, Optional[int], bool, bool) -> List[Dict[str, Any]]
+        """:meth:`subscribe` のイベントを検証せずに返す
+
+        ``check`` が真なら、エラーのレスポンスで :class:`requests.HTTPError` を投げる。
+        """
+        r = self._get('/rooms/{0}/subscribe'.format(room_uuid),
+                      params={'newer_than': newer_than,
+                              'read': 1 if read else 0},
+                      timeout=self._long_poll_timeout())
+        if check:
+            r.raise_for_status()
+        data = r.json()
+        if type(data) != list:
+            return []
+        return data
+
     def _post_message(self, room_uuid, data):
         # type: (uuid.UUID, Dict[str, str]) -> Message
         data.setdefault('text', '')
@@ -171,31 +395,75 @@ class Client(object):
         # type: (uuid.UUID, str) -> Message
         """テキストメッセージの送信
 
-        現在 python ライブラリではテキストメッセージのみサポートしています。
-
         Web API: http://api-docs.bocco.me/reference.html#post-roomsroomidmessages
         """
         data = {'text': text,
                 'media': MessageMedia.text.value}
         return self._post_message(room_uuid, data)
 
-    def post_audio_message(self, room_uuid, audio):
+    def _post_media_message(self, room_uuid, media, source, progress=None, timeout=None):
+        # type: (uuid.UUID, MessageMedia, Union[str, BinaryIO], Optional[Callable[[int, int], None]], Optional[float]) -> Message
+        assert type(room_uuid) == uuid.UUID
+        path = '/rooms/{0}/messages'.format(room_uuid)
+        fields = {'media': media.value,
+                  'text': '',
+                  'unique_id': unicode(uuid.uuid4())}
+        if isinstance(source, (str, unicode)):
+            with open(source, 'rb') as f:
+                r = self._post_multipart(path, fields, media.value, f, progress, timeout)
+        else:
+            r = self._post_multipart(path, fields, media.value, source, progress, timeout)
+        return Client._parse(r.json(), Message)
+
+    def post_audio_message(self, room_uuid, audio, progress=None, timeout=None):
+        # type: (uuid.UUID, Union[str, BinaryIO], Optional[Callable[[int, int], None]], Optional[float]) -> Message
         """音声メッセージの送信
 
-        .. note::
+        ``audio`` にはファイルのパスまたはバイナリモードで開いたファイルオブジェクトを渡します。
+        ファイルは ``UPLOAD_CHUNK_SIZE`` ずつ読み込みながら送信するため、全体をメモリに載せません。
+
+        .. code-block:: python
+
+           def progress(sent, total):
+               print('{0}/{1}'.format(sent, total))
+
+           api.post_audio_message(room['uuid'], 'voice.m4a', progress=progress, timeout=30)
 
-           未実装
+        Web API: http://api-docs.bocco.me/reference.html#post-roomsroomidmessages
         """
-        pass
+        return self._post_media_message(room_uuid, MessageMedia.audio, audio, progress, timeout)
 
-    def post_image_message(self, room_uuid, image):
+    def post_image_message(self, room_uuid, image, progress=None, timeout=None):
+        # type: (uuid.UUID, Union[str, BinaryIO], Optional[Callable[[int, int], None]], Optional[float]) -> Message
         """画像メッセージの送信
 
-        .. note::
+        引数は :meth:`post_audio_message` と同じです。
 
-           未実装
+        Web API: http://api-docs.bocco.me/reference.html#post-roomsroomidmessages
         """
-        pass
+        return self._post_media_message(room_uuid, MessageMedia.image, image, progress, timeout)
+
+    def post_media_messages(self, room_uuid, media, sources, max_workers=4, progress=None, timeout=None):
+        # type: (uuid.UUID, MessageMedia, List[Union[str, BinaryIO]], int, Optional[Callable[[Any, int, int], None]], Optional[float]) -> List[Message]
+        """複数の音声または画像メッセージを並行して送信
+
+        最大 ``max_workers`` 件を同時にアップロードし、``sources`` と同じ順序で結果を返します。
+        ``progress`` は ``(source, sent, total)`` で呼ばれます。
+
+        .. code-block:: python
+
+           api.post_media_messages(room['uuid'], MessageMedia.audio, ['a.m4a', 'b.m4a'])
+        """
+        assert media in (MessageMedia.audio, MessageMedia.image)
+
+        def post(source):
+            callback = None
+            if progress is not None:
+                callback = lambda sent, total: progress(source, sent, total)
+            return self._post_media_message(room_uuid, media, source, callback, timeout)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(post, sources))
 
     def download(self, url, dest):
         # type: (str, str) -> requests.Response
@@ -203,18 +471,206 @@ class Client(object):
 
         Web API: http://api-docs.bocco.me/reference.html#get-messagesuniqueidextname
         """
-        params = {'access_token': self.access_token}
-        r = requests.get(url,
-                         params=params,
-                         headers=self.headers,
-                         stream=True)
+        r = self._request(lambda access_token: self.http.get(url,
+                                                             params={'access_token': access_token},
+                                                             headers=self.headers,
+                                                             stream=True,
+                                                             timeout=self.timeout))
         with open(dest, 'wb') as f:
-            for chunk in r.iter_content(chunk_size=1024):
+            for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
                 if chunk:
                     f.write(chunk)
         return r
 
 
+class SessionManager(object):
+    """サインインで得たセッションをディスクにキャッシュして使い回す
+
+    セッション (アクセストークンとユーザの UUID) は ``cache_path`` に
+    所有者のみ読み書きできるパーミッションで保存され、次回起動時はサインインせずに再利用されます。
+    アクセストークンが失効した場合は :meth:`refresh` で再サインインします。
+    複数のスレッドが同時に失効に気づいても、サインインは一度だけ行われます。
+
+    .. code-block:: python
+
+       manager = bocco.api.SessionManager('API KEY', 'test@example.com', 'pass')
+       api = bocco.api.Client.from_session_manager(manager)
+    """
+
+    def __init__(self, api_key, email, password, cache_path=SESSION_CACHE_PATH, base_url=None, timeout=None):
+        # type: (str, str, str, Optional[str], Optional[str], Any) -> None
+        self.api_key = api_key
+        self.email = email
+        self.password = password
+        self.cache_path = cache_path
+        self.base_url = base_url
+        self.timeout = timeout
+        self._session = None  # type: Optional[Session]
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        # type: () -> Session
+        """現在のセッション
+
+        キャッシュがあれば読み込み、なければサインインします。
+        """
+        with self._lock:
+            if self._session is None:
+                self._session = self._load()
+            if self._session is None:
+                self._signin()
+            return self._session  # type: ignore
+
+    def refresh(self, stale_access_token):
+        # type: (str) -> str
+        """失効した ``stale_access_token`` に代わるアクセストークンを返す
+
+        他のスレッドが既に再サインインしていれば、そのトークンを返します。
+        """
+        with self._lock:
+            if self._session is None or self._session['access_token'] == stale_access_token:
+                self._signin()
+            return self._session['access_token']  # type: ignore
+
+    def _signin(self):
+        # type: () -> None
+        self._session = Client._create_session(self.api_key, self.email, self.password, self.base_url,
+                                               self.timeout)
+        self._save(self._session)
+
+    def _load(self):
+        # type: () -> Optional[Session]
+        if not self.cache_path:
+            return None
+        try:
+            with open(self.cache_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if data.get('email') != self.email or data.get('base_url') != (self.base_url or BASE_URL):
+            return None
+        try:
+            return Session(data)
+        except SchemaError:
+            return None
+
+    def _save(self, session):
+        # type: (Session) -> None
+        if not self.cache_path:
+            return
+        directory = os.path.dirname(self.cache_path)
+        if directory:
+            try:
+                os.makedirs(directory, 0o700)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        data = {'email': self.email,
+                'base_url': self.base_url or BASE_URL,
+                'access_token': session['access_token'],
+                'uuid': unicode(session['uuid'])}
+        tmppath = '{0}.{1}.tmp'.format(self.cache_path, os.getpid())
+        fd = os.open(tmppath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.rename(tmppath, self.cache_path)
+
+
+class _MultipartBody(object):
+    """multipart/form-data のリクエストボディを少しずつ読み出すファイルライクオブジェクト
+
+    ``requests`` は ``len`` を持つファイルライクオブジェクトを
+    Content-Length 付きでストリーミング送信する。
+    HTTP/2 のトランスポート (httpx) にはイテレータとして渡す。
+    """
+
+    def __init__(self, fields, name, fileobj, progress=None):
+        # type: (Dict[str, str], str, BinaryIO, Optional[Callable[[int, int], None]]) -> None
+        self.boundary = uuid.uuid4().hex
+        self.content_type = 'multipart/form-data; boundary={0}'.format(self.boundary)
+        filename = os.path.basename(getattr(fileobj, 'name', None) or name)
+        if not isinstance(filename, unicode):
+            filename = filename.decode('utf-8')
+        file_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        head = []
+        for key, value in sorted(fields.items()):
+            head.append(u'--{0}\r\n'
+                        u'Content-Disposition: form-data; name="{1}"\r\n\r\n'
+                        u'{2}\r\n'.format(self.boundary, key, value))
+        head.append(u'--{0}\r\n'
+                    u'Content-Disposition: form-data; name="{1}"; filename="{2}"\r\n'
+                    u'Content-Type: {3}\r\n\r\n'.format(self.boundary, name, filename, file_type))
+        self._head = u''.join(head).encode('utf-8')
+        self._tail = u'\r\n--{0}--\r\n'.format(self.boundary).encode('utf-8')
+        self._file = fileobj
+        self._progress = progress
+        self.len = len(self._head) + _remaining_size(fileobj) + len(self._tail)
+        self._sent = 0
+        self._chunks = self._iter_chunks()
+        self._buffer = b''
+
+    def __len__(self):
+        return self.len
+
+    def _iter_chunks(self):
+        # type: () -> Iterator[bytes]
+        yield self._head
+        while True:
+            chunk = self._file.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+        yield self._tail
+
+    def __iter__(self):
+        # type: () -> Iterator[bytes]
+        while True:
+            data = self.read(UPLOAD_CHUNK_SIZE)
+            if not data:
+                break
+            yield data
+
+    def read(self, size=-1):
+        # type: (int) -> bytes
+        while size < 0 or len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        self._sent += len(data)
+        if data and self._progress is not None:
+            self._progress(self._sent, self.len)
+        return data
+
+
+def _remaining_size(fileobj):
+    # type: (BinaryIO) -> int
+    try:
+        return os.fstat(fileobj.fileno()).st_size - fileobj.tell()
+    except (AttributeError, IOError, OSError):
+        pass
+    position = fileobj.tell()
+    fileobj.seek(0, os.SEEK_END)
+    size = fileobj.tell() - position
+    fileobj.seek(position)
+    return size
+
+
+def _is_transient(error):
+    # type: (Exception) -> bool
+    """再試行すれば成功しうるエラーか (接続エラー、タイムアウト、408、429、5xx)"""
+    if not isinstance(error, requests.RequestException):
+        return False
+    response = getattr(error, 'response', None)
+    if not isinstance(error, requests.HTTPError) or response is None:
+        return True
+    return response.status_code in (408, 429) or 500 <= response.status_code
+
+
 class ApiError(IOError):
     """API エラー
 
@@ -0,0 +1,157 @@
+# encoding: utf-8
+"""複数の部屋の履歴を並行して取得するバックフィル
+
+ページの取得は I/O スレッドで、JSON のデコードとモデルの検証はプロセスプールで行うので、
+ネットワークと CPU の両方を使い切ることができます。
+次のページのカーソルは前のページから決まるため、同じ部屋のページは順に取得し、
+部屋をまたいで取得とデコードを重ねます。
+
+.. code-block:: python
+
+   backfill = bocco.backfill.Backfill(api, [r['uuid'] for r in api.get_rooms()],
+                                      io_workers=16, decode_workers=4)
+   for room_uuid, messages in backfill:
+       print(room_uuid, messages[0]['id'], len(messages))
+"""
+from __future__ import absolute_import
+import json
+import threading
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue  # type: ignore
+
+try:
+    from typing import Any, Dict, Iterator, List, Optional, Tuple
+except:
+    pass
+
+from .api import Client
+from .models import Message
+
+
+def _decode_page(content, older_than=None):
+    # type: (bytes, Optional[int]) -> List[Message]
+    """ページのレスポンスをデコード・検証し、新しい順の :class:`~bocco.models.Message` のリストにする
+
+    プロセスプールで実行されるため、モジュールレベルの関数にしている。
+    """
+    page = json.loads(content.decode('utf-8'))
+    if type(page) != list:
+        return []
+    if older_than is not None:
+        page = [m for m in page if m['id'] < older_than]
+    page.sort(key=lambda m: m['id'], reverse=True)
+    return [Message(m) for m in page]
+
+
+class _Done(object):
+
+    def __init__(self, room_uuid, error=None):
+        # type: (uuid.UUID, Optional[BaseException]) -> None
+        self.room_uuid = room_uuid
+        self.error = error
+
+
+class Backfill(object):
+    """複数の部屋のメッセージを新しい方から遡って取得する
+
+    イテレートすると ``(room_uuid, messages)`` をページごとに返します。
+    ``messages`` は新しい順に並んだ :class:`~bocco.models.Message` のリストです。
+    異なる部屋のページは取得できた順に混ざって返りますが、
+    同じ部屋のページは必ず新しいものから順に返ります。
+
+    :param client: 使用するクライアント
+    :param room_uuids: 対象の部屋
+    :param io_workers: 同時に取得する部屋の数 (= HTTP 接続数)
+    :param decode_workers: デコードと検証を行うプロセス数。0 なら I/O スレッドで行う。
+                           ``None`` なら CPU 数
+    :param max_pages: 部屋ごとに取得する最大ページ数。``None`` なら最後まで
+    :param max_pending_pages: 取り出されずに溜まっているページ数の上限。
+                              超えると取得を一時停止します
+    :param older_than: このメッセージ ID より古いものから取得する
+    """
+
+    def __init__(self,
+                 client,
+                 room_uuids,
+                 io_workers=8,
+                 decode_workers=None,
+                 max_pages=None,
+                 max_pending_pages=64,
+                 older_than=None):
+        # type: (Client, List[uuid.UUID], int, Optional[int], Optional[int], int, Optional[int]) -> None
+        self.client = client
+        self.room_uuids = list(room_uuids)
+        self.io_workers = io_workers
+        self.decode_workers = decode_workers
+        self.max_pages = max_pages
+        self.max_pending_pages = max_pending_pages
+        self.older_than = older_than
+
+    def __iter__(self):
+        # type: () -> Iterator[Tuple[uuid.UUID, List[Message]]]
+        client = self.client._with_pool_size(self.io_workers)
+        results = queue.Queue(self.max_pending_pages)  # type: queue.Queue
+        stop = threading.Event()
+        decoder = None
+        if self.decode_workers != 0:
+            decoder = ProcessPoolExecutor(max_workers=self.decode_workers)
+        fetcher = ThreadPoolExecutor(max_workers=self.io_workers)
+
+        def put(item):
+            # type: (Any) -> bool
+            while not stop.is_set():
+                try:
+                    results.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def fetch_room(room_uuid):
+            # type: (uuid.UUID) -> None
+            try:
+                older_than = self.older_than
+                pages = 0
+                while self.max_pages is None or pages < self.max_pages:
+                    if stop.is_set():
+                        return
+                    r = client._get_messages_response(room_uuid, older_than=older_than, read=False, check=True)
+                    if decoder is not None:
+                        messages = decoder.submit(_decode_page, r.content, older_than).result()
+                    else:
+                        messages = _decode_page(r.content, older_than)
+                    if not messages:
+                        break
+                    if not put((room_uuid, messages)):
+                        return
+                    pages += 1
+                    older_than = messages[-1]['id']
+                put(_Done(room_uuid))
+            except BaseException as e:
+                put(_Done(room_uuid, e))
+
+        for room_uuid in self.room_uuids:
+            fetcher.submit(fetch_room, room_uuid)
+
+        remaining = len(self.room_uuids)
+        try:
+            while 0 < remaining:
+                item = results.get()
+                if isinstance(item, _Done):
+                    remaining -= 1
+                    if item.error is not None:
+                        raise item.error
+                    continue
+                yield item
+        finally:
+            stop.set()
+            fetcher.shutdown(wait=True)
+            if decoder is not None:
+                decoder.shutdown(wait=True)
+            if client is not self.client:
+                client.http.close()
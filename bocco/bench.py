@@ -0,0 +1,244 @@
+# encoding: utf-8
+"""BOCCO API クライアントの負荷試験
+
+``bocco bench`` コマンドから使われます。
+:mod:`bocco.fake` のサーバと組み合わせると、手元で再現性のある計測ができます。
+"""
+from __future__ import absolute_import
+import os
+import random
+import threading
+import time
+import uuid
+
+try:
+    from typing import Any, Callable, Dict, List, Optional, Tuple
+except:
+    pass
+
+from .api import Client, ApiError
+
+
+#: 計測できる API 呼び出し
+OPERATIONS = ('get_rooms', 'get_messages', 'subscribe', 'post_text_message')
+
+#: 部屋にメッセージを書き込む API 呼び出し
+WRITE_OPERATIONS = frozenset(['post_text_message'])
+
+#: 既定の呼び出し比率 (読み込みのみ)
+DEFAULT_MIX = 'get_rooms=1,get_messages=4,subscribe=1'
+
+
+def parse_mix(text, allow_writes=False):
+    # type: (str, bool) -> Dict[str, float]
+    """``get_rooms=1,get_messages=4`` 形式の呼び出し比率を読む
+
+    書き込む呼び出し (:data:`WRITE_OPERATIONS`) は ``allow_writes`` が真の場合だけ使えます。
+
+    >>> sorted(parse_mix('get_rooms=1, get_messages=4').items())
+    [('get_messages', 4.0), ('get_rooms', 1.0)]
+    >>> parse_mix('get_rooms=1,post_text_message=1')
+    Traceback (most recent call last):
+      ...
+    ValueError: post_text_message writes to the rooms; allow writes to use it
+    """
+    mix = {}  # type: Dict[str, float]
+    for item in text.split(','):
+        name, _, weight = item.strip().partition('=')
+        if name not in OPERATIONS:
+            raise ValueError(u'Unknown operation: {0}'.format(name))
+        if name in WRITE_OPERATIONS and not allow_writes:
+            raise ValueError(u'{0} writes to the rooms; allow writes to use it'.format(name))
+        mix[name] = float(weight or 1)
+    if not any(0 < w for w in mix.values()):
+        raise ValueError(u'No operation has a positive weight')
+    return mix
+
+
+def percentile(values, p):
+    # type: (List[float], float) -> float
+    """ソート済みの ``values`` の ``p`` パーセンタイル (最近傍法)
+
+    >>> percentile([1.0, 2.0, 3.0, 4.0], 50)
+    2.0
+    >>> percentile([1.0, 2.0, 3.0, 4.0], 99)
+    4.0
+    """
+    if not values:
+        return 0.0
+    index = max(0, int(round(p / 100.0 * len(values) + 0.5)) - 1)
+    return values[min(index, len(values) - 1)]
+
+
+def _summarize(latencies):
+    # type: (List[float]) -> Dict[str, float]
+    latencies = sorted(latencies)
+    return {'count': len(latencies),
+            'p50': percentile(latencies, 50),
+            'p95': percentile(latencies, 95),
+            'p99': percentile(latencies, 99),
+            'max': latencies[-1] if latencies else 0.0}
+
+
+def _cpu_time():
+    # type: () -> float
+    times = os.times()
+    return times[0] + times[1]
+
+
+def run_benchmark(client, mix, room_uuids=None, concurrency=4, rate=None, duration=10.0, requests=None, seed=0):
+    # type: (Client, Dict[str, float], Optional[List[uuid.UUID]], int, Optional[float], float, Optional[int], int) -> Dict[str, Any]
+    """``mix`` の比率で API を呼び続け、結果を集計する
+
+    :param client: 計測に使うクライアント。``concurrency`` 本の接続を持つ専用のセッションで複製して使います
+    :param mix: :func:`parse_mix` の結果
+    :param room_uuids: 対象の部屋。省略時は :meth:`~bocco.api.Client.get_rooms` の全ての部屋
+    :param concurrency: 同時に実行する呼び出しの数
+    :param rate: 1 秒あたりの呼び出し数の上限。``None`` なら ``concurrency`` だけで制御する
+    :param duration: 計測する秒数
+    :param requests: 呼び出す回数。指定すると ``duration`` より優先されます
+    :param seed: 呼び出しを選ぶ乱数のシード
+
+    ``subscribe`` は各部屋の最新メッセージの直前の ID を ``newer_than`` に渡すので、
+    ロングポーリングで待たずにすぐ返ります。
+    レイテンシは秒で、``cpu_per_request`` はクライアントプロセスの CPU 時間 (秒) です。
+    """
+    shared = client
+    client = client._with_pool_size(concurrency)
+
+    rooms = client.get_rooms()
+    last_ids = {}  # type: Dict[uuid.UUID, int]
+    for room in rooms:
+        if room_uuids is None or room['uuid'] in room_uuids:
+            last_ids[room['uuid']] = max([m['id'] for m in room['messages']] or [1])
+    targets = list(last_ids.keys())
+    if not targets and any(mix.get(op) for op in OPERATIONS if op != 'get_rooms'):
+        raise ValueError(u'No rooms to benchmark')
+
+    calls = {
+        'get_rooms': lambda r: client.get_rooms(),
+        'get_messages': lambda r: client.get_messages(r),
+        'subscribe': lambda r: client.subscribe(r, newer_than=last_ids[r] - 1),
+        'post_text_message': lambda r: client.post_text_message(r, u'bocco bench'),
+    }  # type: Dict[str, Callable[[uuid.UUID], Any]]
+    names = [name for name in OPERATIONS if 0 < mix.get(name, 0)]
+    weights = [mix[name] for name in names]
+
+    status = threading.local()
+
+    def record_status(response, *args, **kwargs):
+        status.code = response.status_code
+
+    lock = threading.Lock()
+    latencies = dict((name, []) for name in names)  # type: Dict[str, List[float]]
+    errors = {}  # type: Dict[str, int]
+    state = {'issued': 0}
+    start = time.time()
+    deadline = start + duration
+
+    def next_slot():
+        # type: () -> Optional[float]
+        with lock:
+            index = state['issued']
+            if requests is not None and requests <= index:
+                return None
+            state['issued'] += 1
+        if rate:
+            return start + index / rate
+        return time.time()
+
+    def worker(worker_seed):
+        # type: (int) -> None
+        rnd = random.Random(worker_seed)
+        while True:
+            slot = next_slot()
+            if slot is None or (requests is None and deadline <= slot):
+                return
+            delay = slot - time.time()
+            if 0 < delay:
+                time.sleep(delay)
+            name = _choose(rnd, names, weights)
+            room_uuid = rnd.choice(targets) if targets else None
+            status.code = None
+            error = None
+            t = time.time()
+            try:
+                calls[name](room_uuid)
+            except ApiError as e:
+                error = u'ApiError {0}'.format(e.body['code'])
+            except Exception as e:
+                error = type(e).__name__
+            elapsed = time.time() - t
+            if error is None and status.code is not None and 400 <= status.code:
+                error = u'HTTP {0}'.format(status.code)
+            with lock:
+                if error is None:
+                    latencies[name].append(elapsed)
+                else:
+                    key = u'{0}: {1}'.format(name, error)
+                    errors[key] = errors.get(key, 0) + 1
+
+    client.http.hooks['response'].append(record_status)
+    try:
+        cpu = _cpu_time()
+        threads = [threading.Thread(target=worker, args=(seed + i,)) for i in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+        cpu = _cpu_time() - cpu
+    finally:
+        client.http.hooks['response'].remove(record_status)
+        if client is not shared:
+            client.http.close()
+
+    succeeded = sum(len(l) for l in latencies.values())
+    total = succeeded + sum(errors.values())
+    return {
+        'base_url': client.base_url,
+        'concurrency': concurrency,
+        'rate': rate,
+        'elapsed': elapsed,
+        'requests': total,
+        'errors': sum(errors.values()),
+        'throughput': succeeded / elapsed if elapsed else 0.0,
+        'cpu_per_request': cpu / total if total else 0.0,
+        'latency': _summarize([v for l in latencies.values() for v in l]),
+        'operations': dict((name, _summarize(l)) for name, l in latencies.items()),
+        'error_breakdown': errors,
+    }
+
+
+def _choose(rnd, names, weights):
+    # type: (random.Random, List[str], List[float]) -> str
+    x = rnd.uniform(0, sum(weights))
+    for name, weight in zip(names, weights):
+        x -= weight
+        if x <= 0:
+            return name
+    return names[-1]
+
+
+def format_result(result):
+    # type: (Dict[str, Any]) -> str
+    """:func:`run_benchmark` の結果を表形式のテキストにする"""
+    lines = [
+        u'Target:      {0[base_url]}'.format(result),
+        u'Requests:    {0[requests]} in {0[elapsed]:.2f}s ({0[errors]} errors)'.format(result),
+        u'Throughput:  {0[throughput]:.1f} req/s'.format(result),
+        u'CPU/request: {0:.2f} ms'.format(result['cpu_per_request'] * 1000),
+        u'',
+        u'{0:<20} {1:>7} {2:>9} {3:>9} {4:>9} {5:>9}'.format(
+            u'operation', u'count', u'p50(ms)', u'p95(ms)', u'p99(ms)', u'max(ms)'),
+    ]
+    rows = sorted(result['operations'].items()) + [(u'total', result['latency'])]
+    for name, s in rows:
+        lines.append(u'{0:<20} {1:>7} {2:>9.1f} {3:>9.1f} {4:>9.1f} {5:>9.1f}'.format(
+            name, s['count'], s['p50'] * 1000, s['p95'] * 1000, s['p99'] * 1000, s['max'] * 1000))
+    if result['error_breakdown']:
+        lines.append(u'')
+        lines.append(u'Errors:')
+        for key, count in sorted(result['error_breakdown'].items()):
+            lines.append(u'  {0}: {1}'.format(key, count))
+    return u'\n'.join(lines)
@@ -2,13 +2,30 @@
 from __future__ import absolute_import
 import os
 import sys
+import time
 import uuid
 import json
 
+try:
+    from typing import Any, List, Tuple
+except:
+    pass
+
 import click
+import requests
 
-from .api import Client, ApiError
-from .web import app
+from .api import Client, ApiError, SessionManager, SESSION_CACHE_PATH, TRANSPORTS
+from .web import app, serve
+from .fake import FakeServer
+from .bench import DEFAULT_MIX, parse_mix, run_benchmark, format_result
+from . import snapshot
+from .models import MessageMedia
+from .search import SearchIndex, SEARCH_INDEX_PATH
+from .export import FORMATS, export_room, guess_format
+from .mirror import mirror_room
+from .profiling import Profiler
+from .relay import OVERFLOW_POLICIES, Relay, WebhookSink, StreamSink, FileSink
+from . import daemon as _daemon
 from io import open
 
 
@@ -20,22 +37,68 @@ def main():
 @click.group()
 @click.option('--config', type=click.Path(exists=True), default='config.json')
 @click.option('--access-token')
+@click.option('--base-url', help=u'API の URL (例: bocco fake-server の URL)')
+@click.option('--transport', type=click.Choice(TRANSPORTS), help=u'HTTP のトランスポート (既定は http1)')
+@click.option('--profile', type=click.Path(dir_okay=False),
+              help=u'プロファイルを <PROFILE>.prof, .folded, .phases.json に保存')
 @click.pass_context
-def cli(ctx, config, access_token):
-    # type: (click.Context, str, str) -> None
+def cli(ctx, config, access_token, base_url, transport, profile):
+    # type: (click.Context, str, str, str, str, str) -> None
     """BOCCO API http://api-docs.bocco.me/ を CLI で操作するツール"""
+    if profile:
+        _start_profile(ctx, profile)
     debug = False
     downloads = None
+    config_json = {}
     if config:
         with open(config, 'r') as f:
             config_json = json.load(f)
             debug = config_json['debug']
             downloads = config_json['downloads']
-            access_token = config_json['access_token']
+            access_token = config_json.get('access_token', access_token)
+            base_url = base_url or config_json.get('base_url')
+            transport = transport or config_json.get('transport')
+    transport = transport or 'http1'
 
-    ctx.obj['api'] = Client(access_token)
+    # デーモン (bocco.daemon) から呼ばれた場合は、起動済みのクライアントを使い回す
+    client_class = ctx.obj.get('client_class', Client)
+    clients = ctx.obj.get('clients')
+    timeout = ctx.obj.get('api_timeout')
+    if 'email' in config_json:
+        key = ('session', config_json['email'], base_url, transport)  # type: tuple
+    else:
+        key = ('token', access_token, base_url, transport)
+    if clients is not None and key in clients:
+        ctx.obj['api'] = clients[key]
+    elif 'email' in config_json:
+        # アクセストークンの代わりにログイン情報を使い、セッションをキャッシュする
+        manager = SessionManager(config_json['api_key'],
+                                 config_json['email'],
+                                 config_json['password'],
+                                 config_json.get('session_cache', SESSION_CACHE_PATH),
+                                 base_url=base_url,
+                                 timeout=timeout)
+        ctx.obj['api'] = client_class.from_session_manager(manager, transport=transport, timeout=timeout)
+    else:
+        ctx.obj['api'] = client_class(access_token, base_url=base_url, transport=transport, timeout=timeout)
+    if clients is not None:
+        clients[key] = ctx.obj['api']
     ctx.obj['debug'] = debug
     ctx.obj['downloads'] = downloads
+    ctx.obj['search_index'] = config_json.get('search_index')
+
+
+def _start_profile(ctx, prefix):
+    # type: (click.Context, str) -> None
+    profiler = Profiler()
+    profiler.start()
+
+    def finish():
+        profiler.stop()
+        paths = profiler.save(prefix)
+        click.echo(profiler.summary(), err=True)  # type: ignore
+        click.echo(u'Profile saved: {0}'.format(u', '.join(paths)), err=True)  # type: ignore
+    ctx.call_on_close(finish)
 
 
 @cli.command()
@@ -78,19 +141,29 @@ def rooms(ctx, verbose):
 @click.option('-o', '--older_than', default=0, type=int)
 @click.option('-l', '--limit', default=10, type=int)
 @click.option('-v', '--verbose', is_flag=True)
+@click.option('-f', '--follow', is_flag=True, help=u'新しいメッセージが届くたびに表示し続ける')
 @click.pass_context
 def messages(ctx,
              room_uuid,
              newer_than,
              older_than,
              limit,
-             verbose):
-    # type: (click.Context, str, int, int, int, bool) -> None
+             verbose,
+             follow):
+    # type: (click.Context, str, int, int, int, bool, bool) -> None
     """指定した部屋のメッセージを表示"""
     api = ctx.obj['api']
-    messages = api.get_messages(uuid.UUID(room_uuid),
-                                newer_than=newer_than,
-                                older_than=older_than)
+    room_uuid = uuid.UUID(room_uuid)
+    if newer_than:
+        messages = api.get_messages(room_uuid,
+                                    newer_than=newer_than,
+                                    older_than=older_than)[-limit:]
+    else:
+        # 表示する分のページだけを取得する
+        try:
+            messages = api.get_recent_messages(room_uuid, limit, older_than=older_than or None)
+        except requests.HTTPError as e:
+            raise click.ClickException(u'Cannot get the messages: {0}'.format(e))
     template = u'{m[date]} {m[user][nickname]} {m[text]}'
     if verbose:
         template = u'''
@@ -101,8 +174,17 @@ def messages(ctx,
 \tmessage_type: {m[message_type]}
 \tdictated: {m[dictated]}
 '''.strip()
-    for m in messages[-limit:]:
+    for m in messages:
         click.echo(template.format(m=m))  # type: ignore
+    if follow:
+        cursor = max([m['id'] for m in messages] or [newer_than]) or None
+        try:
+            for m in api.follow_messages(room_uuid, newer_than=cursor):
+                click.echo(template.format(m=m))  # type: ignore
+        except KeyboardInterrupt:
+            pass
+        except requests.HTTPError as e:
+            raise click.ClickException(u'Cannot follow the room: {0}'.format(e))
 
 
 @cli.command()
@@ -118,15 +200,323 @@ def send(ctx, room_uuid, text):
 
 
 @cli.command()
+@click.argument('query', default='')
+@click.option('-r', '--room', 'room_uuids', multiple=True, help=u'対象の部屋 (複数指定可)。省略時は全ての部屋')
+@click.option('-s', '--sender', help=u'送信者の UUID またはニックネーム')
+@click.option('-m', '--media', type=click.Choice([m.value for m in MessageMedia]))
+@click.option('--since', help=u'この日時以降 (例: 2016-03-01)')
+@click.option('--until', help=u'この日時より前')
+@click.option('-l', '--limit', default=20, type=int)
+@click.option('--index', type=click.Path(), help=u'インデックスのファイル')
+@click.option('--no-update', is_flag=True, help=u'インデックスを更新せずに検索')
 @click.pass_context
-def web(ctx):
-    # type: (click.Context) -> None
+def search(ctx, query, room_uuids, sender, media, since, until, limit, index, no_update):
+    # type: (click.Context, str, Tuple[str, ...], str, str, str, str, int, str, bool) -> None
+    """メッセージを全文検索"""
+    api = ctx.obj['api']
+    index = SearchIndex(index or ctx.obj['search_index'] or SEARCH_INDEX_PATH)
+    rooms = [uuid.UUID(r) for r in room_uuids]
+    if not no_update:
+        for room_uuid in rooms or [r['uuid'] for r in api.get_rooms()]:
+            added = index.update(api, room_uuid)
+            if added:
+                click.echo(u'{0}: {1} messages indexed'.format(room_uuid, added), err=True)  # type: ignore
+    hits = []
+    for room_uuid in rooms or [None]:
+        hits.extend(index.search(query,
+                                 room_uuid=room_uuid,
+                                 sender=sender,
+                                 media=MessageMedia(media) if media else None,
+                                 since=since,
+                                 until=until,
+                                 limit=limit))
+    hits.sort(key=lambda h: h['id'], reverse=True)
+    for hit in hits[:limit]:
+        click.echo(u'{h[date]} {h[nickname]} {h[text]}\n\troom: {h[room_uuid]} id: {h[id]} media: {h[media].value}'.format(h=hit))  # type: ignore
+
+
+@cli.command()
+@click.argument('room_uuid')
+@click.argument('output', type=click.Path())
+@click.option('-f', '--format', 'fmt', type=click.Choice(FORMATS), help=u'出力形式 (省略時は拡張子から推測)')
+@click.option('-z', '--compression', help=u'gzip, bz2 (Parquet は snappy, zstd など)')
+@click.option('--resume', is_flag=True, help=u'中断したエクスポートを再開')
+@click.pass_context
+def export(ctx, room_uuid, output, fmt, compression, resume):
+    # type: (click.Context, str, str, str, str, bool) -> None
+    """部屋のメッセージ履歴をファイルに書き出す"""
+    api = ctx.obj['api']
+
+    def progress(count):
+        click.echo(u'\r{0} messages'.format(count), nl=False, err=True)  # type: ignore
+
+    try:
+        count = export_room(api,
+                            uuid.UUID(room_uuid),
+                            output,
+                            format=fmt,
+                            compression=compression,
+                            resume=resume,
+                            progress=progress)
+    except requests.RequestException as e:
+        if (fmt or guess_format(output)['format']) == 'parquet':
+            raise click.ClickException(u'Export interrupted: {0}'.format(e))
+        raise click.ClickException(u'Export interrupted: {0}\nRun again with --resume to continue'.format(e))
+    except ValueError as e:
+        raise click.ClickException(u'Cannot export: {0}'.format(e))
+    click.echo(u'\r{0} messages exported to {1}'.format(count, output), err=True)  # type: ignore
+
+
+@cli.command()
+@click.argument('room_uuid')
+@click.argument('directory', type=click.Path(file_okay=False))
+@click.option('-w', '--workers', default=8, type=int, help=u'同時にダウンロードする数')
+@click.option('--verify', is_flag=True, help=u'ダウンロード済みのファイルのハッシュも確認')
+@click.pass_context
+def mirror(ctx, room_uuid, directory, workers, verify):
+    # type: (click.Context, str, str, int, bool) -> None
+    """部屋の音声と画像を全てダウンロード"""
+    api = ctx.obj['api']
+
+    def progress(stats):
+        done = stats['downloaded'] + stats['skipped'] + len(stats['failed'])
+        click.echo(u'\r{0}/{1} files, {2:.1f} MB'.format(done, stats['files'], stats['bytes'] / 1e6),  # type: ignore
+                   nl=False, err=True)
+
+    try:
+        stats = mirror_room(api, uuid.UUID(room_uuid), directory,
+                            workers=workers, verify=verify, progress=progress)
+    except requests.RequestException as e:
+        raise click.ClickException(u'Cannot list the media in the room: {0}'.format(e))
+    click.echo(u'\r{0} downloaded ({1} duplicates), {2} skipped, {3} failed: '
+               u'{4:.1f} MB in {5:.1f}s ({6:.2f} MB/s)'.format(stats['downloaded'],  # type: ignore
+                                                              stats['duplicates'],
+                                                              stats['skipped'],
+                                                              len(stats['failed']),
+                                                              stats['bytes'] / 1e6,
+                                                              stats['seconds'],
+                                                              stats['bytes_per_second'] / 1e6), err=True)
+    for url, error in stats['failed']:
+        click.echo(u'{0}: {1}'.format(url, error), err=True)  # type: ignore
+    if stats['failed']:
+        sys.exit(1)
+
+
+@cli.command()
+@click.option('-r', '--room', 'room_uuids', multiple=True, help=u'対象の部屋 (複数指定可)。省略時は全ての部屋')
+@click.option('--webhook', 'webhooks', multiple=True, help=u'イベントを POST する URL (複数指定可)')
+@click.option('--file', 'files', multiple=True, type=click.Path(dir_okay=False), help=u'イベントを追記するファイル (複数指定可)')
+@click.option('--stdout', is_flag=True, help=u'イベントを標準出力に書く (転送先を指定しなければ既定)')
+@click.option('--queue-size', default=1000, type=int, help=u'転送先ごとの送信待ちイベント数の上限')
+@click.option('--batch-size', default=100, type=int, help=u'一度に送るイベント数の上限')
+@click.option('--batch-interval', default=1.0, type=float, help=u'イベントをまとめるために待つ秒数')
+@click.option('--concurrency', default=1, type=int, help=u'Webhook ごとに同時に送るバッチの数')
+@click.option('--overflow', default='drop_oldest', type=click.Choice(OVERFLOW_POLICIES),
+              help=u'送信待ちが一杯のときの動作')
+@click.option('--stats-interval', default=60.0, type=float, help=u'統計を表示する間隔 (秒)。0 なら表示しない')
+@click.pass_context
+def relay(ctx, room_uuids, webhooks, files, stdout, queue_size, batch_size, batch_interval,
+          concurrency, overflow, stats_interval):
+    # type: (click.Context, Tuple[str, ...], Tuple[str, ...], Tuple[str, ...], bool, int, int, float, int, str, float) -> None
+    """部屋のイベントを Webhook やファイルに転送"""
+    api = ctx.obj['api']
+    options = {'queue_size': queue_size,
+               'batch_size': batch_size,
+               'batch_interval': batch_interval,
+               'overflow': overflow}
+    sinks = [WebhookSink(url, concurrency=concurrency, **options) for url in webhooks]  # type: List[Any]
+    sinks += [FileSink(path, **options) for path in files]
+    if stdout or not sinks:
+        sinks.append(StreamSink(**options))
+    targets = [uuid.UUID(r) for r in room_uuids] or [r['uuid'] for r in api.get_rooms()]
+    relay = Relay(api, targets, sinks)
+    relay.start()
+    click.echo(u'Relaying {0} rooms to {1} sinks'.format(len(targets), len(sinks)), err=True)  # type: ignore
+    try:
+        while True:
+            time.sleep(stats_interval if 0 < stats_interval else 3600)
+            if 0 < stats_interval:
+                _echo_relay_stats(relay)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        relay.stop()
+        _echo_relay_stats(relay)
+
+
+def _echo_relay_stats(relay):
+    # type: (Relay) -> None
+    for name, stats in sorted(relay.stats().items()):
+        click.echo(u'{0}: {1[received]} received, {1[sent]} sent, {1[dropped]} dropped, '  # type: ignore
+                   u'{1[failed]} failed, {1[pending]} pending'.format(name, stats), err=True)
+    for room_uuid, error in relay.errors.items():
+        click.echo(u'{0}: {1}'.format(room_uuid, error), err=True)  # type: ignore
+
+
+@cli.command()
+@click.option('--host', default='127.0.0.1')
+@click.option('--port', default=5000, type=int)
+@click.option('--production', is_flag=True,
+              help=u'gunicorn のマルチプロセスサーバで起動')
+@click.option('--workers', default=2, type=int, help=u'ワーカープロセス数 (--production)')
+@click.option('--threads', default=4, type=int, help=u'ワーカーごとのスレッド数 (--production)')
+@click.option('--timeout', default=30, type=int,
+              help=u'この秒数以上応答しないワーカーを再起動する (--production、gunicorn の --timeout)')
+@click.option('--api-timeout', default=10.0, type=float, help=u'API へのリクエストのタイムアウト秒数')
+@click.option('--rooms-cache-ttl', default=5, type=int, help=u'部屋一覧をキャッシュする秒数')
+@click.option('--profile-requests', is_flag=True, help=u'各リクエストの内訳を Server-Timing ヘッダーで返す')
+@click.option('--profile-dir', type=click.Path(file_okay=False),
+              help=u'リクエストごとのプロファイルを保存するディレクトリ (--profile-requests を含む)')
+@click.pass_context
+def web(ctx, host, port, production, workers, threads, timeout, api_timeout, rooms_cache_ttl, profile_requests,
+        profile_dir):
+    # type: (click.Context, str, int, bool, int, int, int, float, int, bool, str) -> None
     """Web サーバ上で API クライアントを起動"""
     api = ctx.obj['api']
+    api.timeout = api_timeout
+    if api.session_manager is not None:
+        api.session_manager.timeout = api_timeout
     debug = ctx.obj['debug']
     downloads = ctx.obj['downloads']
 
-    app.config.update(dict(DEBUG=debug, DOWNLOADS=downloads))
+    app.config.update(dict(DEBUG=debug,
+                           DOWNLOADS=downloads,
+                           ROOMS_CACHE_TTL=rooms_cache_ttl,
+                           SEARCH_INDEX=ctx.obj['search_index'],
+                           PROFILE=profile_requests or bool(profile_dir),
+                           PROFILE_DIR=profile_dir))
     app.api = api
-    app.run()
+    if production:
+        serve(host=host, port=port, workers=workers, threads=threads, timeout=timeout)
+    else:
+        app.run(host=host, port=port)
+
+
+@cli.command('fake-server')
+@click.option('--host', default='127.0.0.1')
+@click.option('--port', default=8080, type=int)
+@click.option('--rooms', default=3, type=int, help=u'部屋の数')
+@click.option('--messages', default=1000, type=int, help=u'部屋ごとのメッセージ数')
+@click.option('--page-size', default=30, type=int, help=u'1 ページのメッセージ数')
+@click.option('--latency', default=0.0, type=float, help=u'レスポンスの遅延 (秒)')
+@click.option('--jitter', default=0.0, type=float, help=u'遅延の揺らぎ (秒)')
+@click.option('--bandwidth', default=None, type=int, help=u'帯域の上限 (バイト/秒)')
+@click.option('--error-rate', default=0.0, type=float, help=u'500 エラーを返す確率')
+@click.option('--long-poll-timeout', default=30.0, type=float, help=u'subscribe のタイムアウト (秒)')
+@click.option('--message-rate', default=0.0, type=float, help=u'部屋ごとの新着メッセージ頻度 (件/秒)')
+@click.option('--media-size', default=64 * 1024, type=int, help=u'メディアファイルのサイズ (バイト)')
+@click.option('--seed', default=0, type=int)
+def fake_server(host, port, rooms, messages, page_size, latency, jitter, bandwidth,
+                error_rate, long_poll_timeout, message_rate, media_size, seed):
+    # type: (str, int, int, int, int, float, float, int, float, float, float, int, int) -> None
+    """BOCCO API のフェイクサーバを起動"""
+    server = FakeServer(rooms=rooms,
+                        messages_per_room=messages,
+                        page_size=page_size,
+                        latency=latency,
+                        jitter=jitter,
+                        bandwidth=bandwidth,
+                        error_rate=error_rate,
+                        long_poll_timeout=long_poll_timeout,
+                        message_rate=message_rate,
+                        media_size=media_size,
+                        seed=seed)
+    click.echo(u'API URL: http://{0}:{1}'.format(host, port))  # type: ignore
+    server.run(host=host, port=port)
+
+
+@cli.command()
+@click.option('--mix', default=DEFAULT_MIX, help=u'呼び出しの比率 (例: get_rooms=1,get_messages=4)')
+@click.option('--allow-writes', is_flag=True, help=u'部屋に書き込む呼び出し (post_text_message) を --mix で使えるようにする')
+@click.option('-c', '--concurrency', default=4, type=int, help=u'同時実行数')
+@click.option('-r', '--rate', default=None, type=float, help=u'1 秒あたりの呼び出し数の上限')
+@click.option('-d', '--duration', default=10.0, type=float, help=u'計測する秒数')
+@click.option('-n', '--requests', default=None, type=int, help=u'呼び出す回数 (--duration より優先)')
+@click.option('--room', 'room_uuids', multiple=True, help=u'対象の部屋 (複数指定可)')
+@click.option('--json', 'as_json', is_flag=True, help=u'結果を JSON で出力')
+@click.option('-o', '--output', type=click.Path(), help=u'結果の JSON を保存するファイル')
+@click.pass_context
+def bench(ctx, mix, allow_writes, concurrency, rate, duration, requests, room_uuids, as_json, output):
+    # type: (click.Context, str, bool, int, float, float, int, Tuple[str, ...], bool, str) -> None
+    """API の負荷試験を実行 (既定では読み込みのみ)"""
+    api = ctx.obj['api']
+    try:
+        weights = parse_mix(mix, allow_writes)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='--mix')
+    result = run_benchmark(api,
+                           weights,
+                           room_uuids=[uuid.UUID(r) for r in room_uuids] or None,
+                           concurrency=concurrency,
+                           rate=rate,
+                           duration=duration,
+                           requests=requests)
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(result, indent=2, ensure_ascii=False))
+    if as_json:
+        click.echo(json.dumps(result, indent=2, ensure_ascii=False))  # type: ignore
+    else:
+        click.echo(format_result(result))  # type: ignore
+
+
+@cli.command('bench-snapshot')
+@click.option('-n', '--count', default=1000, type=int, help=u'メッセージ数')
+@click.option('--repeat', default=5, type=int, help=u'繰り返す回数 (最短時間を表示)')
+def bench_snapshot(count, repeat):
+    # type: (int, int) -> None
+    """メッセージの読み込み時間を JSON とスナップショットで比較"""
+    result = snapshot.benchmark(count=count, repeat=repeat)
+    click.echo(u'{0} messages: JSON {1} bytes, snapshot {2} bytes'.format(  # type: ignore
+        result['count'], result['json_bytes'], result['snapshot_bytes']))
+    for key, label in (('json_validate', u'JSON + validation'),
+                       ('to_dict_from_dict', u'JSON + from_dict(validate=False)'),
+                       ('snapshot_dumps', u'snapshot dumps'),
+                       ('snapshot_loads', u'snapshot loads')):
+        click.echo(u'  {0:<34} {1:8.2f} ms'.format(label, result[key] * 1000))  # type: ignore
+
+
+@cli.group('daemon')
+def daemon():
+    # type: () -> None
+    """コマンドを高速に実行する常駐プロセスを管理"""
+
+
+@daemon.command('start')
+@click.option('--socket', 'socket_path', default=_daemon.SOCKET_PATH, type=click.Path(), help=u'待ち受けるソケット')
+@click.option('--rooms-cache-ttl', default=5.0, type=float, help=u'部屋一覧をキャッシュする秒数')
+@click.option('--api-timeout', default=_daemon.API_TIMEOUT, type=float, help=u'API へのリクエストのタイムアウト秒数')
+@click.option('--foreground', is_flag=True, help=u'バックグラウンドに移らずに実行')
+def daemon_start(socket_path, rooms_cache_ttl, api_timeout, foreground):
+    # type: (str, float, float, bool) -> None
+    """デーモンを起動"""
+    if foreground:
+        click.echo(u'Listening on {0}'.format(socket_path))  # type: ignore
+        _daemon.serve(socket_path, rooms_cache_ttl, api_timeout=api_timeout)
+        return
+    pid = _daemon.start(socket_path, rooms_cache_ttl, api_timeout)
+    click.echo(u'Started (pid {0}): {1}'.format(pid, socket_path))  # type: ignore
+
+
+@daemon.command('stop')
+@click.option('--socket', 'socket_path', default=_daemon.SOCKET_PATH, type=click.Path())
+def daemon_stop(socket_path):
+    # type: (str) -> None
+    """デーモンを停止"""
+    if not _daemon.stop(socket_path):
+        click.echo(u'Not running: {0}'.format(socket_path), err=True)  # type: ignore
+        sys.exit(1)
+    click.echo(u'Stopped')  # type: ignore
+
 
+@daemon.command('status')
+@click.option('--socket', 'socket_path', default=_daemon.SOCKET_PATH, type=click.Path())
+def daemon_status(socket_path):
+    # type: (str) -> None
+    """デーモンが起動しているか表示"""
+    sock = _daemon._connect(socket_path)
+    if sock is None:
+        click.echo(u'Not running: {0}'.format(socket_path))  # type: ignore
+        sys.exit(1)
+    sock.close()
+    click.echo(u'Running: {0}'.format(socket_path))  # type: ignore
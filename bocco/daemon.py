@@ -0,0 +1,351 @@
+# encoding: utf-8
+"""CLI を高速に実行するための常駐プロセス
+
+``bocco daemon start`` で起動したデーモンは、API クライアントとコネクション、
+部屋一覧のキャッシュを保持したまま Unix ソケットで待ち受けます。
+デーモンが起動していれば ``bocco rooms`` などのコマンドはデーモンに転送され、
+Python の起動やライブラリの読み込み、接続の確立を省略できます。
+
+このモジュールはコマンドの転送を速くするため、標準ライブラリ以外を読み込みません。
+"""
+from __future__ import absolute_import
+import io
+import json
+import os
+import socket
+import sys
+import time
+
+try:
+    from typing import Any, Dict, List, Optional
+except:
+    pass
+
+
+#: デーモンのソケット (``BOCCO_DAEMON_SOCKET`` 環境変数で変更できる)
+SOCKET_PATH = os.environ.get('BOCCO_DAEMON_SOCKET') or \
+    os.path.join(os.path.expanduser('~'), '.bocco', 'daemon.sock')
+
+#: デーモンに転送するコマンド (長時間動くコマンドは転送しない)。
+#: ``search`` は最初にインデックスを作ると部屋全体を取得するので、``--no-update`` の場合だけ転送する
+FORWARDED_COMMANDS = frozenset(['rooms', 'messages', 'send', 'search'])
+
+#: デーモンの応答を待つ秒数。過ぎたらこのプロセスで実行する
+FORWARD_TIMEOUT = 30.0
+
+#: デーモンが API へ送るリクエストのタイムアウト秒数
+API_TIMEOUT = 10.0
+
+# 値を取るグローバルオプション
+_GLOBAL_OPTIONS_WITH_VALUE = frozenset(['--config', '--access-token', '--base-url', '--transport', '--profile'])
+
+# 値を取る messages のオプション
+_MESSAGES_OPTIONS_WITH_VALUE = frozenset(['-n', '--newer_than', '-o', '--older_than', '-l', '--limit'])
+
+
+def main(argv=None):
+    # type: (Optional[List[str]]) -> None
+    """``bocco`` コマンドのエントリポイント
+
+    デーモンが起動していれば転送し、そうでなければこのプロセスで実行する。
+    ``BOCCO_NO_DAEMON`` 環境変数を設定すると常にこのプロセスで実行する。
+    """
+    if argv is None:
+        argv = sys.argv[1:]
+    if not os.environ.get('BOCCO_NO_DAEMON') and _is_forwarded(argv):
+        code = forward(argv)
+        if code is not None:
+            sys.exit(code)
+    from .cli import cli
+    cli.main(args=argv, obj={}, prog_name='bocco')
+
+
+def _command_index(argv):
+    # type: (List[str]) -> Optional[int]
+    """``argv`` のサブコマンド名の位置"""
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        if arg.startswith('--') and '=' in arg:
+            # --config=path のように値を含む
+            i += 1
+        elif arg in _GLOBAL_OPTIONS_WITH_VALUE:
+            i += 2
+        elif arg.startswith('-'):
+            i += 1
+        else:
+            return i
+    return None
+
+
+def _command_name(argv):
+    # type: (List[str]) -> Optional[str]
+    """``argv`` からサブコマンド名を取り出す
+
+    >>> _command_name(['--config', 'c.json', 'rooms', '-v'])
+    'rooms'
+    >>> _command_name(['--base-url=http://localhost', 'messages', 'x'])
+    'messages'
+    >>> _command_name(['--config=rooms', 'send', 'x', 'hi'])
+    'send'
+    """
+    i = _command_index(argv)
+    return argv[i] if i is not None else None
+
+
+def _is_following(args):
+    # type: (List[str]) -> bool
+    """``messages`` の引数に ``-f``/``--follow`` があるか (``-vf`` のようにまとめた短いオプションも含む)
+
+    >>> _is_following(['x', '-vf'])
+    True
+    >>> _is_following(['x', '-l', '5', '-v'])
+    False
+    >>> _is_following(['x', '-l', '-f'])
+    False
+    """
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg == '--':
+            return False
+        if arg in _MESSAGES_OPTIONS_WITH_VALUE:
+            i += 2
+            continue
+        if arg == '--follow':
+            return True
+        if arg.startswith('-') and not arg.startswith('--'):
+            for c in arg[1:]:
+                if c == 'f':
+                    return True
+                if '-' + c in _MESSAGES_OPTIONS_WITH_VALUE:
+                    # 残りはオプションの値
+                    break
+        i += 1
+    return False
+
+
+def _is_forwarded(argv):
+    # type: (List[str]) -> bool
+    """デーモンに転送するコマンドか
+
+    ``messages --follow`` のように終わらないものと、``--profile`` を指定したもの
+    (このプロセスでの実行を計測する)、インデックスを更新する ``search`` は転送しない。
+
+    >>> _is_forwarded(['rooms'])
+    True
+    >>> _is_forwarded(['messages', 'x', '--follow'])
+    False
+    >>> _is_forwarded(['messages', 'x', '-vf'])
+    False
+    >>> _is_forwarded(['--profile=out/rooms', 'rooms'])
+    False
+    >>> _is_forwarded(['search', 'hello'])
+    False
+    >>> _is_forwarded(['search', '--no-update', 'hello'])
+    True
+    """
+    i = _command_index(argv)
+    if i is None or argv[i] not in FORWARDED_COMMANDS:
+        return False
+    if any(arg == '--profile' or arg.startswith('--profile=') for arg in argv[:i]):
+        return False
+    args = argv[i + 1:]
+    if argv[i] == 'search':
+        if '--' in args:
+            args = args[:args.index('--')]
+        return '--no-update' in args
+    return not (argv[i] == 'messages' and _is_following(args))
+
+
+def _connect(socket_path):
+    # type: (str) -> Optional[socket.socket]
+    if not os.path.exists(socket_path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except (IOError, OSError):
+        sock.close()
+        return None
+    return sock
+
+
+def _request(sock, request):
+    # type: (socket.socket, Dict[str, Any]) -> Dict[str, Any]
+    sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+    sock.shutdown(socket.SHUT_WR)
+    chunks = []
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    return json.loads(b''.join(chunks).decode('utf-8'))
+
+
+def forward(argv, socket_path=SOCKET_PATH, timeout=FORWARD_TIMEOUT):
+    # type: (List[str], str, Optional[float]) -> Optional[int]
+    """コマンドをデーモンで実行し、終了コードを返す
+
+    デーモンに接続できないか、``timeout`` 秒以内に応答がなければ ``None`` を返す。
+    """
+    sock = _connect(socket_path)
+    if sock is None:
+        return None
+    sock.settimeout(timeout)
+    try:
+        response = _request(sock, {'argv': argv, 'cwd': os.getcwd()})
+    except (IOError, OSError, ValueError):
+        return None
+    finally:
+        sock.close()
+    _write(sys.stdout, response['stdout'])
+    _write(sys.stderr, response['stderr'])
+    return response['code']
+
+
+def _write(stream, text):
+    # type: (Any, str) -> None
+    if not text:
+        return
+    if hasattr(stream, 'buffer'):
+        stream.buffer.write(text.encode('utf-8'))
+    else:
+        stream.write(text.encode('utf-8'))
+    stream.flush()
+
+
+def stop(socket_path=SOCKET_PATH):
+    # type: (str) -> bool
+    """デーモンを停止する。起動していなければ ``False`` を返す"""
+    sock = _connect(socket_path)
+    if sock is None:
+        return False
+    try:
+        _request(sock, {'shutdown': True})
+    finally:
+        sock.close()
+    return True
+
+
+def serve(socket_path=SOCKET_PATH, rooms_cache_ttl=5.0, client_timeout=5.0, api_timeout=API_TIMEOUT):
+    # type: (str, float, float, Optional[float]) -> None
+    """デーモンとして待ち受ける (停止するまで戻らない)
+
+    コマンドは 1 つずつ順番に実行される。
+    要求を送り終えない、または応答を受け取らない接続は ``client_timeout`` 秒で切断し、
+    API の呼び出しは ``api_timeout`` 秒で打ち切って、他のコマンドを待たせないようにする。
+    """
+    from .api import Client
+    from .cli import cli
+
+    class WarmClient(Client):
+        """部屋一覧を ``rooms_cache_ttl`` 秒キャッシュするクライアント"""
+
+        def __init__(self, *args, **kwargs):
+            super(WarmClient, self).__init__(*args, **kwargs)
+            self._rooms = None  # type: Any
+            self._rooms_expires = 0.0
+
+        def get_rooms(self):
+            if self._rooms is None or self._rooms_expires <= time.time():
+                self._rooms = super(WarmClient, self).get_rooms()
+                self._rooms_expires = time.time() + rooms_cache_ttl
+            return self._rooms
+
+    clients = {}  # type: Dict[tuple, Client]
+
+    directory = os.path.dirname(socket_path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory, 0o700)
+    if os.path.exists(socket_path):
+        if _connect(socket_path) is not None:
+            raise RuntimeError(u'Daemon is already running: {0}'.format(socket_path))
+        os.remove(socket_path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask(0o177)
+    try:
+        server.bind(socket_path)
+    finally:
+        os.umask(umask)
+    server.listen(16)
+
+    try:
+        while True:
+            conn, _ = server.accept()
+            conn.settimeout(client_timeout)
+            try:
+                request = _read_request(conn)
+                if request.get('shutdown'):
+                    conn.sendall(b'{}')
+                    return
+                response = _run(cli, request, {'clients': clients,
+                                               'client_class': WarmClient,
+                                               'api_timeout': api_timeout})
+                conn.sendall(json.dumps(response).encode('utf-8'))
+            except (IOError, OSError, ValueError):
+                pass
+            finally:
+                conn.close()
+    finally:
+        server.close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+def _read_request(conn):
+    # type: (socket.socket) -> Dict[str, Any]
+    chunks = []
+    while True:
+        chunk = conn.recv(65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        if chunk.endswith(b'\n'):
+            break
+    return json.loads(b''.join(chunks).decode('utf-8'))
+
+
+def _run(cli, request, obj):
+    # type: (Any, Dict[str, Any], Dict[str, Any]) -> Dict[str, Any]
+    """``cli`` を出力を捕まえながら実行する"""
+    stdout, stderr = io.StringIO(), io.StringIO()
+    saved = sys.stdout, sys.stderr, os.getcwd()
+    sys.stdout, sys.stderr = stdout, stderr
+    code = 0
+    try:
+        os.chdir(request['cwd'])
+        cli.main(args=request['argv'], obj=obj, prog_name='bocco')
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+        if not isinstance(e.code, (int, type(None))):
+            stderr.write(u'{0}\n'.format(e.code))
+    except Exception as e:
+        code = 1
+        stderr.write(u'Error: {0!r}\n'.format(e))
+    finally:
+        sys.stdout, sys.stderr = saved[0], saved[1]
+        os.chdir(saved[2])
+    return {'stdout': stdout.getvalue(), 'stderr': stderr.getvalue(), 'code': code}
+
+
+def start(socket_path=SOCKET_PATH, rooms_cache_ttl=5.0, api_timeout=API_TIMEOUT):
+    # type: (str, float, Optional[float]) -> int
+    """デーモンをバックグラウンドで起動し、プロセス ID を返す"""
+    pid = os.fork()
+    if pid:
+        # ソケットができるまで待つ
+        for _ in range(100):
+            if _connect(socket_path) is not None:
+                break
+            time.sleep(0.05)
+        return pid
+    os.setsid()
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(devnull, fd)
+    try:
+        serve(socket_path, rooms_cache_ttl, api_timeout=api_timeout)
+    finally:
+        os._exit(0)
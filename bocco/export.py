@@ -0,0 +1,353 @@
+# encoding: utf-8
+"""部屋のメッセージ履歴のエクスポート
+
+API から 1 ページずつ取得したメッセージを、そのままファイルに書き出します。
+モデルの検証を行わず、メモリに保持するのは常に 1 ページ (Parquet の場合は 1 行グループ) 分だけです。
+
+.. code-block:: python
+
+   bocco.export.export_room(api, room['uuid'], 'history.ndjson.gz')
+
+中断した場合は ``resume=True`` で続きから再開できます。
+再開位置は出力ファイルの隣の ``<出力ファイル>.checkpoint`` に保存されます。
+"""
+from __future__ import absolute_import
+import bz2
+import csv
+import gzip
+import io
+import json
+import os
+import sys
+import uuid
+
+try:
+    from typing import Any, Callable, Dict, Iterator, List, Optional
+except:
+    pass
+
+import arrow
+
+from .api import Client
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+if (3, 0) <= sys.version_info:
+    unicode = str
+
+
+#: 対応している出力形式
+FORMATS = ('ndjson', 'csv', 'parquet')
+
+#: CSV と Parquet の列
+COLUMNS = ('id', 'unique_id', 'date', 'media', 'message_type', 'sender',
+           'nickname', 'user_type', 'dictated', 'text', 'audio', 'image')
+
+_COMPRESSORS = {
+    'gzip': lambda f: gzip.GzipFile(fileobj=f, mode='wb'),
+    'bz2': lambda f: _Bz2Writer(f),
+}  # type: Dict[str, Callable[[Any], Any]]
+
+
+class _Bz2Writer(object):
+    """閉じても元のファイルを閉じない bz2 ストリーム"""
+
+    def __init__(self, fileobj):
+        self._file = fileobj
+        self._compressor = bz2.BZ2Compressor()
+
+    def write(self, data):
+        # type: (bytes) -> None
+        self._file.write(self._compressor.compress(data))
+
+    def close(self):
+        # type: () -> None
+        self._file.write(self._compressor.flush())
+
+
+def guess_format(path):
+    # type: (str) -> Dict[str, Optional[str]]
+    """ファイル名から出力形式と圧縮方式を推測する
+
+    >>> sorted(guess_format('history.csv.gz').items())
+    [('compression', 'gzip'), ('format', 'csv')]
+    >>> sorted(guess_format('history.parquet').items())
+    [('compression', None), ('format', 'parquet')]
+    """
+    name, ext = os.path.splitext(path)
+    compression = {'.gz': 'gzip', '.bz2': 'bz2'}.get(ext)
+    if compression:
+        name, ext = os.path.splitext(name)
+    fmt = {'.csv': 'csv', '.parquet': 'parquet'}.get(ext, 'ndjson')
+    return {'format': fmt, 'compression': compression}
+
+
+def _row(message):
+    # type: (Dict[str, Any]) -> List[Any]
+    user = message.get('user') or {}
+    return [message.get('id'),
+            message.get('unique_id'),
+            message.get('date'),
+            message.get('media'),
+            message.get('message_type'),
+            message.get('sender'),
+            user.get('nickname'),
+            user.get('user_type'),
+            message.get('dictated'),
+            message.get('text'),
+            message.get('audio'),
+            message.get('image')]
+
+
+class _SegmentedWriter(object):
+    """圧縮ストリームをチェックポイントごとに区切って書き出す
+
+    gzip と bz2 は複数のストリームを連結したファイルも正しく展開できるので、
+    チェックポイントで 1 つのストリームを閉じておけば、その位置で切り詰めて追記を再開できる。
+    """
+
+    def __init__(self, path, compression, offset=None):
+        # type: (str, Optional[str], Optional[int]) -> None
+        if offset is None:
+            self._file = io.open(path, 'wb')
+        else:
+            self._file = io.open(path, 'r+b')
+            self._file.truncate(offset)
+            self._file.seek(offset)
+        self._compression = compression
+        self._stream = None  # type: Any
+
+    def write(self, data):
+        # type: (bytes) -> None
+        if self._compression is None:
+            self._file.write(data)
+            return
+        if self._stream is None:
+            self._stream = _COMPRESSORS[self._compression](self._file)
+        self._stream.write(data)
+
+    def commit(self):
+        # type: () -> int
+        """ここまでの内容をディスクに書き、ファイルの位置を返す"""
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        return self._file.tell()
+
+    def close(self):
+        # type: () -> None
+        self.commit()
+        self._file.close()
+
+
+class _TextExporter(object):
+
+    def __init__(self, path, fmt, compression, offset, header):
+        # type: (str, str, Optional[str], Optional[int], bool) -> None
+        self._writer = _SegmentedWriter(path, compression, offset)
+        self._format = fmt
+        if fmt == 'csv' and header:
+            self._writer.write(self._csv([list(COLUMNS)]))
+
+    def _csv(self, rows):
+        # type: (List[List[Any]]) -> bytes
+        buf = io.StringIO() if (3, 0) <= sys.version_info else io.BytesIO()
+        csv.writer(buf).writerows(rows)
+        data = buf.getvalue()
+        return data.encode('utf-8') if isinstance(data, unicode) else data
+
+    def write(self, page):
+        # type: (List[Dict[str, Any]]) -> None
+        if self._format == 'csv':
+            self._writer.write(self._csv([_row(m) for m in page]))
+        else:
+            lines = [json.dumps(m, ensure_ascii=False, separators=(',', ':')) for m in page]
+            self._writer.write((u'\n'.join(lines) + u'\n').encode('utf-8'))
+
+    def commit(self):
+        # type: () -> int
+        return self._writer.commit()
+
+    def close(self):
+        # type: () -> None
+        self._writer.close()
+
+
+class _ParquetExporter(object):
+
+    def __init__(self, path, compression, row_group_size):
+        # type: (str, Optional[str], int) -> None
+        if pyarrow is None:
+            raise RuntimeError(u'pyarrow is required for Parquet export: pip install bocco[parquet]')
+        self._schema = pyarrow.schema([
+            ('id', pyarrow.int64()),
+            ('unique_id', pyarrow.string()),
+            ('date', pyarrow.timestamp('us', tz='UTC')),
+            ('media', pyarrow.string()),
+            ('message_type', pyarrow.string()),
+            ('sender', pyarrow.string()),
+            ('nickname', pyarrow.string()),
+            ('user_type', pyarrow.string()),
+            ('dictated', pyarrow.bool_()),
+            ('text', pyarrow.string()),
+            ('audio', pyarrow.string()),
+            ('image', pyarrow.string()),
+        ])
+        self._writer = pyarrow.parquet.ParquetWriter(path, self._schema,
+                                                     compression=compression or 'none')
+        self._row_group_size = row_group_size
+        self._rows = []  # type: List[List[Any]]
+
+    def write(self, page):
+        # type: (List[Dict[str, Any]]) -> None
+        for message in page:
+            row = _row(message)
+            row[2] = arrow.get(row[2]).to('UTC').datetime if row[2] else None
+            self._rows.append(row)
+        if self._row_group_size <= len(self._rows):
+            self._flush()
+
+    def _flush(self):
+        # type: () -> None
+        if not self._rows:
+            return
+        columns = list(zip(*self._rows))
+        table = pyarrow.Table.from_arrays(
+            [pyarrow.array(c, type=f.type) for c, f in zip(columns, self._schema)],
+            schema=self._schema)
+        self._writer.write_table(table)
+        self._rows = []
+
+    def commit(self):
+        # type: () -> int
+        return 0
+
+    def close(self):
+        # type: () -> None
+        self._flush()
+        self._writer.close()
+
+
+def export_room(client,
+                room_uuid,
+                path,
+                format=None,
+                compression=None,
+                resume=False,
+                checkpoint_pages=10,
+                row_group_size=10000,
+                progress=None):
+    # type: (Client, uuid.UUID, str, Optional[str], Optional[str], bool, int, int, Optional[Callable[[int], None]]) -> int
+    """部屋のメッセージを新しい順に全てファイルに書き出す
+
+    :param format: ``ndjson`` (API の JSON そのまま)、``csv`` または ``parquet``。
+                   省略時はファイル名から推測します
+    :param compression: ndjson と csv は ``gzip`` か ``bz2``。
+                        parquet は ``snappy`` や ``zstd`` など pyarrow が対応する方式。
+                        省略時はファイル名から推測します
+    :param resume: チェックポイントがあれば続きから書き出す (ndjson と csv のみ)
+    :param checkpoint_pages: チェックポイントを保存する間隔 (ページ数)
+    :param row_group_size: Parquet の行グループの行数
+    :param progress: ページを書くたびに、それまでに書いたメッセージ数で呼ばれる
+    :return: 書き出したメッセージの数 (再開前の分を含む)
+    :raises requests.HTTPError: API がエラーを返した場合。ndjson と csv ではチェックポイントが残り、
+                                parquet では書きかけのファイルを削除します
+    """
+    guessed = guess_format(path)
+    fmt = format or guessed['format']
+    if fmt not in FORMATS:
+        raise ValueError(u'Unknown format: {0}'.format(fmt))
+    if compression is None and fmt != 'parquet':
+        compression = guessed['compression']
+    if fmt != 'parquet' and compression not in (None, 'gzip', 'bz2'):
+        raise ValueError(u'Unknown compression: {0}'.format(compression))
+
+    checkpoint_path = path + '.checkpoint'
+    checkpoint = None  # type: Optional[Dict[str, Any]]
+    if resume:
+        if fmt == 'parquet':
+            raise ValueError(u'Parquet export cannot be resumed')
+        checkpoint = _load_checkpoint(checkpoint_path, room_uuid, fmt, compression)
+    elif os.path.exists(checkpoint_path):
+        # 最初から書き出すので、以前のチェックポイントは使えない
+        os.remove(checkpoint_path)
+
+    if fmt == 'parquet':
+        exporter = _ParquetExporter(path, compression, row_group_size)  # type: Any
+    elif checkpoint is not None:
+        exporter = _TextExporter(path, fmt, compression, checkpoint['offset'], header=False)
+    else:
+        exporter = _TextExporter(path, fmt, compression, None, header=True)
+
+    count = checkpoint['count'] if checkpoint else 0
+    older_than = checkpoint['older_than'] if checkpoint else None
+    pages = 0
+    saved = True
+    writing = False
+    failed = False
+
+    def save():
+        # type: () -> None
+        _save_checkpoint(checkpoint_path, {'room_uuid': unicode(room_uuid),
+                                           'format': fmt,
+                                           'compression': compression,
+                                           'older_than': older_than,
+                                           'count': count,
+                                           'offset': exporter.commit()})
+
+    try:
+        for page in client._iter_messages_data(room_uuid, older_than=older_than):
+            writing = True
+            exporter.write(page)
+            writing = False
+            count += len(page)
+            older_than = page[-1]['id']
+            pages += 1
+            saved = False
+            if fmt != 'parquet' and pages % checkpoint_pages == 0:
+                save()
+                saved = True
+            if progress is not None:
+                progress(count)
+    except Exception:
+        failed = True
+        # 書き終えたページまでのチェックポイントを残し、resume で続きから書き出せるようにする
+        if fmt != 'parquet' and not saved and not writing:
+            save()
+        raise
+    finally:
+        exporter.close()
+        # Parquet は閉じるとフッタが書かれ、途中までのファイルが完全なものに見えてしまう
+        if failed and fmt == 'parquet' and os.path.exists(path):
+            os.remove(path)
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    return count
+
+
+def _load_checkpoint(path, room_uuid, fmt, compression):
+    # type: (str, uuid.UUID, str, Optional[str]) -> Optional[Dict[str, Any]]
+    try:
+        with io.open(path, 'r', encoding='utf-8') as f:
+            checkpoint = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if (checkpoint.get('room_uuid') != unicode(room_uuid) or
+            checkpoint.get('format') != fmt or
+            checkpoint.get('compression') != compression):
+        raise ValueError(u'Checkpoint {0} belongs to another export'.format(path))
+    return checkpoint
+
+
+def _save_checkpoint(path, checkpoint):
+    # type: (str, Dict[str, Any]) -> None
+    tmppath = path + '.tmp'
+    with io.open(tmppath, 'w', encoding='utf-8') as f:
+        f.write(unicode(json.dumps(checkpoint)))
+    os.rename(tmppath, path)
@@ -0,0 +1,333 @@
+# encoding: utf-8
+"""BOCCO API の代わりに使えるローカルサーバ
+
+:class:`bocco.api.Client` が使うエンドポイントを、生成した部屋とメッセージで再現します。
+遅延・帯域・エラー率・ロングポーリングの挙動を設定できるので、
+実際の api.bocco.me を使わずに負荷試験やベンチマークを行えます。
+
+.. code-block:: python
+
+   server = bocco.fake.FakeServer(rooms=3, messages_per_room=1000, latency=0.05)
+   server.run(port=8080)
+
+   # 別のプロセスから
+   api = bocco.api.Client('any token', base_url='http://127.0.0.1:8080')
+"""
+from __future__ import absolute_import
+import bisect
+import random
+import sys
+import threading
+import time
+import uuid
+
+try:
+    from typing import Any, Dict, Iterator, List, Optional
+except:
+    pass
+
+import arrow
+from flask import Flask, Response, jsonify, request
+
+if (3, 0) <= sys.version_info:
+    unicode = str
+
+
+_TEXTS = [u'ただいま', u'おかえり', u'今から帰ります', u'ごはんできたよ',
+          u'了解', u'いってきます', u'おやすみ', u'hello', u'BOCCO テスト']
+
+
+class _Room(object):
+
+    def __init__(self, room_uuid, name, members):
+        # type: (uuid.UUID, str, List[Dict[str, Any]]) -> None
+        self.uuid = room_uuid
+        self.name = name
+        self.members = members
+        self.ids = []  # type: List[int]
+        self.messages = []  # type: List[Dict[str, Any]]
+        self.updated_at = arrow.utcnow()
+
+
+class FakeServer(object):
+    """BOCCO API のフェイクサーバ
+
+    :param rooms: 部屋の数
+    :param messages_per_room: 部屋ごとに最初から存在するメッセージの数
+    :param page_size: ``GET /rooms/<id>/messages`` が一度に返すメッセージの最大数
+    :param latency: 全てのレスポンスに加える遅延 (秒)
+    :param jitter: 遅延に加えるランダムな揺らぎの最大値 (秒)
+    :param bandwidth: レスポンスを送る速度の上限 (バイト/秒)。``None`` なら無制限
+    :param error_rate: 500 エラーを返す確率 (0〜1)
+    :param long_poll_timeout: ``subscribe`` が新着メッセージを待つ最大時間 (秒)
+    :param message_rate: 各部屋に新しいメッセージが届く頻度 (件/秒)。0 なら届かない
+    :param media_size: 音声・画像ファイルのサイズ (バイト)
+    :param access_tokens: 受け付けるアクセストークン。``None`` なら全て受け付ける
+    :param seed: データ生成に使う乱数のシード
+    """
+
+    def __init__(self,
+                 rooms=3,
+                 messages_per_room=1000,
+                 page_size=30,
+                 latency=0.0,
+                 jitter=0.0,
+                 bandwidth=None,
+                 error_rate=0.0,
+                 long_poll_timeout=30.0,
+                 message_rate=0.0,
+                 media_size=64 * 1024,
+                 access_tokens=None,
+                 seed=0):
+        # type: (int, int, int, float, float, Optional[int], float, float, float, int, Optional[List[str]], int) -> None
+        self.page_size = page_size
+        self.latency = latency
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.long_poll_timeout = long_poll_timeout
+        self.message_rate = message_rate
+        self.media_size = media_size
+        self.access_tokens = set(access_tokens) if access_tokens is not None else None
+        self._random = random.Random(seed)
+        self._condition = threading.Condition()
+        self._last_id = 0
+        self._rooms = {}  # type: Dict[uuid.UUID, _Room]
+        for i in range(rooms):
+            room = _Room(self._uuid(), u'Room {0}'.format(i + 1), self._members())
+            self._rooms[room.uuid] = room
+            start = arrow.utcnow().shift(seconds=-60 * messages_per_room)
+            for j in range(messages_per_room):
+                self._add_message(room, date=start.shift(seconds=60 * j))
+        self.app = self._create_app()
+
+    def _uuid(self):
+        # type: () -> uuid.UUID
+        return uuid.UUID(int=self._random.getrandbits(128), version=4)
+
+    def _members(self):
+        # type: () -> List[Dict[str, Any]]
+        users = [{'uuid': unicode(self._uuid()),
+                  'user_type': u'bocco',
+                  'nickname': u'BOCCO',
+                  'seller': u'',
+                  'address': u'00:11:22:33:44:55'}]
+        for i in range(self._random.randint(1, 4)):
+            users.append({'uuid': unicode(self._uuid()),
+                          'user_type': u'human',
+                          'nickname': u'User {0}'.format(i + 1),
+                          'seller': u''})
+        for user in users:
+            # URL はリクエストされたホストから組み立てる
+            user['icon'] = u'/users/{0}/icon.png'.format(user['uuid'])
+        return [{'read_id': 0, 'joined_at': u'2016-01-01T00:00:00+00:00', 'user': user}
+                for user in users]
+
+    def _add_message(self, room, text=None, media=None, sender=None, date=None):
+        # type: (_Room, Optional[str], Optional[str], Optional[Dict[str, Any]], Optional[arrow.Arrow]) -> Dict[str, Any]
+        with self._condition:
+            if media is None:
+                media = self._random.choice([u'text'] * 8 + [u'audio', u'image'])
+            if text is None:
+                text = self._random.choice(_TEXTS) if media == u'text' else u''
+            if sender is None:
+                sender = self._random.choice(room.members)['user']
+            self._last_id += 1
+            unique_id = unicode(self._uuid())
+            date = date or arrow.utcnow()
+            message = {
+                'id': self._last_id,
+                'unique_id': unique_id,
+                'date': date.isoformat(),
+                'media': media,
+                'message_type': u'normal',
+                'user': sender,
+                'sender': sender['uuid'],
+                'dictated': False,
+                'text': text,
+                # URL はリクエストされたホストから組み立てる
+                'audio': u'/messages/{0}.m4a'.format(unique_id) if media == u'audio' else u'',
+                'image': u'/messages/{0}.jpg'.format(unique_id) if media == u'image' else u'',
+            }
+            room.ids.append(message['id'])
+            room.messages.append(message)
+            room.updated_at = date
+            self._condition.notify_all()
+            return message
+
+    def post_message(self, room_uuid, text):
+        # type: (uuid.UUID, str) -> Dict[str, Any]
+        """サーバ側から部屋にメッセージを追加する"""
+        room = self._rooms[room_uuid]
+        return self._add_message(room, text=text, media=u'text')
+
+    @property
+    def room_uuids(self):
+        # type: () -> List[uuid.UUID]
+        return list(self._rooms.keys())
+
+    def _user_json(self, user):
+        # type: (Dict[str, Any]) -> Dict[str, Any]
+        return dict(user, icon=request.url_root.rstrip('/') + user['icon'])
+
+    def _message_json(self, message):
+        # type: (Dict[str, Any]) -> Dict[str, Any]
+        data = dict(message)
+        root = request.url_root.rstrip('/')
+        for key in ('audio', 'image'):
+            if data[key]:
+                data[key] = root + data[key]
+        data['user'] = self._user_json(data['user'])
+        return data
+
+    def _room_json(self, room):
+        # type: (_Room) -> Dict[str, Any]
+        return {'uuid': unicode(room.uuid),
+                'name': room.name,
+                'updated_at': room.updated_at.isoformat(),
+                'members': [dict(m, user=self._user_json(m['user'])) for m in room.members],
+                'sensors': [],
+                'messages': [self._message_json(m) for m in room.messages[-1:]]}
+
+    def _messages_page(self, room, newer_than, older_than):
+        # type: (_Room, Optional[int], Optional[int]) -> List[Dict[str, Any]]
+        if newer_than:
+            start = bisect.bisect_right(room.ids, newer_than)
+            return room.messages[start:start + self.page_size]
+        end = len(room.ids)
+        if older_than:
+            end = bisect.bisect_left(room.ids, older_than)
+        return room.messages[max(0, end - self.page_size):end]
+
+    def _media_data(self, name):
+        # type: (str) -> bytes
+        """``name`` から決まる ``media_size`` バイトのダミーのデータ"""
+        seed = sum(bytearray(name.encode('utf-8')))
+        chunk = bytes(bytearray((seed + i) % 256 for i in range(256)))
+        return chunk * (self.media_size // 256) + chunk[:self.media_size % 256]
+
+    def _throttle(self, data):
+        # type: (bytes) -> Iterator[bytes]
+        chunk_size = max(1, self.bandwidth // 10)  # type: ignore
+        for i in range(0, len(data), chunk_size):
+            chunk = data[i:i + chunk_size]
+            time.sleep(float(len(chunk)) / self.bandwidth)  # type: ignore
+            yield chunk
+
+    def _generate_messages(self):
+        # type: () -> None
+        rooms = list(self._rooms.values())
+        while True:
+            time.sleep(self._random.expovariate(self.message_rate * len(rooms)))
+            self._add_message(self._random.choice(rooms))
+
+    def _create_app(self):
+        # type: () -> Flask
+        app = Flask(__name__)
+
+        def error(code, message):
+            response = jsonify({'code': code, 'message': message})
+            response.status_code = code
+            return response
+
+        def room_or_404(room_id):
+            try:
+                return self._rooms[uuid.UUID(room_id)]
+            except (ValueError, KeyError):
+                return None
+
+        @app.before_request
+        def inject_faults():
+            delay = self.latency + self._random.uniform(0, self.jitter)
+            if 0 < delay:
+                time.sleep(delay)
+            if self._random.random() < self.error_rate:
+                return error(500, u'Injected error')
+            if request.path == '/sessions':
+                return None
+            access_token = request.values.get('access_token')
+            if not access_token or (self.access_tokens is not None and
+                                    access_token not in self.access_tokens):
+                return error(401, u'Invalid access token')
+            return None
+
+        @app.after_request
+        def limit_bandwidth(response):
+            if self.bandwidth and not response.direct_passthrough:
+                data = response.get_data()
+                response.response = self._throttle(data)
+                response.headers['Content-Length'] = str(len(data))
+            return response
+
+        @app.route('/sessions', methods=['POST'])
+        def sessions():
+            if not (request.form.get('apikey') and
+                    request.form.get('email') and
+                    request.form.get('password')):
+                return error(401, u'Invalid credentials')
+            access_token = uuid.uuid4().hex
+            if self.access_tokens is not None:
+                self.access_tokens.add(access_token)
+            return jsonify({'access_token': access_token, 'uuid': unicode(uuid.uuid4())})
+
+        @app.route('/rooms/joined')
+        def rooms_joined():
+            with self._condition:
+                return jsonify([self._room_json(r) for r in self._rooms.values()])
+
+        @app.route('/rooms/<room_id>/messages', methods=['GET'])
+        def get_messages(room_id):
+            room = room_or_404(room_id)
+            if room is None:
+                return error(404, u'Room not found')
+            with self._condition:
+                page = self._messages_page(room,
+                                           request.args.get('newer_than', type=int),
+                                           request.args.get('older_than', type=int))
+                return jsonify([self._message_json(m) for m in page])
+
+        @app.route('/rooms/<room_id>/messages', methods=['POST'])
+        def post_message(room_id):
+            room = room_or_404(room_id)
+            if room is None:
+                return error(404, u'Room not found')
+            media = request.form.get('media', u'text')
+            sender = room.members[-1]['user']
+            message = self._add_message(room, text=request.form.get('text', u''), media=media, sender=sender)
+            return jsonify(self._message_json(message))
+
+        @app.route('/rooms/<room_id>/subscribe')
+        def subscribe(room_id):
+            room = room_or_404(room_id)
+            if room is None:
+                return error(404, u'Room not found')
+            newer_than = request.args.get('newer_than', type=int) or (room.ids[-1] if room.ids else 0)
+            deadline = time.time() + self.long_poll_timeout
+            with self._condition:
+                while not room.ids or room.ids[-1] <= newer_than:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return jsonify([])
+                    self._condition.wait(remaining)
+                page = self._messages_page(room, newer_than, None)
+                return jsonify([{'event': u'message', 'body': self._message_json(m)} for m in page])
+
+        @app.route('/messages/<name>')
+        def media(name):
+            mimetype = 'image/jpeg' if name.endswith('.jpg') else 'audio/mp4'
+            return Response(self._media_data(name), mimetype=mimetype)
+
+        @app.route('/users/<user_id>/<name>')
+        def icon(user_id, name):
+            return Response(self._media_data(user_id + name), mimetype='image/png')
+
+        return app
+
+    def run(self, host='127.0.0.1', port=8080):
+        # type: (str, int) -> None
+        """サーバを起動する (終了するまで戻らない)"""
+        if 0 < self.message_rate:
+            thread = threading.Thread(target=self._generate_messages)
+            thread.daemon = True
+            thread.start()
+        self.app.run(host=host, port=port, threaded=True)
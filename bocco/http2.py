@@ -0,0 +1,162 @@
+# encoding: utf-8
+"""HTTP/2 のトランスポート
+
+:class:`Http2Session` は :class:`~bocco.api.Client` が使う :class:`requests.Session` の
+メソッドを `httpx <https://www.python-httpx.org/>`_ で実装したものです。
+HTTP/2 では 1 つの接続で複数のリクエストを同時に送れるので、
+多くの部屋を ``subscribe`` しながら他の API を呼んでも、接続数はほとんど増えません。
+
+``pip install bocco[http2]`` でインストールし、``transport='http2'`` を指定して使います。
+
+.. code-block:: python
+
+   api = bocco.api.Client('ACCESS TOKEN', transport='http2')
+"""
+from __future__ import absolute_import
+
+try:
+    from typing import Any, Callable, Dict, Iterator, List, Optional
+except:
+    pass
+
+import requests
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+
+class Http2Response(object):
+    """:class:`httpx.Response` を :class:`requests.Response` と同じように扱うラッパー"""
+
+    def __init__(self, response, stream=False):
+        # type: (Any, bool) -> None
+        self._response = response
+        self._stream = stream
+        self.status_code = response.status_code  # type: int
+        self.headers = response.headers
+        self.url = str(response.url)
+        self.http_version = response.http_version  # type: str
+
+    @property
+    def content(self):
+        # type: () -> bytes
+        if self._stream:
+            self._response.read()
+            self._response.close()
+            self._stream = False
+        return self._response.content
+
+    @property
+    def text(self):
+        # type: () -> str
+        self.content
+        return self._response.text
+
+    def json(self, **kwargs):
+        # type: (**Any) -> Any
+        self.content
+        return self._response.json(**kwargs)
+
+    def iter_content(self, chunk_size=1, decode_unicode=False):
+        # type: (int, bool) -> Iterator[bytes]
+        if not self._stream:
+            content = self._response.content
+            for i in range(0, len(content), chunk_size):
+                yield content[i:i + chunk_size]
+            return
+        try:
+            for chunk in self._response.iter_bytes(chunk_size):
+                yield chunk
+        finally:
+            self.close()
+
+    def raise_for_status(self):
+        # type: () -> None
+        if 400 <= self.status_code:
+            raise requests.HTTPError(u'{0} Error for url: {1}'.format(self.status_code, self.url),
+                                     response=self)  # type: ignore
+
+    def close(self):
+        # type: () -> None
+        self._stream = False
+        self._response.close()
+
+
+class Http2Session(object):
+    """HTTP/2 で通信する :class:`requests.Session` 互換のセッション
+
+    :class:`~bocco.api.Client` が使うメソッドだけを実装しています。
+    スレッド間で共有でき、同じホストへのリクエストは少数の接続に多重化されます。
+
+    :param max_connections: 接続数の上限。HTTP/2 に対応していないサーバでは同時リクエスト数の上限になります
+    """
+
+    def __init__(self, max_connections=10):
+        # type: (int) -> None
+        if httpx is None:
+            raise RuntimeError(u'httpx is required for HTTP/2: pip install bocco[http2]')
+        # requests と同じく、既定ではタイムアウトしない (subscribe のロングポーリングのため)
+        self._client = httpx.Client(http2=True,
+                                    timeout=None,
+                                    limits=httpx.Limits(max_connections=max_connections))
+        #: :attr:`requests.Session.hooks` と同じく、``'response'`` のフックはレスポンスを受け取るたびに呼ばれる
+        self.hooks = {'response': []}  # type: Dict[str, List[Callable[..., Any]]]
+
+    @property
+    def cookies(self):
+        # type: () -> Any
+        """Cookie を保存する :class:`cookielib.CookieJar`"""
+        return self._client.cookies.jar
+
+    def mount(self, prefix, adapter):
+        # type: (str, Any) -> None
+        """何もしない
+
+        :class:`requests.adapters.HTTPAdapter` でコネクションプールを広げるコードとの互換のため。
+        HTTP/2 では同時リクエストが 1 つの接続に多重化されるので、広げる必要はありません。
+        """
+
+    def get(self, url, params=None, headers=None, stream=False, timeout=None):
+        # type: (str, Optional[Dict[str, Any]], Optional[Dict[str, str]], bool, Any) -> Http2Response
+        return self._send('GET', url, params=params, headers=headers, stream=stream, timeout=timeout)
+
+    def post(self, url, data=None, headers=None, timeout=None):
+        # type: (str, Any, Optional[Dict[str, str]], Any) -> Http2Response
+        headers = dict(headers or {})
+        if isinstance(data, dict):
+            return self._send('POST', url, data=data, headers=headers, timeout=timeout)
+        # ストリーミングするボディ (_MultipartBody)。
+        # httpx はイテレータを chunked で送るので、長さを明示して Content-Length を付ける
+        if data is not None and hasattr(data, '__len__'):
+            headers['Content-Length'] = str(len(data))
+        return self._send('POST', url, content=data, headers=headers, timeout=timeout)
+
+    def _send(self, method, url, params=None, stream=False, timeout=None, **kwargs):
+        # type: (str, str, Optional[Dict[str, Any]], bool, Any, **Any) -> Http2Response
+        if params is not None:
+            # requests と同じく、値が None のパラメータは送らない
+            kwargs['params'] = dict((k, v) for k, v in params.items() if v is not None)
+        if 'data' in kwargs:
+            kwargs['data'] = dict((k, v) for k, v in kwargs['data'].items() if v is not None)
+        if timeout is None:
+            timeout = httpx.USE_CLIENT_DEFAULT
+        elif isinstance(timeout, tuple):
+            # requests と同じ (接続, 読み込み) のタプル
+            timeout = httpx.Timeout(timeout[1], connect=timeout[0])
+        request = self._client.build_request(method, url, timeout=timeout, **kwargs)
+        try:
+            response = self._client.send(request, stream=stream)
+        except httpx.TimeoutException as e:
+            raise requests.Timeout(e)
+        except httpx.TransportError as e:
+            raise requests.ConnectionError(e)
+        r = Http2Response(response, stream=stream)
+        for hook in list(self.hooks['response']):
+            r = hook(r) or r
+        return r
+
+    def close(self):
+        # type: () -> None
+        self._client.close()
@@ -0,0 +1,217 @@
+# encoding: utf-8
+"""部屋の音声と画像のミラー
+
+部屋の履歴を遡って ``audio`` と ``image`` の URL を集め、複数のスレッドで並行してダウンロードします。
+ファイルは内容の SHA-256 を名前にして保存するので、同じ内容のファイルは 1 つにまとまります。
+URL と保存したファイルの対応はミラー先の ``manifest.json`` に記録され、
+次回は記録済みでサイズが一致するファイルをダウンロードしません。
+
+.. code-block:: python
+
+   stats = bocco.mirror.mirror_room(api, room['uuid'], 'media', workers=8)
+   print(stats['downloaded'], stats['bytes_per_second'])
+"""
+from __future__ import absolute_import
+import hashlib
+import io
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from typing import Any, Callable, Dict, List, Optional, Tuple
+except:
+    pass
+
+import requests
+
+from .api import Client, DOWNLOAD_CHUNK_SIZE, _is_transient
+
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse  # type: ignore
+
+if (3, 0) <= sys.version_info:
+    unicode = str
+
+
+#: URL とファイルの対応を記録するファイル名
+MANIFEST_NAME = 'manifest.json'
+
+#: メディアを含むメッセージのフィールド
+MEDIA_FIELDS = ('audio', 'image')
+
+
+def _media_urls(client, room_uuid, retries=3):
+    # type: (Client, uuid.UUID, int) -> List[Tuple[str, int]]
+    """部屋の全メッセージから ``(URL, メッセージ ID)`` を新しい順に集める
+
+    一時的なエラーなら 1 秒から倍々に間隔を空けて ``retries`` 回まで続きから取得し直し、
+    それでも失敗すれば :class:`requests.RequestException` を投げる。
+    """
+    urls = []  # type: List[Tuple[str, int]]
+    older_than = None  # type: Optional[int]
+    failures = 0
+    while True:
+        try:
+            for page in client._iter_messages_data(room_uuid, older_than=older_than, read=False):
+                for message in page:
+                    for field in MEDIA_FIELDS:
+                        if message.get(field):
+                            urls.append((message[field], message['id']))
+                older_than = page[-1]['id']
+                failures = 0
+            return urls
+        except requests.RequestException as e:
+            failures += 1
+            if retries < failures or not _is_transient(e):
+                raise
+            time.sleep(2 ** (failures - 1))
+
+
+def _sha256(path):
+    # type: (str) -> str
+    digest = hashlib.sha256()
+    with io.open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class _Manifest(object):
+    """``manifest.json`` の読み書き (スレッド間で共有できる)"""
+
+    def __init__(self, directory):
+        # type: (str) -> None
+        self.path = os.path.join(directory, MANIFEST_NAME)
+        self._lock = threading.Lock()
+        try:
+            with io.open(self.path, 'r', encoding='utf-8') as f:
+                self.entries = json.load(f)  # type: Dict[str, Dict[str, Any]]
+        except (IOError, OSError, ValueError):
+            self.entries = {}
+
+    def get(self, url):
+        # type: (str) -> Optional[Dict[str, Any]]
+        with self._lock:
+            return self.entries.get(url)
+
+    def set(self, url, entry):
+        # type: (str, Dict[str, Any]) -> None
+        with self._lock:
+            self.entries[url] = entry
+
+    def save(self):
+        # type: () -> None
+        with self._lock:
+            data = json.dumps(self.entries, indent=1, sort_keys=True)
+        tmppath = self.path + '.tmp'
+        with io.open(tmppath, 'w', encoding='utf-8') as f:
+            f.write(unicode(data))
+        os.rename(tmppath, self.path)
+
+
+def mirror_room(client,
+                room_uuid,
+                directory,
+                workers=8,
+                verify=False,
+                save_interval=50,
+                progress=None):
+    # type: (Client, uuid.UUID, str, int, bool, int, Optional[Callable[[Dict[str, Any]], None]]) -> Dict[str, Any]
+    """部屋の音声と画像を全て ``directory`` にダウンロードする
+
+    :param workers: 同時にダウンロードする数 (= HTTP 接続数)
+    :param verify: 記録済みのファイルもハッシュを計算し直して確認する
+    :param save_interval: ``manifest.json`` を保存する間隔 (ダウンロード数)。
+                          中断しても、保存済みの分は次回ダウンロードしません
+    :param progress: ファイルを 1 つ処理するたびに、途中経過の統計で呼ばれる
+    :return: 統計 (``files``, ``downloaded``, ``skipped``, ``duplicates``, ``failed``,
+             ``bytes``, ``seconds``, ``bytes_per_second``)。
+             ``failed`` はダウンロードに失敗した ``(URL, エラー)`` のリスト
+    :raises requests.RequestException: 履歴を最後まで取得できなかった場合 (何もダウンロードしません)
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    manifest = _Manifest(directory)
+
+    started = time.time()
+    urls = _media_urls(client, room_uuid)
+    downloader = client._with_pool_size(workers)
+    stats = {'files': len(urls),
+             'downloaded': 0,
+             'skipped': 0,
+             'duplicates': 0,
+             'failed': [],
+             'bytes': 0}  # type: Dict[str, Any]
+    lock = threading.Lock()
+
+    def is_valid(entry):
+        # type: (Optional[Dict[str, Any]]) -> bool
+        if entry is None:
+            return False
+        path = os.path.join(directory, entry['file'])
+        if not os.path.isfile(path) or os.path.getsize(path) != entry['size']:
+            return False
+        return not verify or _sha256(path) == entry['sha256']
+
+    def fetch(url, message_id):
+        # type: (str, int) -> None
+        if is_valid(manifest.get(url)):
+            with lock:
+                stats['skipped'] += 1
+            return
+        ext = os.path.splitext(urlparse(url).path)[1]
+        tmppath = os.path.join(directory, '.{0}.tmp'.format(uuid.uuid4().hex))
+        try:
+            r = downloader.download(url, tmppath)
+            r.raise_for_status()
+            sha256 = _sha256(tmppath)
+            size = os.path.getsize(tmppath)
+            filename = sha256 + ext
+            path = os.path.join(directory, filename)
+            duplicate = os.path.isfile(path) and os.path.getsize(path) == size
+            if duplicate:
+                os.remove(tmppath)
+            else:
+                os.rename(tmppath, path)
+        except Exception as e:
+            if os.path.exists(tmppath):
+                os.remove(tmppath)
+            with lock:
+                stats['failed'].append((url, e))
+            return
+        manifest.set(url, {'file': filename, 'sha256': sha256, 'size': size, 'message_id': message_id})
+        with lock:
+            stats['downloaded'] += 1
+            stats['bytes'] += size
+            if duplicate:
+                stats['duplicates'] += 1
+            save = stats['downloaded'] % save_interval == 0
+        if save:
+            manifest.save()
+
+    def done(_):
+        if progress is not None:
+            with lock:
+                snapshot = dict(stats, seconds=time.time() - started)
+            progress(snapshot)
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(fetch, url, message_id) for url, message_id in urls]
+            for future in futures:
+                future.add_done_callback(done)
+    finally:
+        manifest.save()
+        if downloader is not client:
+            downloader.http.close()
+
+    stats['seconds'] = time.time() - started
+    stats['bytes_per_second'] = stats['bytes'] / stats['seconds'] if stats['seconds'] else 0.0
+    return stats
@@ -4,7 +4,7 @@ import sys
 from uuid import UUID
 
 try:
-    from typing import Any, Dict
+    from typing import Any, Callable, Dict
 except:
     pass
 
@@ -51,10 +51,39 @@ UUIDSchema = Or(UUID, Use(UUID))
 DateTimeSchema = Or(arrow.Arrow, Use(arrow.get))
 
 
+def _uuid(value):
+    # type: (Any) -> UUID
+    return value if isinstance(value, UUID) else UUID(value)
+
+
+def _datetime(value):
+    # type: (Any) -> arrow.Arrow
+    return value if isinstance(value, arrow.Arrow) else arrow.get(value)
+
+
+def _plain(value):
+    # type: (Any) -> Any
+    """モデルの値を JSON で表せる値にする"""
+    if isinstance(value, _Model):
+        return value.to_dict()
+    if isinstance(value, list):
+        return [_plain(v) for v in value]
+    if isinstance(value, UUID):
+        return unicode(value)
+    if isinstance(value, Enum):
+        return value.value
+    if isinstance(value, arrow.Arrow):
+        return value.isoformat()
+    return value
+
+
 class _Model(object):
 
     schema = Schema(None)
 
+    #: 検証せずに読み込むときの各キーの変換 (:meth:`from_dict`)
+    fields = {}  # type: Dict[str, Callable[[Any], Any]]
+
     @classmethod
     def validate(cls, data):
         # type: (dict) -> dict
@@ -77,9 +106,38 @@ class _Model(object):
         cls = type(self)
         self._data = cls.validate(data)  # type: Dict[str, Any]
 
+    @classmethod
+    def from_dict(cls, data, validate=True):
+        # type: (dict, bool) -> Any
+        """:meth:`to_dict` の出力からモデルを作成する
+
+        ``validate`` が偽なら検証を行わず、値の型だけを変換します。信頼できるデータにだけ使ってください。
+        UUID や日時は変換済みの値 (:mod:`bocco.snapshot` が読み込んだもの) も受け付けます。
+        """
+        if validate:
+            return cls(data)
+        model = cls.__new__(cls)
+        model._data = dict((key, cls.fields[key](value) if key in cls.fields else value)
+                           for key, value in data.items())
+        return model
+
+    def to_dict(self):
+        # type: () -> Dict[str, Any]
+        """API のレスポンスと同じ形の dict を返す
+
+        UUID と列挙型は文字列に、日時は ISO 8601 の文字列になります。
+        """
+        return dict((key, _plain(value)) for key, value in self._data.items())
+
     def __getitem__(self, key):
         return self._data[key]
 
+    def __getstate__(self):
+        return self._data
+
+    def __setstate__(self, state):
+        self._data = state
+
     def __repr__(self):
         return '<{0} {1}>'.format(type(self).__name__, self._data)
 
@@ -118,6 +176,11 @@ class User(_Model):
         Optional('icon'): URLSchema,
     }, ignore_extra_keys=True)
 
+    fields = {
+        'uuid': _uuid,
+        'user_type': UserType,
+    }
+
 
 class RoomUser(_Model):
     """部屋と紐付いたユーザ情報
@@ -148,6 +211,11 @@ class RoomUser(_Model):
         'user': Or(User, Use(User)),
     }, ignore_extra_keys=True)
 
+    fields = {
+        'joined_at': _datetime,
+        'user': lambda v: User.from_dict(v, validate=False),
+    }
+
 
 class Room(_Model):
     """部屋情報
@@ -233,6 +301,14 @@ class Room(_Model):
             Use(lambda l: [Message(i) for i in l])),
     }, ignore_extra_keys=True)
 
+    fields = {
+        'uuid': _uuid,
+        'updated_at': _datetime,
+        'members': lambda l: [RoomUser.from_dict(i, validate=False) for i in l or []],
+        'sensors': lambda l: [User.from_dict(i, validate=False) for i in l],
+        'messages': lambda l: [Message.from_dict(i, validate=False) for i in l],
+    }
+
 
 class Session(_Model):
     """API クライアントのセッション情報
@@ -252,6 +328,10 @@ class Session(_Model):
         'uuid': UUIDSchema,
     }, ignore_extra_keys=True)
 
+    fields = {
+        'uuid': _uuid,
+    }
+
 
 class Message(_Model):
     """部屋へ送信されたメッセージ
@@ -284,6 +364,19 @@ class Message(_Model):
     True
     >>> m['user']['uuid']
     UUID('0a0f6b39-ac63-4731-9c94-756ae80dd0b9')
+
+    ``to_dict`` と ``from_dict`` で往復できます。pickle にも対応しています。
+
+    >>> d = m.to_dict()
+    >>> d['date'] == u'2016-03-02T11:00:59+00:00'
+    True
+    >>> d['user']['user_type'] == u'bocco'
+    True
+    >>> Message.from_dict(d, validate=False)['date']
+    <Arrow [2016-03-02T11:00:59+00:00]>
+    >>> import pickle
+    >>> pickle.loads(pickle.dumps(m)).to_dict() == d
+    True
     """
 
     schema = Schema({
@@ -300,6 +393,15 @@ class Message(_Model):
         'user': Or(User, Use(User)),
     }, ignore_extra_keys=True)
 
+    fields = {
+        'unique_id': _uuid,
+        'media': MessageMedia,
+        'message_type': MessageType,
+        'sender': _uuid,
+        'date': _datetime,
+        'user': lambda v: User.from_dict(v, validate=False),
+    }
+
 
 class ApiErrorBody(_Model):
     """エラーレスポンス
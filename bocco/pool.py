@@ -0,0 +1,175 @@
+# encoding: utf-8
+"""複数アカウントの BOCCO API クライアントをまとめて扱うプール"""
+from __future__ import absolute_import
+import threading
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+
+try:
+    from typing import Any, Callable, Dict, List, Optional
+except:
+    pass
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.compat import cookielib
+
+from .api import Client, SessionManager
+from .http2 import Http2Session
+from .models import Room
+
+
+class ClientPool(object):
+    """複数アカウントのクライアントを固定数のワーカーで動かすプール
+
+    部屋は UUID によって ``workers`` 個のワーカーに振り分けられ、
+    同じ部屋への呼び出しは常に同じワーカーで順番に実行されます。
+    全てのクライアントは 1 つのコネクションプールを共有するため、
+    アカウント数が増えても接続数とスレッド数はワーカー数で決まります。
+
+    各メソッドは :class:`concurrent.futures.Future` を返します。
+
+    .. code-block:: python
+
+       with bocco.pool.ClientPool(workers=8) as pool:
+           pool.add_account('ACCESS TOKEN 1')
+           pool.add_account('ACCESS TOKEN 2')
+           futures = [pool.post_text_message(room['uuid'], 'hello')
+                      for room in pool.refresh_rooms()]
+           for f in futures:
+               print(f.result())
+
+    .. note::
+
+       :meth:`subscribe` はロングポーリングの間スレッドを占有するので、
+       他の呼び出しとは別の ``subscribe_threads`` 個のスレッドで実行されます。
+       多くの部屋を同時に購読する場合は ``subscribe_threads`` を増やしてください。
+    """
+
+    def __init__(self, workers=4, threads_per_worker=2, base_url=None, transport='http1', timeout=None,
+                 subscribe_threads=8):
+        # type: (int, int, Optional[str], str, Any, int) -> None
+        assert 0 < workers and 0 < threads_per_worker and 0 < subscribe_threads
+        self.base_url = base_url
+        self.transport = transport
+        self.timeout = timeout
+        # 全てのスレッドが同時に接続を使えるようにする。
+        # HTTP/2 でもサーバが HTTP/1.1 にフォールバックすると多重化されないので、同じ数だけ用意する
+        max_connections = workers * threads_per_worker + subscribe_threads
+        if transport == 'http2':
+            self.http = Http2Session(max_connections=max_connections)  # type: Any
+        else:
+            self.http = requests.Session()
+        # アクセストークンはクエリで送るので、アカウント間で接続を共有しても問題ない。
+        # Cookie だけはアカウントをまたいで送らないよう、全て拒否する。
+        self.http.cookies.set_policy(cookielib.DefaultCookiePolicy(allowed_domains=[]))
+        adapter = HTTPAdapter(pool_maxsize=max_connections)  # HTTP/2 では無視される
+        self.http.mount('https://', adapter)
+        self.http.mount('http://', adapter)
+        self.clients = []  # type: List[Client]
+        self._executors = [ThreadPoolExecutor(max_workers=threads_per_worker)
+                           for _ in range(workers)]
+        self._subscribe_executor = ThreadPoolExecutor(max_workers=subscribe_threads)
+        self._routes = {}  # type: Dict[uuid.UUID, Client]
+        self._rooms = {}  # type: Dict[uuid.UUID, Room]
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+
+    def add_account(self, access_token=None, session_manager=None):
+        # type: (Optional[str], Optional[SessionManager]) -> Client
+        """アカウントを追加する
+
+        ``access_token`` か ``session_manager`` のどちらかを指定します。
+        部屋の割り当ては次の :meth:`refresh_rooms` で更新されます。
+        """
+        if session_manager is not None:
+            client = Client.from_session_manager(session_manager,
+                                                 http_session=self.http,
+                                                 transport=self.transport,
+                                                 timeout=self.timeout)
+        else:
+            assert access_token is not None
+            client = Client(access_token,
+                            http_session=self.http,
+                            base_url=self.base_url,
+                            transport=self.transport,
+                            timeout=self.timeout)
+        with self._lock:
+            self.clients.append(client)
+        return client
+
+    def refresh_rooms(self):
+        # type: () -> List[Room]
+        """全アカウントの部屋一覧を取得し、部屋とアカウントの対応を更新する
+
+        複数のアカウントが同じ部屋に入っている場合は、先に追加したアカウントを使います。
+        """
+        with self._lock:
+            clients = list(self.clients)
+        futures = [self._executors[i % len(self._executors)].submit(client.get_rooms)
+                   for i, client in enumerate(clients)]
+        routes = {}  # type: Dict[uuid.UUID, Client]
+        rooms = {}  # type: Dict[uuid.UUID, Room]
+        for client, future in zip(clients, futures):
+            for room in future.result():
+                if room['uuid'] not in routes:
+                    routes[room['uuid']] = client
+                    rooms[room['uuid']] = room
+        with self._lock:
+            self._routes = routes
+            self._rooms = rooms
+        return list(rooms.values())
+
+    def get_room(self, room_uuid):
+        # type: (uuid.UUID) -> Room
+        """:meth:`refresh_rooms` で取得した部屋情報を返す"""
+        with self._lock:
+            return self._rooms[room_uuid]
+
+    def client_for(self, room_uuid):
+        # type: (uuid.UUID) -> Client
+        """部屋に入っているアカウントのクライアントを返す
+
+        未知の部屋なら :exc:`KeyError` を送出します。
+        """
+        with self._lock:
+            return self._routes[room_uuid]
+
+    def _submit(self, room_uuid, call, executor=None):
+        # type: (uuid.UUID, Callable[[Client], Any], Optional[ThreadPoolExecutor]) -> Future
+        assert type(room_uuid) == uuid.UUID
+        client = self.client_for(room_uuid)
+        if executor is None:
+            executor = self._executors[room_uuid.int % len(self._executors)]
+        return executor.submit(call, client)
+
+    def get_messages(self, room_uuid, **kwargs):
+        # type: (uuid.UUID, **Any) -> Future
+        """:meth:`bocco.api.Client.get_messages` を部屋のワーカーで実行する"""
+        return self._submit(room_uuid, lambda c: c.get_messages(room_uuid, **kwargs))
+
+    def subscribe(self, room_uuid, **kwargs):
+        # type: (uuid.UUID, **Any) -> Future
+        """:meth:`bocco.api.Client.subscribe` を購読用のスレッドで実行する
+
+        部屋のワーカーは使わないので、ロングポーリング中も同じ部屋の他の呼び出しは待たされません。
+        """
+        return self._submit(room_uuid, lambda c: c.subscribe(room_uuid, **kwargs), self._subscribe_executor)
+
+    def post_text_message(self, room_uuid, text):
+        # type: (uuid.UUID, str) -> Future
+        """:meth:`bocco.api.Client.post_text_message` を部屋のワーカーで実行する"""
+        return self._submit(room_uuid, lambda c: c.post_text_message(room_uuid, text))
+
+    def shutdown(self, wait=True):
+        # type: (bool) -> None
+        """ワーカーを停止し、コネクションを閉じる"""
+        for executor in self._executors:
+            executor.shutdown(wait=wait)
+        self._subscribe_executor.shutdown(wait=wait)
+        self.http.close()
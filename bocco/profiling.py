@@ -0,0 +1,316 @@
+# encoding: utf-8
+"""CLI と Web アプリのプロファイリング
+
+:class:`Profiler` を開始すると、API 呼び出しごとに次のフェーズの時間を記録します。
+
+- ``network``: HTTP の送受信
+- ``json``: レスポンスの JSON のデコード
+- ``validate``: :mod:`bocco.models` のスキーマ検証 (日時の解析を除く)
+- ``arrow``: :func:`arrow.get` による日時の解析
+- ``render``: Web アプリの HTML の生成
+
+あわせて cProfile とスタックのサンプリングを行い、:meth:`Profiler.save` で書き出します。
+``.folded`` ファイルは flamegraph.pl や speedscope で可視化できます。
+
+.. code-block:: python
+
+   with bocco.profiling.Profiler() as profiler:
+       api.get_messages(room['uuid'])
+   print(profiler.summary())
+   profiler.save('profile/messages')  # messages.prof, messages.folded, messages.phases.json
+
+計測のためのフックは開始している間だけ設定され、計測しているスレッド以外では何もしません。
+"""
+from __future__ import absolute_import
+import collections
+import contextlib
+import cProfile
+import functools
+import io
+import json
+import os
+import sys
+import threading
+import time
+
+try:
+    from typing import Any, Callable, Dict, Iterator, List, Optional
+except:
+    pass
+
+if (3, 0) <= sys.version_info:
+    unicode = str
+
+
+#: 記録するフェーズ
+PHASES = ('network', 'json', 'validate', 'arrow', 'render')
+
+_local = threading.local()
+_hooks_lock = threading.Lock()
+_hooks_count = 0
+_originals = []  # type: List[tuple]
+
+
+class _Frame(object):
+
+    __slots__ = ('name', 'start', 'children')
+
+    def __init__(self, name):
+        # type: (str) -> None
+        self.name = name
+        self.start = time.time()
+        self.children = 0.0
+
+
+@contextlib.contextmanager
+def phase(name):
+    # type: (str) -> Iterator[None]
+    """このスレッドで計測中なら、ブロックの時間をフェーズ ``name`` として記録する
+
+    フェーズが入れ子になった場合、内側の時間は外側には含めません。
+    """
+    profiler = getattr(_local, 'profiler', None)
+    if profiler is None:
+        yield
+        return
+    stack = _local.stack
+    frame = _Frame(name)
+    stack.append(frame)
+    try:
+        yield
+    finally:
+        stack.pop()
+        elapsed = time.time() - frame.start
+        if stack:
+            stack[-1].children += elapsed
+        profiler._add(name, elapsed - frame.children)
+
+
+def _wrap_phase(name, f):
+    # type: (str, Callable[..., Any]) -> Callable[..., Any]
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        if getattr(_local, 'profiler', None) is None:
+            return f(*args, **kwargs)
+        with phase(name):
+            return f(*args, **kwargs)
+    return wrapper
+
+
+def _wrap_call(name, f):
+    # type: (str, Callable[..., Any]) -> Callable[..., Any]
+    """API 呼び出し 1 回分のフェーズをまとめて記録する (入れ子の呼び出しは外側にまとめる)"""
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        profiler = getattr(_local, 'profiler', None)
+        if profiler is None or _local.call is not None:
+            return f(*args, **kwargs)
+        call = {'call': name, 'start': time.time()}  # type: Dict[str, Any]
+        _local.call = call
+        try:
+            return f(*args, **kwargs)
+        finally:
+            _local.call = None
+            call['total'] = time.time() - call.pop('start')
+            profiler._add_call(call)
+    return wrapper
+
+
+def _hook_targets():
+    # type: () -> List[tuple]
+    import arrow.factory
+    import requests
+    from . import api, http2, models
+    targets = [(requests.Session, 'send', 'network'),
+               (http2.Http2Session, '_send', 'network'),
+               (requests.Response, 'json', 'json'),
+               (http2.Http2Response, 'json', 'json'),
+               (models._Model, '__init__', 'validate'),
+               (arrow.factory.ArrowFactory, 'get', 'arrow')]
+    for name in ('get_rooms', 'get_messages', 'get_recent_messages', 'subscribe',
+                 'post_text_message', 'post_audio_message', 'post_image_message', 'download',
+                 '_get_messages_data', '_subscribe_data'):
+        targets.append((api.Client, name, None))
+    return targets
+
+
+def _install_hooks():
+    # type: () -> None
+    global _hooks_count
+    with _hooks_lock:
+        _hooks_count += 1
+        if _hooks_count != 1:
+            return
+        for owner, name, phase_name in _hook_targets():
+            original = owner.__dict__[name]
+            if phase_name is None:
+                wrapper = _wrap_call(name, original)
+            else:
+                wrapper = _wrap_phase(phase_name, original)
+            _originals.append((owner, name, original))
+            setattr(owner, name, wrapper)
+
+
+def _uninstall_hooks():
+    # type: () -> None
+    global _hooks_count
+    with _hooks_lock:
+        _hooks_count -= 1
+        if _hooks_count != 0:
+            return
+        while _originals:
+            owner, name, original = _originals.pop()
+            setattr(owner, name, original)
+
+
+class _Sampler(threading.Thread):
+    """一定間隔でスタックを記録する"""
+
+    def __init__(self, interval, thread_ident=None):
+        # type: (float, Optional[int]) -> None
+        super(_Sampler, self).__init__()
+        self.daemon = True
+        self.interval = interval
+        self.thread_ident = thread_ident
+        self.stacks = collections.Counter()  # type: collections.Counter
+        self._stop_event = threading.Event()
+
+    def run(self):
+        # type: () -> None
+        names = {}  # type: Dict[int, str]
+        while not self._stop_event.wait(self.interval):
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name  # type: ignore
+            for ident, frame in sys._current_frames().items():
+                if ident == self.ident or (self.thread_ident is not None and ident != self.thread_ident):
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(u'{0} ({1}:{2})'.format(code.co_name,
+                                                         os.path.basename(code.co_filename),
+                                                         code.co_firstlineno))
+                    frame = frame.f_back
+                stack.append(names.get(ident, unicode(ident)))
+                self.stacks[u';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        # type: () -> None
+        self._stop_event.set()
+        self.join()
+
+
+class Profiler(object):
+    """API 呼び出しのフェーズの内訳、cProfile、スタックのサンプリングを記録する
+
+    記録されるのは :meth:`start` を呼んだスレッドの処理だけです
+    (サンプリングは ``all_threads`` が真なら全てのスレッド)。
+
+    :param cprofile: cProfile を使う。別のプロファイラが動いている場合は使われません
+    :param sample_interval: スタックを記録する間隔 (秒)。0 ならサンプリングしない
+    :param all_threads: 全てのスレッドのスタックを記録する
+    """
+
+    def __init__(self, cprofile=True, sample_interval=0.005, all_threads=True):
+        # type: (bool, float, bool) -> None
+        self.phases = dict((name, 0.0) for name in PHASES)  # type: Dict[str, float]
+        self.calls = []  # type: List[Dict[str, Any]]
+        self.total = 0.0
+        self._cprofile = cProfile.Profile() if cprofile else None
+        self._sample_interval = sample_interval
+        self._all_threads = all_threads
+        self._sampler = None  # type: Optional[_Sampler]
+        self._started = 0.0
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        # type: () -> None
+        _install_hooks()
+        _local.profiler = self
+        _local.stack = []
+        _local.call = None
+        if 0 < self._sample_interval:
+            self._sampler = _Sampler(self._sample_interval,
+                                     None if self._all_threads else threading.current_thread().ident)
+            self._sampler.start()
+        if self._cprofile is not None:
+            try:
+                self._cprofile.enable()
+            except ValueError:
+                # Python 3.12 以降は同時に 1 つしか有効にできない
+                self._cprofile = None
+        self._started = time.time()
+
+    def stop(self):
+        # type: () -> None
+        self.total = time.time() - self._started
+        if self._cprofile is not None:
+            self._cprofile.disable()
+        if self._sampler is not None:
+            self._sampler.stop()
+        _local.profiler = None
+        _uninstall_hooks()
+
+    def _add(self, name, elapsed):
+        # type: (str, float) -> None
+        self.phases[name] = self.phases.get(name, 0.0) + elapsed
+        call = _local.call
+        if call is not None:
+            call[name] = call.get(name, 0.0) + elapsed
+
+    def _add_call(self, call):
+        # type: (Dict[str, Any]) -> None
+        self.calls.append(call)
+
+    def server_timing(self):
+        # type: () -> str
+        """``Server-Timing`` ヘッダーの値 (ミリ秒)"""
+        timings = [u'{0};dur={1:.2f}'.format(name, self.phases[name] * 1000)
+                   for name in PHASES if self.phases[name]]
+        timings.append(u'total;dur={0:.2f}'.format(self.total * 1000))
+        return u', '.join(timings)
+
+    def summary(self):
+        # type: () -> str
+        """フェーズごとの時間の表"""
+        lines = [u'{0:<10} {1:>10}'.format(u'phase', u'ms')]
+        accounted = 0.0
+        for name in PHASES:
+            lines.append(u'{0:<10} {1:>10.2f}'.format(name, self.phases[name] * 1000))
+            accounted += self.phases[name]
+        lines.append(u'{0:<10} {1:>10.2f}'.format(u'other', (self.total - accounted) * 1000))
+        lines.append(u'{0:<10} {1:>10.2f}'.format(u'total', self.total * 1000))
+        for call in self.calls:
+            lines.append(u'{0}: {1:.2f} ms ({2})'.format(
+                call['call'], call['total'] * 1000,
+                u', '.join(u'{0} {1:.2f}'.format(name, call[name] * 1000) for name in PHASES if name in call)))
+        return u'\n'.join(lines)
+
+    def save(self, prefix):
+        # type: (str) -> List[str]
+        """``<prefix>.prof`` (cProfile)、``<prefix>.folded`` (サンプリング)、
+        ``<prefix>.phases.json`` (フェーズの内訳) を書き出し、書いたファイルのリストを返す
+        """
+        directory = os.path.dirname(prefix)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        paths = []
+        if self._cprofile is not None:
+            self._cprofile.dump_stats(prefix + '.prof')
+            paths.append(prefix + '.prof')
+        if self._sampler is not None:
+            with io.open(prefix + '.folded', 'w', encoding='utf-8') as f:
+                for stack, count in sorted(self._sampler.stacks.items()):
+                    f.write(u'{0} {1}\n'.format(stack, count))
+            paths.append(prefix + '.folded')
+        with io.open(prefix + '.phases.json', 'w', encoding='utf-8') as f:
+            f.write(unicode(json.dumps({'total': self.total, 'phases': self.phases, 'calls': self.calls},
+                                       indent=2)))
+        paths.append(prefix + '.phases.json')
+        return paths
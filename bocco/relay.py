@@ -0,0 +1,362 @@
+# encoding: utf-8
+"""部屋のイベントを外部に転送するリレー
+
+:class:`Relay` は部屋ごとのスレッドで ``subscribe`` を続け、届いたイベントを全てのシンクに渡します。
+シンクはそれぞれ上限付きのキューと送信スレッドを持ち、イベントをまとめて送ります。
+シンクへの追加はキューに入れるだけなので、遅いシンクがあっても
+``subscribe`` や他のシンクは待たされません (``overflow='block'`` を除く)。
+
+.. code-block:: python
+
+   relay = bocco.relay.Relay(api, [room['uuid'] for room in api.get_rooms()],
+                             [bocco.relay.WebhookSink('https://example.com/hook', concurrency=4),
+                              bocco.relay.FileSink('events.ndjson')])
+   relay.start()
+
+イベントは API のイベントに部屋の UUID を加えた JSON です。
+
+.. code-block:: json
+
+   {"room_uuid": "...", "event": "message", "body": {"id": 123, "text": "...", ...}}
+"""
+from __future__ import absolute_import
+import collections
+import io
+import json
+import sys
+import threading
+import time
+import uuid
+
+try:
+    from typing import Any, Deque, Dict, List, Optional, TextIO
+except:
+    pass
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .api import Client
+
+if (3, 0) <= sys.version_info:
+    unicode = str
+
+
+#: キューが一杯のときの動作
+#:
+#: - ``drop_oldest``: 最も古いイベントを捨てて追加する
+#: - ``drop_newest``: 追加しようとしたイベントを捨てる
+#: - ``block``: 空くまで待つ (その間、部屋の ``subscribe`` も止まる)
+OVERFLOW_POLICIES = ('drop_oldest', 'drop_newest', 'block')
+
+
+class _BoundedQueue(object):
+    """上限付きのキュー。イベントをまとめて取り出せる"""
+
+    def __init__(self, maxsize, overflow):
+        # type: (int, str) -> None
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.closed = False
+        self._items = collections.deque()  # type: Deque[Any]
+        self._condition = threading.Condition()
+
+    def __len__(self):
+        return len(self._items)
+
+    def put(self, item):
+        # type: (Any) -> int
+        """イベントを追加し、捨てたイベントの数を返す"""
+        dropped = 0
+        with self._condition:
+            if self.closed:
+                return 1
+            if self.maxsize <= len(self._items):
+                if self.overflow == 'drop_newest':
+                    return 1
+                elif self.overflow == 'drop_oldest':
+                    self._items.popleft()
+                    dropped = 1
+                else:
+                    while self.maxsize <= len(self._items) and not self.closed:
+                        self._condition.wait()
+                    if self.closed:
+                        return 1
+            self._items.append(item)
+            self._condition.notify_all()
+        return dropped
+
+    def get_batch(self, size, interval):
+        # type: (int, float) -> List[Any]
+        """最大 ``size`` 個のイベントを取り出す
+
+        最初のイベントが届いてから ``interval`` 秒まではまとめるために待つ。
+        閉じられて空になっていれば空のリストを返す。
+        """
+        with self._condition:
+            while not self._items and not self.closed:
+                self._condition.wait()
+            deadline = time.time() + interval
+            while len(self._items) < size and not self.closed:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            batch = [self._items.popleft() for _ in range(min(size, len(self._items)))]
+            self._condition.notify_all()
+        return batch
+
+    def close(self):
+        # type: () -> None
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
+
+
+class Sink(object):
+    """イベントの転送先
+
+    サブクラスで :meth:`send` を実装します。
+    :meth:`send` は ``concurrency`` 個のスレッドから同時に呼ばれることがあります。
+
+    :param queue_size: 送信待ちのイベント数の上限
+    :param batch_size: 一度に送るイベント数の上限
+    :param batch_interval: イベントをまとめるために待つ最大時間 (秒)
+    :param concurrency: 同時に送るバッチの数。1 より大きいとバッチの順序は保証されません
+    :param overflow: キューが一杯のときの動作 (:data:`OVERFLOW_POLICIES`)
+    """
+
+    def __init__(self,
+                 queue_size=1000,
+                 batch_size=100,
+                 batch_interval=1.0,
+                 concurrency=1,
+                 overflow='drop_oldest'):
+        # type: (int, int, float, int, str) -> None
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(u'Unknown overflow policy: {0}'.format(overflow))
+        assert 0 < queue_size and 0 < batch_size and 0 < concurrency
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.concurrency = concurrency
+        self.stats = {'received': 0, 'sent': 0, 'dropped': 0, 'failed': 0}  # type: Dict[str, int]
+        self.last_error = None  # type: Optional[BaseException]
+        self._queue = _BoundedQueue(queue_size, overflow)
+        self._lock = threading.Lock()
+        self._threads = []  # type: List[threading.Thread]
+
+    def __repr__(self):
+        return '<{0}>'.format(self.__class__.__name__)
+
+    def send(self, events):
+        # type: (List[Dict[str, Any]]) -> None
+        """イベントをまとめて送る。失敗したら例外を投げる"""
+        raise NotImplementedError()
+
+    def put(self, event):
+        # type: (Dict[str, Any]) -> None
+        """イベントを送信待ちのキューに入れる"""
+        dropped = self._queue.put(event)
+        with self._lock:
+            self.stats['received'] += 1
+            self.stats['dropped'] += dropped
+
+    def start(self):
+        # type: () -> None
+        for _ in range(self.concurrency):
+            thread = threading.Thread(target=self._run)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def close(self, timeout=None):
+        # type: (Optional[float]) -> None
+        """キューに残ったイベントを送り終えるまで待つ"""
+        self._queue.close()
+        deadline = None if timeout is None else time.time() + timeout
+        for thread in self._threads:
+            thread.join(None if deadline is None else max(0, deadline - time.time()))
+
+    @property
+    def pending(self):
+        # type: () -> int
+        """送信待ちのイベント数"""
+        return len(self._queue)
+
+    def _run(self):
+        # type: () -> None
+        while True:
+            batch = self._queue.get_batch(self.batch_size, self.batch_interval)
+            if not batch:
+                return
+            try:
+                self.send(batch)
+            except Exception as e:
+                with self._lock:
+                    self.stats['failed'] += len(batch)
+                    self.last_error = e
+            else:
+                with self._lock:
+                    self.stats['sent'] += len(batch)
+
+
+def _dumps(event):
+    # type: (Dict[str, Any]) -> str
+    data = json.dumps(event, ensure_ascii=False, separators=(',', ':'))
+    return data if isinstance(data, unicode) else data.decode('utf-8')
+
+
+class WebhookSink(Sink):
+    """イベントのリストを JSON で POST するシンク
+
+    :param url: 送信先の URL
+    :param headers: 追加するヘッダー
+    :param timeout: 1 回の POST のタイムアウト (秒)
+    :param retries: 失敗したときにやり直す回数
+    """
+
+    def __init__(self, url, headers=None, timeout=10.0, retries=3, **kwargs):
+        # type: (str, Optional[Dict[str, str]], float, int, **Any) -> None
+        super(WebhookSink, self).__init__(**kwargs)
+        self.url = url
+        self.headers = dict(headers or {})
+        self.headers['Content-Type'] = 'application/json; charset=utf-8'
+        self.timeout = timeout
+        self.retries = retries
+        self.http = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=self.concurrency)
+        self.http.mount('https://', adapter)
+        self.http.mount('http://', adapter)
+
+    def __repr__(self):
+        return '<WebhookSink {0}>'.format(self.url)
+
+    def send(self, events):
+        # type: (List[Dict[str, Any]]) -> None
+        body = (u'[' + u','.join(_dumps(e) for e in events) + u']').encode('utf-8')
+        for attempt in range(self.retries + 1):
+            try:
+                r = self.http.post(self.url, data=body, headers=self.headers, timeout=self.timeout)
+                r.raise_for_status()
+                return
+            except requests.RequestException:
+                if self.retries <= attempt:
+                    raise
+                time.sleep(min(2 ** attempt, 30))
+
+
+class StreamSink(Sink):
+    """イベントを 1 行 1 つの JSON (NDJSON) でストリームに書くシンク
+
+    :param stream: 書き込み先。省略時は標準出力
+    """
+
+    def __init__(self, stream=None, **kwargs):
+        # type: (Optional[TextIO], **Any) -> None
+        kwargs['concurrency'] = 1
+        super(StreamSink, self).__init__(**kwargs)
+        self.stream = stream
+
+    def send(self, events):
+        # type: (List[Dict[str, Any]]) -> None
+        stream = self.stream or sys.stdout
+        stream.write(u''.join(_dumps(e) + u'\n' for e in events))
+        stream.flush()
+
+
+class FileSink(StreamSink):
+    """イベントを NDJSON でファイルに追記するシンク"""
+
+    def __init__(self, path, **kwargs):
+        # type: (str, **Any) -> None
+        super(FileSink, self).__init__(io.open(path, 'a', encoding='utf-8'), **kwargs)
+        self.path = path
+
+    def __repr__(self):
+        return '<FileSink {0}>'.format(self.path)
+
+    def close(self, timeout=None):
+        # type: (Optional[float]) -> None
+        super(FileSink, self).close(timeout)
+        self.stream.close()  # type: ignore
+
+
+class Relay(object):
+    """部屋のイベントを ``subscribe`` し、全てのシンクに転送する
+
+    :param client: 使用するクライアント
+    :param room_uuids: 対象の部屋
+    :param sinks: 転送先
+    :param newer_than: このメッセージ ID より新しいイベントから転送する。
+                       省略時は開始した時点の最新のメッセージより後
+    :param read: 転送したメッセージを既読にする
+    :param max_retry_interval: ``subscribe`` が失敗したときに待つ最大時間 (秒)。
+                               失敗が続くと 1 秒から倍々に延ばします
+    """
+
+    def __init__(self, client, room_uuids, sinks, newer_than=None, read=False, max_retry_interval=60.0):
+        # type: (Client, List[uuid.UUID], List[Sink], Optional[int], bool, float) -> None
+        self.client = client
+        self.room_uuids = list(room_uuids)
+        self.sinks = list(sinks)
+        self.newer_than = newer_than
+        self.read = read
+        self.max_retry_interval = max_retry_interval
+        self.errors = {}  # type: Dict[uuid.UUID, BaseException]
+        self._stop = threading.Event()
+        self._threads = []  # type: List[threading.Thread]
+        # ロングポーリングが部屋ごとに接続を占有するので、専用のセッションを使う
+        self._subscriber = client._with_pool_size(max(1, len(self.room_uuids)))
+
+    def start(self):
+        # type: () -> None
+        """シンクと部屋ごとの ``subscribe`` を開始する"""
+        for sink in self.sinks:
+            sink.start()
+        for room_uuid in self.room_uuids:
+            thread = threading.Thread(target=self._subscribe, args=(room_uuid,))
+            # ロングポーリングは中断できないので、終了を待たない
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=10.0):
+        # type: (float) -> None
+        """``subscribe`` をやめ、シンクに残ったイベントを ``timeout`` 秒まで送る"""
+        self._stop.set()
+        deadline = time.time() + timeout
+        for sink in self.sinks:
+            sink.close(max(0, deadline - time.time()))
+
+    def stats(self):
+        # type: () -> Dict[str, Dict[str, int]]
+        """シンクごとの統計 (``received``, ``sent``, ``dropped``, ``failed``, ``pending``)"""
+        return dict((repr(sink), dict(sink.stats, pending=sink.pending)) for sink in self.sinks)
+
+    def _subscribe(self, room_uuid):
+        # type: (uuid.UUID) -> None
+        newer_than = self.newer_than
+        retry_interval = 1.0
+        while not self._stop.is_set():
+            try:
+                if newer_than is None:
+                    page = self._subscriber._get_messages_data(room_uuid, read=False, check=True)
+                    newer_than = max([m['id'] for m in page] or [0])
+                events = self._subscriber._subscribe_data(room_uuid, newer_than, self.read, check=True)
+            except Exception as e:
+                self.errors[room_uuid] = e
+                self._stop.wait(retry_interval)
+                retry_interval = min(retry_interval * 2, self.max_retry_interval)
+                continue
+            self.errors.pop(room_uuid, None)
+            retry_interval = 1.0
+            events.sort(key=lambda e: (e.get('body') or {}).get('id') or 0)
+            for event in events:
+                body = event.get('body') or {}
+                if event.get('event') == u'message':
+                    if body['id'] <= newer_than:
+                        continue
+                    newer_than = body['id']
+                relayed = dict(event, room_uuid=unicode(room_uuid))
+                for sink in self.sinks:
+                    sink.put(relayed)
@@ -0,0 +1,245 @@
+# encoding: utf-8
+"""部屋のメッセージ履歴の全文検索
+
+メッセージを SQLite の FTS5 インデックスに保存し、差分だけを取得して更新します。
+日本語を検索できるよう、SQLite が対応していれば trigram トークナイザを使います。
+
+.. code-block:: python
+
+   index = bocco.search.SearchIndex('search.db')
+   index.update(api, room['uuid'])
+   for hit in index.search(u'ただいま', room_uuid=room['uuid']):
+       print(hit['date'], hit['nickname'], hit['text'])
+"""
+from __future__ import absolute_import
+import os
+import sqlite3
+import sys
+import threading
+import uuid
+
+try:
+    from typing import Any, Dict, List, Optional, Union
+except:
+    pass
+
+import arrow
+
+from .api import Client
+from .models import MessageMedia
+
+if (3, 0) <= sys.version_info:
+    unicode = str
+
+#: 既定のインデックスファイル
+SEARCH_INDEX_PATH = os.path.join(os.path.expanduser('~'), '.bocco', 'search.db')
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    room_uuid TEXT NOT NULL,
+    sender TEXT NOT NULL,
+    nickname TEXT NOT NULL,
+    media TEXT NOT NULL,
+    date REAL NOT NULL,
+    text TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_room_date ON messages (room_uuid, date);
+CREATE TABLE IF NOT EXISTS rooms (
+    room_uuid TEXT PRIMARY KEY,
+    oldest_id INTEGER NOT NULL,
+    newest_id INTEGER NOT NULL,
+    complete INTEGER NOT NULL DEFAULT 0
+);
+CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts (rowid, text) VALUES (new.id, new.text);
+END;
+'''
+
+_FTS_TABLE = '''
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts
+USING fts5(text, content='messages', content_rowid='id', tokenize='{0}')
+'''
+
+
+class SearchIndex(object):
+    """メッセージの全文検索インデックス
+
+    1 つのファイルに複数の部屋のメッセージを保存できます。
+    スレッド間で共有できます。
+    """
+
+    def __init__(self, path=SEARCH_INDEX_PATH):
+        # type: (str) -> None
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        try:
+            self._db.execute(_FTS_TABLE.format('trigram'))
+            self.tokenizer = 'trigram'
+        except sqlite3.OperationalError as e:
+            if 'fts5' in unicode(e):
+                raise RuntimeError(u'SQLite is built without FTS5')
+            # trigram は SQLite 3.34 以降
+            self._db.execute(_FTS_TABLE.format('unicode61'))
+            self.tokenizer = 'unicode61'
+        self._db.executescript(_SCHEMA)
+        self._db.commit()
+
+    def close(self):
+        # type: () -> None
+        self._db.close()
+
+    def _insert(self, room_uuid, messages):
+        # type: (uuid.UUID, List[Dict[str, Any]]) -> int
+        rows = [(m['id'],
+                 unicode(room_uuid),
+                 m['sender'],
+                 (m.get('user') or {}).get('nickname') or u'',
+                 m['media'],
+                 arrow.get(m['date']).float_timestamp,
+                 m['text'] or u'') for m in messages]
+        cursor = self._db.executemany('INSERT OR IGNORE INTO messages VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+        return cursor.rowcount
+
+    def _room_state(self, room_uuid):
+        # type: (uuid.UUID) -> Optional[tuple]
+        return self._db.execute('SELECT oldest_id, newest_id, complete FROM rooms WHERE room_uuid = ?',
+                                (unicode(room_uuid),)).fetchone()
+
+    def is_complete(self, room_uuid):
+        # type: (uuid.UUID) -> bool
+        """部屋の最も古いメッセージまでインデックスに追加済みか"""
+        with self._lock:
+            state = self._room_state(room_uuid)
+        return state is not None and bool(state[2])
+
+    def _save_page(self, room_uuid, messages, complete=False):
+        # type: (uuid.UUID, List[Dict[str, Any]], bool) -> int
+        with self._lock:
+            added = self._insert(room_uuid, messages)
+            ids = [m['id'] for m in messages]
+            state = self._room_state(room_uuid)
+            if state is None:
+                self._db.execute('INSERT INTO rooms VALUES (?, ?, ?, ?)',
+                                 (unicode(room_uuid), min(ids), max(ids), int(complete)))
+            else:
+                oldest, newest, done = state
+                if ids:
+                    oldest = min([oldest] + ids)
+                    newest = max([newest] + ids)
+                self._db.execute('UPDATE rooms SET oldest_id = ?, newest_id = ?, complete = ? '
+                                 'WHERE room_uuid = ?',
+                                 (oldest, newest, int(done or complete), unicode(room_uuid)))
+            self._db.commit()
+        return added
+
+    def update(self, client, room_uuid, backfill=True):
+        # type: (Client, uuid.UUID, bool) -> int
+        """部屋の新しいメッセージをインデックスに追加する
+
+        前回の更新以降のメッセージだけを取得します。
+        ``backfill`` が真なら、まだ取得していない古いメッセージも最後まで遡ります。
+        途中で中断しても、次回は続きから取得します。
+        API がエラーを返した場合は :class:`requests.HTTPError` を投げます (取得済みの分は保存されます)。
+
+        :return: 追加したメッセージの数
+        """
+        with self._lock:
+            state = self._room_state(room_uuid)
+        added = 0
+        if state is None:
+            page = client._get_messages_data(room_uuid, check=True)
+            if not page:
+                return 0
+            added += self._save_page(room_uuid, page)
+        while True:
+            with self._lock:
+                newest = self._room_state(room_uuid)[1]  # type: ignore
+            page = client._get_messages_data(room_uuid, newer_than=newest, check=True)
+            page = [m for m in page if newest < m['id']]
+            if not page:
+                break
+            added += self._save_page(room_uuid, page)
+        while backfill:
+            with self._lock:
+                oldest, _, complete = self._room_state(room_uuid)  # type: ignore
+            if complete:
+                break
+            page = client._get_messages_data(room_uuid, older_than=oldest, check=True)
+            page = [m for m in page if m['id'] < oldest]
+            added += self._save_page(room_uuid, page, complete=not page)
+        return added
+
+    def search(self,
+               query,
+               room_uuid=None,
+               sender=None,
+               media=None,
+               since=None,
+               until=None,
+               limit=50):
+        # type: (str, Optional[uuid.UUID], Optional[str], Optional[MessageMedia], Any, Any, int) -> List[Dict[str, Any]]
+        """メッセージを検索し、新しい順に返す
+
+        :param query: 検索語。空ならフィルタだけで検索します
+        :param room_uuid: 部屋
+        :param sender: 送信者の UUID またはニックネーム
+        :param media: メッセージのメディア
+        :param since: この日時以降 (:func:`arrow.get` が受け付ける値)
+        :param until: この日時より前
+        :param limit: 最大件数
+        """
+        where = []  # type: List[str]
+        params = []  # type: List[Any]
+        table = 'messages m'
+        if query and (self.tokenizer != 'trigram' or 3 <= len(query)):
+            table = 'messages_fts f JOIN messages m ON m.id = f.rowid'
+            where.append('messages_fts MATCH ?')
+            params.append(u'"{0}"'.format(query.replace(u'"', u'""')))
+        elif query:
+            # trigram は 3 文字未満の語を検索できないので、部分一致で探す
+            where.append("m.text LIKE ? ESCAPE '\\'")
+            params.append(u'%{0}%'.format(
+                query.replace(u'\\', u'\\\\').replace(u'%', u'\\%').replace(u'_', u'\\_')))
+        if room_uuid is not None:
+            where.append('m.room_uuid = ?')
+            params.append(unicode(room_uuid))
+        if sender:
+            where.append('(m.sender = ? OR m.nickname = ?)')
+            params.extend([unicode(sender), unicode(sender)])
+        if media is not None:
+            where.append('m.media = ?')
+            params.append(media.value)
+        if since is not None:
+            where.append('? <= m.date')
+            params.append(arrow.get(since).float_timestamp)
+        if until is not None:
+            where.append('m.date < ?')
+            params.append(arrow.get(until).float_timestamp)
+        sql = 'SELECT m.id, m.room_uuid, m.sender, m.nickname, m.media, m.date, m.text FROM {0}'.format(table)
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY m.id DESC LIMIT ?'
+        params.append(limit)
+        with self._lock:
+            rows = self._db.execute(sql, params).fetchall()
+        return [{'id': row[0],
+                 'room_uuid': uuid.UUID(row[1]),
+                 'sender': uuid.UUID(row[2]),
+                 'nickname': row[3],
+                 'media': _media(row[4]),
+                 'date': arrow.get(row[5]),
+                 'text': row[6]} for row in rows]
+
+
+def _media(value):
+    # type: (str) -> MessageMedia
+    try:
+        return MessageMedia(value)
+    except ValueError:
+        return MessageMedia.unknown
@@ -0,0 +1,146 @@
+# encoding: utf-8
+"""モデルのバイナリスナップショット
+
+:mod:`bocco.models` のオブジェクトのリストを `msgpack <https://msgpack.org/>`_ で保存します。
+UUID と日時は msgpack の拡張型で保存するため、読み込むときに文字列を解析し直さず、
+スキーマの検証も行いません。自分で保存した (信頼できる) スナップショットにだけ使ってください。
+
+``pip install bocco[snapshot]`` でインストールします。
+
+.. code-block:: python
+
+   with open('messages.msgpack', 'wb') as f:
+       f.write(bocco.snapshot.dumps(api.get_messages(room['uuid'])))
+   with open('messages.msgpack', 'rb') as f:
+       messages = bocco.snapshot.loads(f.read())
+"""
+from __future__ import absolute_import
+import datetime
+import json
+import struct
+import time
+import uuid
+from enum import Enum
+
+try:
+    from typing import Any, Dict, List, Type
+except:
+    pass
+
+import arrow
+from dateutil import tz
+
+from . import models
+from .models import _Model
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+#: スナップショットの形式のバージョン
+VERSION = 1
+
+#: スナップショットに保存できるモデル
+MODELS = dict((cls.__name__, cls) for cls in (models.User, models.RoomUser, models.Room, models.Message))
+
+_EXT_UUID = 1
+_EXT_DATETIME = 2
+_DATETIME = struct.Struct('>qi')
+_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=tz.tzutc())
+
+
+def _check():
+    # type: () -> None
+    if msgpack is None:
+        raise RuntimeError(u'msgpack is required for snapshots: pip install bocco[snapshot]')
+
+
+def _default(value):
+    # type: (Any) -> Any
+    if isinstance(value, _Model):
+        return value._data
+    if isinstance(value, uuid.UUID):
+        return msgpack.ExtType(_EXT_UUID, value.bytes)
+    if isinstance(value, arrow.Arrow):
+        # UTC からのマイクロ秒と、タイムゾーンのオフセット (秒)
+        delta = value.datetime - _EPOCH
+        micros = (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+        offset = value.utcoffset()
+        return msgpack.ExtType(_EXT_DATETIME, _DATETIME.pack(
+            micros, int(offset.total_seconds()) if offset is not None else 0))
+    if isinstance(value, Enum):
+        return value.value
+    raise TypeError(u'Cannot serialize {0!r}'.format(value))
+
+
+def _ext_hook(code, data):
+    # type: (int, bytes) -> Any
+    if code == _EXT_UUID:
+        return uuid.UUID(bytes=data)
+    if code == _EXT_DATETIME:
+        micros, offset = _DATETIME.unpack(data)
+        dt = _EPOCH + datetime.timedelta(microseconds=micros)
+        return arrow.Arrow.fromdatetime(dt.astimezone(tz.tzoffset(None, offset)))
+    return msgpack.ExtType(code, data)
+
+
+def dumps(items):
+    # type: (List[_Model]) -> bytes
+    """同じ種類のモデルのリストをスナップショットにする"""
+    _check()
+    name = type(items[0]).__name__ if items else 'Message'
+    if name not in MODELS or any(type(i) is not MODELS[name] for i in items):
+        raise TypeError(u'Snapshot must be a list of one of {0}'.format(', '.join(sorted(MODELS))))
+    return msgpack.packb({'version': VERSION, 'model': name, 'items': items},
+                         default=_default, use_bin_type=True)
+
+
+def loads(data):
+    # type: (bytes) -> List[_Model]
+    """スナップショットからモデルのリストを読み込む (検証しない)"""
+    _check()
+    snapshot = msgpack.unpackb(data, ext_hook=_ext_hook, raw=False)
+    if snapshot.get('version') != VERSION:
+        raise ValueError(u'Unsupported snapshot version: {0}'.format(snapshot.get('version')))
+    cls = MODELS[snapshot['model']]
+    return [cls.from_dict(item, validate=False) for item in snapshot['items']]
+
+
+def benchmark(count=1000, repeat=5):
+    # type: (int, int) -> Dict[str, float]
+    """API の JSON を検証して読み込む場合と、スナップショットから読み込む場合の時間を比べる
+
+    :mod:`bocco.fake` が生成した ``count`` 件のメッセージを使います。
+
+    :return: 方式ごとの最短時間 (秒)
+    """
+    from .fake import FakeServer
+    server = FakeServer(rooms=1, messages_per_room=count, page_size=count)
+    room_uuid = server.room_uuids[0]
+    with server.app.test_client() as client:
+        body = client.get('/rooms/{0}/messages'.format(room_uuid),
+                          query_string={'access_token': 'benchmark'}).data
+    items = [models.Message(m) for m in json.loads(body.decode('utf-8'))]
+    plain = json.dumps([m.to_dict() for m in items]).encode('utf-8')
+    snapshot = dumps(items)
+
+    def measure(f):
+        # type: (Any) -> float
+        best = float('inf')
+        for _ in range(repeat):
+            start = time.time()
+            f()
+            best = min(best, time.time() - start)
+        return best
+
+    return {
+        'count': count,
+        'json_bytes': len(body),
+        'snapshot_bytes': len(snapshot),
+        'json_validate': measure(lambda: [models.Message(m) for m in json.loads(body.decode('utf-8'))]),
+        'to_dict_from_dict': measure(lambda: [models.Message.from_dict(m, validate=False)
+                                              for m in json.loads(plain.decode('utf-8'))]),
+        'snapshot_dumps': measure(lambda: dumps(items)),
+        'snapshot_loads': measure(lambda: loads(snapshot)),
+    }
@@ -1,27 +1,88 @@
 # encoding: utf-8
 from __future__ import absolute_import
+import contextlib
+import io
+import json
 import os
 from uuid import UUID
 import hashlib
+import threading
+import time
+import tempfile
+import zlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
-from flask import Flask, send_from_directory, url_for, request, redirect
+try:
+    from typing import Any, Callable, Dict, List, Optional, Tuple
+except:
+    pass
 
-from .models import Room, UUIDSchema
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+from flask import Flask, send_from_directory, url_for, request, redirect, make_response, abort, g
+from markupsafe import escape
+from werkzeug.http import is_resource_modified
+
+from .models import Room, Message, MessageMedia, UUIDSchema
+from .search import SearchIndex
 from . import api
+from . import profiling
 
 
 #: Flask application
 app = Flask(__name__)
 app.api = None
+app.config.setdefault('ROOMS_CACHE_TTL', 5)
+app.config.setdefault('THUMBNAIL_SIZE', (400, 400))
+app.config.setdefault('THUMBNAIL_QUALITY', 80)
+app.config.setdefault('THUMBNAIL_WORKERS', 2)
+app.config.setdefault('THUMBNAIL_RETRY_INTERVAL', 3600)
+app.config.setdefault('SEARCH_INDEX', None)
+app.config.setdefault('PROFILE', False)
+app.config.setdefault('PROFILE_DIR', None)
+
+#: 1 ページに表示するメッセージ数
+MESSAGES_PER_PAGE = 10
+
+#: 検索結果の最大件数
+SEARCH_LIMIT = 50
+
+#: 新着メッセージを確認する間隔 (秒)
+REFRESH_INTERVAL = 10
+
+#: 圧縮して返す Content-Type
+COMPRESSIBLE_MIMETYPES = frozenset(['text/html', 'text/css', 'text/plain',
+                                    'application/json', 'application/javascript'])
+
+#: これより小さいレスポンスは圧縮しない (バイト)
+COMPRESS_MIN_SIZE = 512
+
+#: ``/assets/`` と ``/style.css`` の Cache-Control
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
 
 
 @app.route('/')
 def index():
-    out = []
     app.logger.debug(u'Getting rooms...')
-    rooms = app.api.get_rooms()
+    rooms = _get_rooms()
     template = u'<li><a href="/{room[uuid]}">{room[name]}</a></li>'
-    return CSS + u'<h1>ROOMS</h1>' + u''.join([template.format(room=r) for r in rooms])
+    return _conditional(
+        [(r['uuid'], r['name'], r['updated_at'], _last_message_id(r)) for r in rooms],
+        max([r['updated_at'] for r in rooms]) if rooms else None,
+        lambda: HEAD + u'<h1>ROOMS</h1>' + u''.join([template.format(room=r) for r in rooms]))
 
 
 @app.route('/favicon.ico')
@@ -33,7 +94,7 @@ def favicon():
 def room(uuid):
     uuid = UUIDSchema.validate(uuid)
     app.logger.debug(u'Getting room {0}...'.format(uuid))
-    rooms = app.api.get_rooms()
+    rooms = _get_rooms()
     room = None
     for item in rooms:
         if uuid == item['uuid']:
@@ -41,66 +102,126 @@ def room(uuid):
 
     if not room:
         return u'Room not found'
-    return CSS + u'''
+    search_form = u''
+    if app.config['SEARCH_INDEX']:
+        search_form = SEARCH_FORM.format(room=room)
+    return _conditional(
+        (room['uuid'], room['name'], room['updated_at'], _last_message_id(room), bool(search_form)),
+        room['updated_at'],
+        lambda: HEAD + u'''
       <a href="/">&lt;= Rooms</a>
       <h1>{room[name]}</h1>
+      {search_form}
       <form method="post" action="/{room[uuid]}/messages/send" target="messages">
         <textarea name="text" placeholder="message"></textarea>
         <input type="submit" value="Submit" />
       </form>
       <iframe name="messages" src="/{room[uuid]}/messages"></iframe>
-    '''.format(room=room)
+    '''.format(room=room, search_form=search_form))
 
 
 @app.route('/<uuid>/messages')
 def messages(uuid):
     uuid = UUIDSchema.validate(uuid)
     app.logger.debug(u'Getting messages in {0}...'.format(uuid))
-    messages = app.api.get_messages(uuid)
+    messages = _get_messages_page(uuid)
+    return _conditional(
+        _messages_validator(uuid, messages),
+        _last_message_date(messages),
+        lambda: HEAD + u'''
+      <table>
+        <thead>
+          <tr>
+            <th>User</th>
+            <th>Text</th>
+            <th>Audio</th>
+            <th>Image</th>
+            <th>Media</th>
+            <th>Date</th>
+          </tr>
+        </thead>
+        <tbody id="messages">{body}</tbody>
+      </table>'''.format(body=_render_messages(messages)) + SCRIPT.format(
+            rows_url=url_for('.message_rows', uuid=uuid),
+            interval=REFRESH_INTERVAL * 1000))
+
+
+@app.route('/<uuid>/messages/rows')
+def message_rows(uuid):
+    """メッセージ一覧の断片 (``<tr>`` の列) を返す
+
+    ``older_than`` / ``newer_than`` をカーソルとして 1 ページ分だけ取得する。
+    無限スクロールと新着メッセージのポーリングに使われる。
+    """
+    uuid = UUIDSchema.validate(uuid)
+    newer_than = request.args.get('newer_than', type=int)
+    older_than = request.args.get('older_than', type=int)
+    app.logger.debug(u'Getting messages in {0} (newer_than={1}, older_than={2})...'.format(
+                        uuid, newer_than, older_than))
+    messages = _get_messages_page(uuid, newer_than=newer_than, older_than=older_than)
+    return _conditional(
+        _messages_validator(uuid, messages),
+        _last_message_date(messages),
+        lambda: _render_messages(messages))
+
+
+@app.route('/<uuid>/search')
+def search(uuid):
+    """部屋のメッセージを全文検索する
+
+    ``SEARCH_INDEX`` にインデックスのパスが設定されている場合のみ使えます。
+    検索の前に、前回以降の新しいメッセージをインデックスに追加します。
+    古いメッセージはバックグラウンドで遡って追加し、終わるまでは結果が不完全であることを表示します。
+    """
+    uuid = UUIDSchema.validate(uuid)
+    index = _get_search_index()
+    if index is None:
+        abort(404)
+    query = request.args.get('q', u'').strip()
+    sender = request.args.get('sender', u'').strip() or None
+    media = None
+    if request.args.get('media'):
+        try:
+            media = MessageMedia(request.args['media'])
+        except ValueError:
+            abort(400)
+    app.logger.debug(u'Searching {0!r} in {1}...'.format(query, uuid))
+    index.update(app.api, uuid, backfill=False)
+    complete = index.is_complete(uuid)
+    if not complete:
+        _schedule_backfill(index, uuid)
+    hits = index.search(query, room_uuid=uuid, sender=sender, media=media, limit=SEARCH_LIMIT)
     template = u'''
         <tr>
-          <th>{user}</th>
-          <td>{message[text]}</td>
-          <td>{audio}</td>
-          <td>{image}</td>
-          <td>{message[media].name}</td>
+          <th>{nickname}</th>
+          <td>{text}</td>
+          <td>{hit[media].name}</td>
           <td>{date}</td>
         </tr>
     '''.strip()
-    items = []
-    for message in messages[-min(len(messages), 10):]:
-        image = audio = u''
-        user = message['user']['nickname']
-        if message['user']['icon']:
-            user = u'<img src="/assets/{0}" width="32" height="32" alt="{1}" title="{1}" />'.format(
-                        _get_assets_filename(message['user']['icon']),
-                        message['user']['nickname'])
-        if message['image']:
-            image = u'<img src="/assets/{0}" />'.format(_get_assets_filename(message['image']))
-        if message['audio']:
-            audio = u'<a href="/assets/{0}">{1}</a>'.format(
-                    _get_assets_filename(message['audio']),
-                    os.path.basename(message['audio']))
-        items.append(template.format(message=message,
-                                     date=message['date'].humanize(),
-                                     user=user,
-                                     image=image,
-                                     audio=audio))
-
-    return u'<head><meta http-equiv="refresh" content="10"></head>' + CSS + u'''
+    rows = [template.format(hit=hit,
+                            nickname=escape(hit['nickname']),
+                            text=escape(hit['text']),
+                            date=hit['date'].format('YYYY-MM-DD HH:mm')) for hit in hits]
+    return HEAD + u'''
+      <a href="{back}">&lt;= Messages</a>
+      <p>{count} results for "{query}"</p>
+      {notice}
       <table>
         <thead>
           <tr>
             <th>User</th>
             <th>Text</th>
-            <th>Audio</th>
-            <th>Image</th>
             <th>Media</th>
             <th>Date</th>
           </tr>
         </thead>
         <tbody>{body}</tbody>
-      </table>'''.format(uuid=uuid, body=''.join(items))
+      </table>'''.format(back=url_for('.messages', uuid=uuid),
+                           count=len(hits),
+                           query=escape(query),
+                           notice=u'' if complete else INCOMPLETE_NOTICE,
+                           body=u''.join(rows))
 
 
 @app.route('/<uuid>/messages/send', methods=['POST'])
@@ -113,24 +234,459 @@ def send(uuid):
 
 @app.route('/assets/<filename>')
 def assets(filename):
-    return send_from_directory(app.config['DOWNLOADS'], filename)
+    # ファイル名は URL のハッシュなので内容は変わらない
+    response = send_from_directory(app.config['DOWNLOADS'], filename)
+    response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+    return response
+
+
+@app.route('/style.css')
+def stylesheet():
+    # URL に CSS_VERSION が含まれるので内容は変わらない
+    response = make_response(CSS)
+    response.mimetype = 'text/css'
+    response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+    response.set_etag(CSS_VERSION, weak=True)
+    return response.make_conditional(request)
+
+
+@app.before_request
+def start_profile():
+    """``PROFILE`` が真ならリクエストをプロファイルする
+
+    フェーズの内訳を ``Server-Timing`` ヘッダーで返し、
+    ``PROFILE_DIR`` が設定されていれば cProfile とサンプリングの結果を保存する。
+    """
+    if app.config['PROFILE']:
+        if app.config['PROFILE_DIR']:
+            g.profiler = profiling.Profiler(all_threads=False)
+        else:
+            # 結果を保存しないので、フェーズだけを計測する
+            g.profiler = profiling.Profiler(cprofile=False, sample_interval=0, all_threads=False)
+        g.profiler.start()
+
+
+@app.after_request
+def finish_profile(response):
+    profiler = g.pop('profiler', None)
+    if profiler is None:
+        return response
+    profiler.stop()
+    response.headers['Server-Timing'] = profiler.server_timing()
+    if app.config['PROFILE_DIR']:
+        name = u'{0:.6f}-{1}'.format(time.time(), request.endpoint or u'unknown')
+        profiler.save(os.path.join(app.config['PROFILE_DIR'], name))
+    return response
+
+
+@app.teardown_request
+def abort_profile(exc):
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.stop()
+
+
+@app.after_request
+def compress(response):
+    """Accept-Encoding に応じて brotli または gzip で圧縮する
+
+    brotli は `brotli <https://pypi.org/project/Brotli/>`_ がインストールされている場合のみ使われる。
+    """
+    if (response.status_code != 200 or
+            response.direct_passthrough or
+            'Content-Encoding' in response.headers or
+            response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+    response.vary.add('Accept-Encoding')
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_SIZE:
+        return response
+    accept = request.accept_encodings
+    if brotli is not None and accept.quality('br'):
+        encoding = 'br'
+        data = brotli.compress(data)
+    elif accept.quality('gzip'):
+        encoding = 'gzip'
+        compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+        data = compressor.compress(data) + compressor.flush()
+    else:
+        return response
+    response.set_data(data)
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def _conditional(validator, last_modified, render):
+    # type: (Any, Optional[Any], Callable[[], str]) -> Any
+    """ETag (弱い ETag) / Last-Modified を付けたレスポンスを返す
+
+    ``validator`` から ETag を作り、クライアントのキャッシュが有効なら
+    ``render`` を呼ばずに 304 を返す。
+    """
+    etag = hashlib.md5(u'{0}:{1!r}'.format(CSS_VERSION, validator).encode('utf-8')).hexdigest()
+    if last_modified is not None:
+        last_modified = last_modified.datetime.replace(microsecond=0)
+    if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        response = make_response(u'', 304)
+    else:
+        with profiling.phase('render'):
+            body = render()
+        response = make_response(body)
+    # 同じ内容を gzip や brotli で圧縮して返すこともあるので、バイト列ではなく内容の同一性を表す弱い ETag にする
+    response.set_etag(etag, weak=True)
+    response.last_modified = last_modified
+    response.cache_control.no_cache = True
+    return response
+
+
+_rooms_cache = {'rooms': None, 'expires': 0.0}
+_rooms_cache_lock = threading.Lock()
+
+#: 全ワーカーで共有する部屋一覧のキャッシュ (``DOWNLOADS`` からの相対パス。``/assets`` からは見えない)
+ROOMS_CACHE_PATH = os.path.join('.cache', 'rooms.json')
+
+
+def _get_rooms():
+    # type: () -> List[Room]
+    """部屋一覧を ``ROOMS_CACHE_TTL`` 秒だけキャッシュして返す
+
+    キャッシュは ``DOWNLOADS`` のファイルで全ワーカーが共有し、
+    期限が切れたらロックを取った 1 つのワーカーだけが API を呼ぶ。
+    同じワーカーに同時に来たリクエストは 1 回の読み込みの結果を共有する。
+    """
+    ttl = app.config['ROOMS_CACHE_TTL']
+    with _rooms_cache_lock:
+        if _rooms_cache['rooms'] is None or _rooms_cache['expires'] <= time.time():
+            if app.config.get('DOWNLOADS'):
+                rooms, expires = _get_shared_rooms(os.path.join(app.config['DOWNLOADS'], ROOMS_CACHE_PATH), ttl)
+            else:
+                rooms, expires = app.api.get_rooms(), time.time() + ttl
+            _rooms_cache['rooms'] = rooms
+            _rooms_cache['expires'] = expires
+        return _rooms_cache['rooms']
+
+
+def _get_shared_rooms(path, ttl):
+    # type: (str, float) -> Tuple[List[Room], float]
+    """共有キャッシュの部屋一覧と有効期限を返す。期限切れなら API から取得して書き込む"""
+    rooms, expires = _read_shared_rooms(path, ttl)
+    if rooms is not None:
+        return rooms, expires
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # 他のワーカーが作った
+            pass
+    with _file_lock(path + '.lock'):
+        rooms, expires = _read_shared_rooms(path, ttl)
+        if rooms is not None:
+            return rooms, expires
+        rooms = app.api.get_rooms()
+        fd, tmppath = tempfile.mkstemp(dir=directory, suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(json.dumps([r.to_dict() for r in rooms]).encode('utf-8'))
+            os.rename(tmppath, path)
+        finally:
+            if os.path.exists(tmppath):
+                os.remove(tmppath)
+        return rooms, time.time() + ttl
+
+
+def _read_shared_rooms(path, ttl):
+    # type: (str, float) -> Tuple[Optional[List[Room]], float]
+    try:
+        expires = os.path.getmtime(path) + ttl
+        if expires <= time.time():
+            return None, 0.0
+        with io.open(path, 'r', encoding='utf-8') as f:
+            return [Room.from_dict(r) for r in json.load(f)], expires
+    except (IOError, OSError, ValueError):
+        return None, 0.0
+
+
+@contextlib.contextmanager
+def _file_lock(path):
+    """ワーカープロセス間の排他ロック (``fcntl`` がなければロックしない)"""
+    with open(path, 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        yield
+
+
+_search_index = None  # type: Optional[SearchIndex]
+_search_index_lock = threading.Lock()
+_backfill_executor = None  # type: Optional[ThreadPoolExecutor]
+_backfill_pending = set()  # type: set
+_backfill_lock = threading.Lock()
+
 
+def _get_search_index():
+    # type: () -> Optional[SearchIndex]
+    global _search_index
+    if not app.config['SEARCH_INDEX']:
+        return None
+    with _search_index_lock:
+        if _search_index is None:
+            _search_index = SearchIndex(app.config['SEARCH_INDEX'])
+        return _search_index
 
-def _get_assets_filename(url):
+
+def _schedule_backfill(index, uuid):
+    # type: (SearchIndex, UUID) -> None
+    """部屋の古いメッセージをインデックスに追加する処理をバックグラウンドで始める
+
+    ワーカープロセスごとに 1 つのスレッドで部屋を順に処理し、同じ部屋を二重に投入しない。
+    失敗した場合は次の検索でまた続きから取得する。
+    """
+    global _backfill_executor
+    with _backfill_lock:
+        if uuid in _backfill_pending:
+            return
+        if _backfill_executor is None:
+            _backfill_executor = ThreadPoolExecutor(max_workers=1)
+        future = _backfill_executor.submit(index.update, app.api, uuid)
+        _backfill_pending.add(uuid)
+
+    def done(future):
+        with _backfill_lock:
+            _backfill_pending.discard(uuid)
+        if future.exception() is not None:
+            app.logger.warning(u'Cannot index the history of {0}: {1!r}'.format(uuid, future.exception()))
+    future.add_done_callback(done)
+
+
+def _last_message_id(room):
+    # type: (Room) -> int
+    if not room['messages']:
+        return 0
+    return max([m['id'] for m in room['messages']])
+
+
+def _messages_validator(uuid, messages):
+    # type: (UUID, List[Message]) -> Any
+    # 縮小画像ができると HTML が変わるので、その有無も含める
+    thumbnails = [m['id'] for m in messages
+                  if m['image'] and os.path.isfile(os.path.join(
+                      app.config['DOWNLOADS'], _thumbnail_filename(_assets_filename(m['image']))))]
+    return (uuid, [m['id'] for m in messages], thumbnails)
+
+
+def _last_message_date(messages):
+    # type: (List[Message]) -> Optional[Any]
+    if not messages:
+        return None
+    return max([m['date'] for m in messages])
+
+
+def _get_messages_page(uuid, newer_than=None, older_than=None):
+    # type: (UUID, Optional[int], Optional[int]) -> List[Message]
+    messages = app.api.get_messages(uuid, newer_than=newer_than, older_than=older_than)
+    messages = sorted(messages, key=lambda m: m['id'])
+    if newer_than is None:
+        # 新しい方から 1 ページ分
+        return messages[-MESSAGES_PER_PAGE:]
+    return messages[:MESSAGES_PER_PAGE]
+
+
+def _render_messages(messages):
+    # type: (List[Message]) -> str
+    template = u'''
+        <tr data-id="{message[id]}">
+          <th>{user}</th>
+          <td>{message[text]}</td>
+          <td>{audio}</td>
+          <td>{image}</td>
+          <td>{message[media].name}</td>
+          <td>{date}</td>
+        </tr>
+    '''.strip()
+    items = []
+    for message in messages:
+        image = audio = u''
+        user = message['user']['nickname']
+        if message['user']['icon']:
+            user = u'<img src="/assets/{0}" width="32" height="32" alt="{1}" title="{1}" />'.format(
+                        _get_assets_filename(message['user']['icon']),
+                        message['user']['nickname'])
+        if message['image']:
+            original = _get_assets_filename(message['image'], thumbnail=True)
+            image = u'<a href="/assets/{0}" target="_blank"><img src="/assets/{1}" /></a>'.format(
+                    original,
+                    _get_thumbnail_filename(original) or original)
+        if message['audio']:
+            audio = u'<a href="/assets/{0}">{1}</a>'.format(
+                    _get_assets_filename(message['audio']),
+                    os.path.basename(message['audio']))
+        items.append(template.format(message=message,
+                                     date=message['date'].humanize(),
+                                     user=user,
+                                     image=image,
+                                     audio=audio))
+    return u''.join(items)
+
+
+def _assets_filename(url):
+    # type: (str) -> str
     md5 = hashlib.md5()
     md5.update(url.encode('utf-8'))
     digest = md5.hexdigest()
     _, ext = os.path.splitext(url)
-    filename = digest + ext
+    return digest + ext
+
+
+def _get_assets_filename(url, thumbnail=False):
+    # type: (str, bool) -> str
+    filename = _assets_filename(url)
     filepath = os.path.join(app.config['DOWNLOADS'], filename)
     if not os.path.isfile(filepath):
         app.logger.debug(u'Downloading {0}...'.format(url))
-        app.api.download(url, filepath)
+        # 他のワーカーが書きかけのファイルを返さないよう、一時ファイルから rename する
+        fd, tmppath = tempfile.mkstemp(dir=app.config['DOWNLOADS'], suffix='.part')
+        os.close(fd)
+        try:
+            app.api.download(url, tmppath)
+            os.rename(tmppath, filepath)
+        finally:
+            if os.path.exists(tmppath):
+                os.remove(tmppath)
+        if thumbnail:
+            _schedule_thumbnail(filename)
     return filename
 
 
+_thumbnail_executor = None  # type: Optional[ProcessPoolExecutor]
+_thumbnail_pending = {}  # type: Dict[str, Any]
+_thumbnail_failures = {}  # type: Dict[str, float]
+_thumbnail_lock = threading.Lock()
+
+
+def _thumbnail_filename(filename):
+    # type: (str) -> str
+    return os.path.splitext(filename)[0] + '.thumb.jpg'
+
+
+def _get_thumbnail_filename(filename):
+    # type: (str) -> Optional[str]
+    """縮小画像のファイル名を返す
+
+    まだ作成されていなければ作成を予約して ``None`` を返す。
+    """
+    if Image is None:
+        return None
+    thumbnail = _thumbnail_filename(filename)
+    if os.path.isfile(os.path.join(app.config['DOWNLOADS'], thumbnail)):
+        return thumbnail
+    _schedule_thumbnail(filename)
+    return None
+
+
+def _schedule_thumbnail(filename):
+    # type: (str) -> None
+    """縮小画像の作成をプロセスプールに投入する
+
+    ワーカープロセスごとにプールを持ち、同じ画像を二重に投入しない。
+    作成に失敗した画像 (壊れた画像など) は ``THUMBNAIL_RETRY_INTERVAL`` 秒経つまで投入しない。
+    """
+    global _thumbnail_executor
+    if Image is None:
+        return
+    thumbnail = _thumbnail_filename(filename)
+    with _thumbnail_lock:
+        if thumbnail in _thumbnail_pending:
+            return
+        failed_at = _thumbnail_failures.get(thumbnail)
+        if failed_at is not None and time.time() < failed_at + app.config['THUMBNAIL_RETRY_INTERVAL']:
+            return
+        if _thumbnail_executor is None:
+            _thumbnail_executor = ProcessPoolExecutor(max_workers=app.config['THUMBNAIL_WORKERS'])
+        downloads = app.config['DOWNLOADS']
+        future = _thumbnail_executor.submit(
+                _make_thumbnail,
+                os.path.join(downloads, filename),
+                os.path.join(downloads, thumbnail),
+                tuple(app.config['THUMBNAIL_SIZE']),
+                app.config['THUMBNAIL_QUALITY'])
+        _thumbnail_pending[thumbnail] = future
+
+    def done(future):
+        with _thumbnail_lock:
+            del _thumbnail_pending[thumbnail]
+            if future.exception() is None:
+                _thumbnail_failures.pop(thumbnail, None)
+            else:
+                _thumbnail_failures[thumbnail] = time.time()
+        if future.exception() is not None:
+            app.logger.warning(u'Cannot make a thumbnail of {0}: {1!r}'.format(filename, future.exception()))
+    future.add_done_callback(done)
+
+
+def _make_thumbnail(src, dest, size, quality):
+    # type: (str, str, Tuple[int, int], int) -> None
+    """``src`` を ``size`` に収まるよう縮小して JPEG で ``dest`` に保存する
+
+    プロセスプールで実行されるため、モジュールレベルの関数にしている。
+    """
+    image = Image.open(src)
+    image.thumbnail(size, Image.LANCZOS)
+    if image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(dest), suffix='.part')
+    os.close(fd)
+    try:
+        image.save(tmppath, 'JPEG', quality=quality, optimize=True, progressive=True)
+        os.rename(tmppath, dest)
+    finally:
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+
+
+def serve(host='127.0.0.1', port=5000, workers=2, threads=4, timeout=30, graceful_timeout=30):
+    # type: (str, int, int, int, int, int) -> None
+    """gunicorn で :data:`app` を起動する
+
+    ``workers`` 個のプロセスそれぞれで ``threads`` 個のスレッドがリクエストを処理する。
+    ``timeout`` は gunicorn のワーカーの死活監視の秒数で、この間マスターに応答しないワーカーは再起動される。
+    gthread ワーカーではスレッドが処理中でも応答は続くので、1 つのリクエストの時間は制限されない。
+    API を待つ時間は :class:`~bocco.api.Client` の ``timeout`` で制限する。
+    マスタープロセスに ``SIGHUP`` を送るとワーカーを順に入れ替える (graceful reload)。
+
+    メディアのキャッシュ (縮小画像を含む) は ``DOWNLOADS`` ディレクトリを全ワーカーで共有する。
+    部屋一覧も ``DOWNLOADS`` のファイルで ``ROOMS_CACHE_TTL`` 秒共有し、期限切れのときに 1 つのワーカーだけが取得する。
+
+    .. note::
+
+       `gunicorn <http://gunicorn.org>`_ が必要です (``pip install bocco[server]``)。
+    """
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        raise RuntimeError(u'gunicorn is required: pip install bocco[server]')
+
+    class Application(BaseApplication):
+
+        def load_config(self):
+            options = {
+                'bind': '{0}:{1}'.format(host, port),
+                'workers': workers,
+                'threads': threads,
+                'worker_class': 'gthread',
+                'timeout': timeout,
+                'graceful_timeout': graceful_timeout,
+                'preload_app': True,
+            }
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return app
+
+    Application().run()
+
+
 CSS = u'''
-<style>
 body {
   max-width: 800px;
   margin-left: auto;
@@ -152,7 +708,7 @@ tr {
   background-color: #eee;
   border: 2px solid #fff;
 }
-image {
+img {
   max-width: 200px;
 }
 th, td {
@@ -175,11 +731,98 @@ form input[type=submit] {
   font-size: 2rem;
   margin-top: .5rem;
 }
+form.search {
+  margin-bottom: .5rem;
+}
+form.search input[type=submit] {
+  display: inline;
+  font-size: 1rem;
+  margin-top: 0;
+}
 textarea {
   font-size: 1.5rem;
   display: block;
   width: 100%;
   height: 4rem;
 }
-</style>
+'''
+
+INCOMPLETE_NOTICE = u'<p>Older messages are still being indexed. Results may be incomplete.</p>'
+
+SEARCH_FORM = u'''
+      <form method="get" action="/{room[uuid]}/search" target="messages" class="search">
+        <input type="search" name="q" placeholder="search" />
+        <input type="text" name="sender" placeholder="sender" />
+        <select name="media">
+          <option value="">all</option>
+          <option value="text">text</option>
+          <option value="audio">audio</option>
+          <option value="image">image</option>
+          <option value="stamp">stamp</option>
+        </select>
+        <input type="submit" value="Search" />
+      </form>
+'''
+
+CSS_VERSION = hashlib.md5(CSS.encode('utf-8')).hexdigest()[:12]
+
+HEAD = u'<link rel="stylesheet" href="/style.css?v={0}" />'.format(CSS_VERSION)
+
+# 上端までスクロールしたら古いメッセージを、一定間隔で新しいメッセージを読み込む
+SCRIPT = u'''
+<script>
+(function () {{
+  var rowsUrl = '{rows_url}';
+  var tbody = document.getElementById('messages');
+  var loading = false;
+  var exhausted = false;
+
+  function edgeId(last) {{
+    var rows = tbody.getElementsByTagName('tr');
+    if (rows.length === 0) {{ return null; }}
+    return rows[last ? rows.length - 1 : 0].getAttribute('data-id');
+  }}
+
+  function fetchRows(query, callback) {{
+    var xhr = new XMLHttpRequest();
+    xhr.open('GET', rowsUrl + '?' + query);
+    xhr.onload = function () {{
+      if (xhr.status === 200) {{ callback(xhr.responseText); }}
+    }};
+    xhr.send();
+  }}
+
+  function loadOlder() {{
+    var id = edgeId(false);
+    if (loading || exhausted || id === null) {{ return; }}
+    loading = true;
+    fetchRows('older_than=' + id, function (html) {{
+      loading = false;
+      if (!html) {{ exhausted = true; return; }}
+      var height = document.body.scrollHeight;
+      tbody.insertAdjacentHTML('afterbegin', html);
+      window.scrollBy(0, document.body.scrollHeight - height);
+      fillViewport();
+    }});
+  }}
+
+  function fillViewport() {{
+    if (document.body.scrollHeight <= window.innerHeight) {{ loadOlder(); }}
+  }}
+
+  function loadNewer() {{
+    var id = edgeId(true);
+    fetchRows(id === null ? '' : 'newer_than=' + id, function (html) {{
+      if (html) {{ tbody.insertAdjacentHTML('beforeend', html); }}
+    }});
+  }}
+
+  window.addEventListener('scroll', function () {{
+    if (window.scrollY <= 0) {{ loadOlder(); }}
+  }});
+  window.scrollTo(0, document.body.scrollHeight);
+  fillViewport();
+  setInterval(loadNewer, {interval});
+}})();
+</script>
 '''
@@ -24,7 +24,19 @@ setup(
         'click>=6.6',
         'enum34>=1.1.6',
         'Flask>=0.11.1',
+        'futures>=3.0; python_version < "3"',
         'requests>=2.12.3',
         'schema>=0.6.5',
     ],
+    extras_require={
+        'brotli': ['brotli'],
+        'server': ['gunicorn>=19.7'],
+        'thumbnail': ['Pillow'],
+        'parquet': ['pyarrow'],
+        'http2': ['httpx[http2]'],
+        'snapshot': ['msgpack>=0.6'],
+    },
+    entry_points={
+        'console_scripts': ['bocco = bocco.daemon:main'],
+    },
 )
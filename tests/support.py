@@ -0,0 +1,68 @@
+# encoding: utf-8
+"""テストで使うフェイクサーバ"""
+from __future__ import absolute_import
+import logging
+import threading
+
+try:
+    from typing import Any, List
+except:
+    pass
+
+from flask import jsonify, request
+from werkzeug.serving import make_server
+
+from bocco.fake import FakeServer
+
+logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+
+class RunningServer(object):
+    """:class:`~bocco.fake.FakeServer` を別スレッドで起動する
+
+    受け付けたリクエストのパスとクエリを :attr:`requests` に記録します。
+    ``kwargs`` は :class:`~bocco.fake.FakeServer` に渡されます。
+    """
+
+    def __init__(self, **kwargs):
+        # type: (**Any) -> None
+        self.fake = FakeServer(**kwargs)
+        self.requests = []  # type: List[str]
+        self._failures = []  # type: List[List[Any]]
+        self._lock = threading.Lock()
+        # 認証やエラーの注入より先に記録する
+        self.fake.app.before_request_funcs.setdefault(None, []).insert(0, self._before_request)
+        self._server = make_server('127.0.0.1', 0, self.fake.app, threaded=True)
+        self.url = 'http://127.0.0.1:{0}'.format(self._server.server_port)
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _before_request(self):
+        path = request.full_path
+        with self._lock:
+            self.requests.append(path)
+            for failure in self._failures:
+                if 0 < failure[0] and failure[1] in path:
+                    failure[0] -= 1
+                    response = jsonify({'code': 500, 'message': u'Injected error'})
+                    response.status_code = 500
+                    return response
+        return None
+
+    def fail(self, count, match):
+        # type: (int, str) -> None
+        """パスとクエリに ``match`` を含む次の ``count`` 個のリクエストを 500 にする"""
+        with self._lock:
+            self._failures.append([count, match])
+
+    def count(self, match):
+        # type: (str) -> int
+        """パスとクエリに ``match`` を含むリクエストの数"""
+        with self._lock:
+            return len([path for path in self.requests if match in path])
+
+    def close(self):
+        # type: () -> None
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,84 @@
+# encoding: utf-8
+from __future__ import absolute_import
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import requests
+
+from bocco.api import Client, SessionManager
+from support import RunningServer
+
+
+class SessionManagerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = RunningServer(rooms=1, messages_per_room=5, access_tokens=[])
+        self.addCleanup(self.server.close)
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.cache_path = os.path.join(directory, 'session.json')
+
+    def manager(self):
+        return SessionManager('key', 'test@example.com', 'pass', self.cache_path, base_url=self.server.url)
+
+    def test_session_is_cached(self):
+        Client.from_session_manager(self.manager()).get_rooms()
+        Client.from_session_manager(self.manager()).get_rooms()
+        self.assertEqual(self.server.count('/sessions'), 1)
+
+    def test_expired_token_is_refreshed_and_request_replayed(self):
+        client = Client.from_session_manager(self.manager())
+        stale = client.access_token
+        self.server.fake.access_tokens.discard(stale)
+
+        self.assertEqual(len(client.get_rooms()), 1)
+        self.assertNotEqual(client.access_token, stale)
+        self.assertEqual(self.server.count('/sessions'), 2)
+        # 401 になったリクエストと、やり直したリクエスト
+        self.assertEqual(self.server.count('/rooms/joined'), 2)
+        with io.open(self.cache_path, 'r', encoding='utf-8') as f:
+            self.assertEqual(json.load(f)['access_token'], client.access_token)
+
+    def test_concurrent_401s_sign_in_once(self):
+        manager = self.manager()
+        clients = [Client.from_session_manager(manager) for _ in range(4)]
+        self.server.fake.access_tokens.discard(manager.session['access_token'])
+
+        results = []
+        threads = [threading.Thread(target=lambda c=c: results.append(len(c.get_rooms()))) for c in clients]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [1] * 4)
+        self.assertEqual(self.server.count('/sessions'), 2)
+        for client in clients:
+            self.assertEqual(client.access_token, manager.session['access_token'])
+
+
+class PagingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = RunningServer(rooms=1, messages_per_room=100, page_size=20)
+        self.addCleanup(self.server.close)
+        self.client = Client('token', base_url=self.server.url)
+        self.room_uuid = self.server.fake.room_uuids[0]
+
+    def test_recent_messages_fetch_only_needed_pages(self):
+        messages = self.client.get_recent_messages(self.room_uuid, 30)
+        self.assertEqual([m['id'] for m in messages], list(range(71, 101)))
+        self.assertEqual(self.server.count('/messages'), 2)
+
+    def test_error_page_is_not_the_end_of_history(self):
+        self.server.fail(1, 'older_than=')
+        with self.assertRaises(requests.HTTPError):
+            list(self.client._iter_messages_data(self.room_uuid))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+# encoding: utf-8
+from __future__ import absolute_import
+import unittest
+
+import requests
+
+from bocco.api import Client
+from bocco.backfill import Backfill
+from support import RunningServer
+
+
+class BackfillTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = RunningServer(rooms=20, messages_per_room=60, page_size=20)
+        self.addCleanup(self.server.close)
+        self.client = Client('token', base_url=self.server.url)
+        self.room_uuids = self.server.fake.room_uuids
+
+    def test_backfill(self):
+        ids = {}
+        for room_uuid, messages in Backfill(self.client, self.room_uuids, io_workers=4, decode_workers=2):
+            ids.setdefault(room_uuid, []).extend(m['id'] for m in messages)
+        self.assertEqual(sorted(ids), sorted(self.room_uuids))
+        for room_ids in ids.values():
+            self.assertEqual(len(set(room_ids)), 60)
+            self.assertEqual(room_ids, sorted(room_ids, reverse=True))
+
+    def test_max_pages(self):
+        pages = list(Backfill(self.client, self.room_uuids, io_workers=4, decode_workers=0, max_pages=1))
+        self.assertEqual(len(pages), 20)
+        self.assertEqual(self.server.count('/messages'), 20)
+
+    def test_close_skips_queued_rooms(self):
+        backfill = iter(Backfill(self.client, self.room_uuids, io_workers=4, decode_workers=0, max_pending_pages=1))
+        next(backfill)
+        backfill.close()
+        # 取得中だったものを除き、待っていた部屋には問い合わせない
+        self.assertLessEqual(self.server.count('/messages'), 4 + 2)
+
+    def test_error_page_raises(self):
+        self.server.fail(1, 'older_than=')
+        with self.assertRaises(requests.HTTPError):
+            list(Backfill(self.client, self.room_uuids[:1], io_workers=1, decode_workers=0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+# encoding: utf-8
+from __future__ import absolute_import
+import io
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+from bocco import daemon
+from support import RunningServer
+
+
+class DaemonTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.socket_path = os.path.join(self.directory, 'daemon.sock')
+
+    def serve(self, **kwargs):
+        thread = threading.Thread(target=daemon.serve, args=(self.socket_path,), kwargs=kwargs)
+        thread.daemon = True
+        thread.start()
+        for _ in range(100):
+            if os.path.exists(self.socket_path):
+                break
+            time.sleep(0.05)
+        self.addCleanup(thread.join, 5.0)
+        self.addCleanup(daemon.stop, self.socket_path)
+
+    def test_stalled_daemon_is_not_waited_for(self):
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.addCleanup(server.close)
+        server.bind(self.socket_path)
+        server.listen(1)
+
+        start = time.time()
+        self.assertIsNone(daemon.forward(['rooms'], self.socket_path, timeout=0.5))
+        self.assertLess(time.time() - start, 2.0)
+
+    def test_api_calls_time_out(self):
+        upstream = RunningServer(rooms=1, messages_per_room=1, latency=3.0)
+        self.addCleanup(upstream.close)
+        config = os.path.join(self.directory, 'config.json')
+        with io.open(config, 'w', encoding='utf-8') as f:
+            f.write(json.dumps({'access_token': 'token', 'debug': False, 'downloads': self.directory,
+                                'base_url': upstream.url}, ensure_ascii=False))
+        self.serve(api_timeout=0.5)
+
+        start = time.time()
+        code = daemon.forward(['--config', config, 'rooms'], self.socket_path, timeout=10.0)
+        self.assertEqual(code, 1)
+        self.assertLess(time.time() - start, 2.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,12 @@
+# encoding: utf-8
+"""モジュールの doctest を unittest から実行する"""
+from __future__ import absolute_import
+import doctest
+
+from bocco import bench, daemon, export, models
+
+
+def load_tests(loader, tests, ignore):
+    for module in (bench, daemon, export, models):
+        tests.addTests(doctest.DocTestSuite(module))
+    return tests
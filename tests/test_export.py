@@ -0,0 +1,70 @@
+# encoding: utf-8
+from __future__ import absolute_import
+import gzip
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import requests
+
+from bocco.api import Client
+from bocco import export
+from bocco.export import export_room
+from support import RunningServer
+
+
+class ExportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = RunningServer(rooms=1, messages_per_room=200, page_size=20)
+        self.addCleanup(self.server.close)
+        self.client = Client('token', base_url=self.server.url)
+        self.room_uuid = self.server.fake.room_uuids[0]
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def read_ids(self, path):
+        opener = gzip.open if path.endswith('.gz') else io.open
+        with opener(path, 'rb') as f:
+            return [json.loads(line.decode('utf-8'))['id'] for line in f]
+
+    def test_export(self):
+        path = os.path.join(self.directory, 'messages.ndjson')
+        self.assertEqual(export_room(self.client, self.room_uuid, path), 200)
+        self.assertEqual(self.read_ids(path), list(range(200, 0, -1)))
+        self.assertFalse(os.path.exists(path + '.checkpoint'))
+
+    def test_failed_export_keeps_checkpoint_and_resumes(self):
+        for name in ('messages.ndjson', 'messages.ndjson.gz'):
+            path = os.path.join(self.directory, name)
+            # 5 ページ (ID 200〜101) を書いたところで失敗させる
+            self.server.fail(1, 'older_than=101&')
+            with self.assertRaises(requests.HTTPError):
+                export_room(self.client, self.room_uuid, path, checkpoint_pages=2)
+            self.assertTrue(os.path.exists(path + '.checkpoint'))
+            self.assertEqual(self.read_ids(path), list(range(200, 100, -1)))
+
+            count = export_room(self.client, self.room_uuid, path, resume=True, checkpoint_pages=2)
+            self.assertEqual(count, 200)
+            self.assertEqual(self.read_ids(path), list(range(200, 0, -1)))
+            self.assertFalse(os.path.exists(path + '.checkpoint'))
+
+    @unittest.skipIf(export.pyarrow is None, 'pyarrow is not installed')
+    def test_failed_parquet_export_is_removed(self):
+        path = os.path.join(self.directory, 'messages.parquet')
+        self.server.fail(1, 'older_than=101&')
+        with self.assertRaises(requests.HTTPError):
+            export_room(self.client, self.room_uuid, path)
+        # 途中までのファイルを完全なものとして残さない
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(os.path.exists(path + '.checkpoint'))
+
+        self.assertEqual(export_room(self.client, self.room_uuid, path), 200)
+        self.assertEqual(export.pyarrow.parquet.read_table(path).num_rows, 200)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+# encoding: utf-8
+from __future__ import absolute_import
+import time
+import unittest
+
+from bocco import http2
+from bocco.pool import ClientPool
+from support import RunningServer
+
+
+class ClientPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = RunningServer(rooms=2, messages_per_room=5, long_poll_timeout=2.0)
+        self.addCleanup(self.server.close)
+
+    def check_subscribe_does_not_block(self, transport):
+        pool = ClientPool(workers=1, threads_per_worker=1, subscribe_threads=2,
+                          base_url=self.server.url, transport=transport)
+        self.addCleanup(pool.shutdown)
+        pool.add_account('token')
+        room_uuids = [r['uuid'] for r in pool.refresh_rooms()]
+        subscribes = [pool.subscribe(room_uuid) for room_uuid in room_uuids]
+        time.sleep(0.2)
+
+        start = time.time()
+        self.assertEqual(len(pool.get_messages(room_uuids[0]).result(timeout=5.0)), 5)
+        # 購読のロングポーリングが終わるのを待たない
+        self.assertLess(time.time() - start, 1.0)
+        for future in subscribes:
+            future.result(timeout=5.0)
+
+    def test_subscribe_does_not_block(self):
+        self.check_subscribe_does_not_block('http1')
+
+    @unittest.skipIf(http2.httpx is None, 'httpx is not installed')
+    def test_subscribe_does_not_block_http2_fallback(self):
+        # フェイクサーバは HTTP/1.1 しか話さない
+        self.check_subscribe_does_not_block('http2')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+# encoding: utf-8
+from __future__ import absolute_import
+import time
+import unittest
+import uuid
+
+from bocco.api import Client
+from bocco.relay import Relay, Sink
+from support import RunningServer
+
+
+class ListSink(Sink):
+
+    def __init__(self):
+        super(ListSink, self).__init__(batch_interval=0.05)
+        self.events = []
+
+    def send(self, events):
+        self.events.extend(events)
+
+
+class RelayTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = RunningServer(rooms=1, messages_per_room=10, long_poll_timeout=0.5)
+        self.addCleanup(self.server.close)
+        self.client = Client('token', base_url=self.server.url)
+        self.room_uuid = self.server.fake.room_uuids[0]
+        self.sink = ListSink()
+
+    def wait_for_events(self, count, timeout=5.0):
+        deadline = time.time() + timeout
+        while len(self.sink.events) < count and time.time() < deadline:
+            time.sleep(0.05)
+
+    def test_relay(self):
+        relay = Relay(self.client, [self.room_uuid], [self.sink])
+        relay.start()
+        time.sleep(0.2)
+        self.server.fake.post_message(self.room_uuid, u'hello')
+        self.wait_for_events(1)
+        relay.stop(timeout=1.0)
+        self.assertEqual([e['body']['text'] for e in self.sink.events], [u'hello'])
+        self.assertEqual(self.sink.events[0]['room_uuid'], str(self.room_uuid))
+
+    def test_transient_error_is_retried(self):
+        self.server.fail(1, '/subscribe')
+        relay = Relay(self.client, [self.room_uuid], [self.sink])
+        relay.start()
+        time.sleep(0.2)
+        self.server.fake.post_message(self.room_uuid, u'hello')
+        self.wait_for_events(1)
+        relay.stop(timeout=1.0)
+        self.assertEqual([e['body']['text'] for e in self.sink.events], [u'hello'])
+        self.assertEqual(relay.errors, {})
+
+    def test_error_responses_back_off(self):
+        unknown = uuid.UUID(int=1)
+        relay = Relay(self.client, [unknown], [self.sink])
+        relay.start()
+        time.sleep(1.5)
+        relay.stop(timeout=1.0)
+        self.assertIn(unknown, relay.errors)
+        # 0 秒と 1 秒の 2 回だけ (次は 3 秒後)
+        self.assertEqual(self.server.count(str(unknown)), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
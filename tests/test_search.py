@@ -0,0 +1,55 @@
+# encoding: utf-8
+from __future__ import absolute_import
+import os
+import shutil
+import tempfile
+import unittest
+
+import requests
+
+from bocco.api import Client
+from bocco.search import SearchIndex
+from support import RunningServer
+
+
+class SearchIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = RunningServer(rooms=1, messages_per_room=100, page_size=20)
+        self.addCleanup(self.server.close)
+        self.client = Client('token', base_url=self.server.url)
+        self.room_uuid = self.server.fake.room_uuids[0]
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.index = SearchIndex(os.path.join(directory, 'index.sqlite'))
+        self.addCleanup(self.index.close)
+
+    def indexed(self):
+        return len(self.index.search(u'', room_uuid=self.room_uuid, limit=1000))
+
+    def test_backfill(self):
+        self.assertEqual(self.index.update(self.client, self.room_uuid), 100)
+        self.assertEqual(self.indexed(), 100)
+        self.assertTrue(self.index._room_state(self.room_uuid)[2])
+
+    def test_backfill_error_does_not_complete_room(self):
+        self.server.fail(1, 'older_than=41&')
+        with self.assertRaises(requests.HTTPError):
+            self.index.update(self.client, self.room_uuid)
+        self.assertEqual(self.indexed(), 60)
+        self.assertFalse(self.index._room_state(self.room_uuid)[2])
+
+        self.assertEqual(self.index.update(self.client, self.room_uuid), 40)
+        self.assertEqual(self.indexed(), 100)
+        self.assertTrue(self.index._room_state(self.room_uuid)[2])
+
+    def test_update_fetches_new_messages(self):
+        self.index.update(self.client, self.room_uuid)
+        self.server.fake.post_message(self.room_uuid, u'zyxwvut')
+        self.assertEqual(self.index.update(self.client, self.room_uuid), 1)
+        hits = self.index.search(u'zyxwvut', room_uuid=self.room_uuid)
+        self.assertEqual([h['text'] for h in hits], [u'zyxwvut'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+# encoding: utf-8
+from __future__ import absolute_import
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from bocco import profiling, web
+from bocco.api import Client
+from bocco.web import app
+from support import RunningServer
+
+
+class StylesheetTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = app.test_client()
+
+    def test_weak_etag_for_every_encoding(self):
+        for headers in ({'Accept-Encoding': 'gzip'}, {}):
+            r = self.client.get('/style.css', headers=headers)
+            self.assertEqual(r.status_code, 200)
+            self.assertTrue(r.headers['ETag'].startswith('W/'))
+
+            r = self.client.get('/style.css', headers=dict(headers, **{'If-None-Match': r.headers['ETag']}))
+            self.assertEqual(r.status_code, 304)
+
+
+class ProfileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.addCleanup(app.config.update, dict(app.config))
+        app.config.update(PROFILE=True, PROFILE_DIR=None)
+        self.client = app.test_client()
+
+    def test_phases_only_without_profile_dir(self):
+        started = []
+        start = profiling._Sampler.start
+
+        def record(sampler):
+            started.append(sampler)
+            start(sampler)
+        profiling._Sampler.start = record
+        self.addCleanup(setattr, profiling._Sampler, 'start', start)
+
+        r = self.client.get('/style.css')
+        self.assertIn('Server-Timing', r.headers)
+        self.assertEqual(started, [])
+
+
+class RoomsCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = RunningServer(rooms=3, messages_per_room=5)
+        self.addCleanup(self.server.close)
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.addCleanup(setattr, app, 'api', app.api)
+        self.addCleanup(app.config.update, dict(app.config))
+        app.api = Client('token', base_url=self.server.url)
+        app.config.update(DOWNLOADS=directory, ROOMS_CACHE_TTL=60)
+        self.path = os.path.join(directory, web.ROOMS_CACHE_PATH)
+        self.forget()
+        self.addCleanup(self.forget)
+
+    def forget(self):
+        # 別のワーカープロセスの状態にする
+        web._rooms_cache.update(rooms=None, expires=0.0)
+
+    def test_workers_share_rooms(self):
+        rooms = web._get_rooms()
+        self.forget()
+        self.assertEqual([r['uuid'] for r in web._get_rooms()], [r['uuid'] for r in rooms])
+        self.assertEqual(self.server.count('/rooms/joined'), 1)
+
+    def test_expired_rooms_are_fetched_again(self):
+        web._get_rooms()
+        os.utime(self.path, (0, 0))
+        self.forget()
+        web._get_rooms()
+        self.forget()
+        web._get_rooms()
+        self.assertEqual(self.server.count('/rooms/joined'), 2)
+
+
+class SearchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = RunningServer(rooms=1, messages_per_room=100, page_size=20)
+        self.addCleanup(self.server.close)
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.addCleanup(setattr, app, 'api', app.api)
+        self.addCleanup(app.config.update, dict(app.config))
+        self.addCleanup(setattr, web, '_search_index', None)
+        app.api = Client('token', base_url=self.server.url)
+        app.config.update(SEARCH_INDEX=os.path.join(directory, 'index.sqlite'))
+        self.room_uuid = self.server.fake.room_uuids[0]
+        self.client = app.test_client()
+
+    def test_history_is_indexed_in_background(self):
+        url = '/{0}/search'.format(self.room_uuid)
+        r = self.client.get(url)
+        self.assertIn(b'Results may be incomplete', r.data)
+
+        index = web._get_search_index()
+        self.addCleanup(index.close)
+        deadline = time.time() + 5.0
+        while not index.is_complete(self.room_uuid) and time.time() < deadline:
+            time.sleep(0.05)
+        r = self.client.get(url)
+        self.assertNotIn(b'Results may be incomplete', r.data)
+        self.assertIn(b'50 results', r.data)
+        self.assertEqual(len(index.search(u'', room_uuid=self.room_uuid, limit=1000)), 100)
+
+
+if __name__ == '__main__':
+    unittest.main()